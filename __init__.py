@@ -16,16 +16,34 @@ if "bpy" in locals():
     import imp
     imp.reload(addon_updater_ops)
     imp.reload(analytics)
+    imp.reload(animation_journal)
+    imp.reload(animation_manifest)
+    imp.reload(cancellation)
     imp.reload(config)
+    imp.reload(controlnet_cache)
+    imp.reload(encoded_image)
+    imp.reload(frame_claims)
     imp.reload(handlers)
+    imp.reload(headless)
+    imp.reload(http_sessions)
+    imp.reload(json_stream)
+    imp.reload(local_upscaler)
     imp.reload(operators)
+    imp.reload(output_images)
+    imp.reload(pixel_utils)
     imp.reload(preferences)
     imp.reload(progress_bar)
+    imp.reload(prompt_timeline)
     imp.reload(properties)
+    imp.reload(render_passes)
+    imp.reload(result_cache)
     imp.reload(task_queue)
+    imp.reload(temp_files)
+    imp.reload(tiled_generation)
     imp.reload(ui_panels)
     imp.reload(ui_preset_styles)
     imp.reload(utils)
+    imp.reload(worker_pool)
     imp.reload(automatic1111_api)
     imp.reload(stability_api)
     imp.reload(stablehorde_api)
@@ -33,14 +51,32 @@ else:
     from . import (
         addon_updater_ops,
         analytics,
+        animation_journal,
+        animation_manifest,
+        cancellation,
         config,
+        controlnet_cache,
+        encoded_image,
+        frame_claims,
         handlers,
+        headless,
+        http_sessions,
+        json_stream,
+        local_upscaler,
         operators,
+        output_images,
+        pixel_utils,
         preferences,
         progress_bar,
+        prompt_timeline,
         properties,
+        render_passes,
+        result_cache,
         task_queue,
+        temp_files,
+        tiled_generation,
         utils,
+        worker_pool,
     )
     from .ui import (
         ui_panels,
@@ -59,26 +95,34 @@ def register():
     addon_updater_ops.register(bl_info)
     analytics.register(bl_info)
     handlers.register()
+    http_sessions.register()
+    local_upscaler.register()
     operators.register()
     preferences.register()
     progress_bar.register()
     properties.register()
     task_queue.register()
+    temp_files.register()
     ui_panels.register()
     ui_preset_styles.register()
+    worker_pool.register()
 
 
 def unregister():
     addon_updater_ops.unregister()
     analytics.unregister()
     handlers.unregister()
+    http_sessions.unregister()
+    local_upscaler.unregister()
     operators.unregister()
     preferences.unregister()
     progress_bar.unregister()
     properties.unregister()
     task_queue.unregister()
+    temp_files.unregister()
     ui_panels.unregister()
     ui_preset_styles.unregister()
+    worker_pool.unregister()
 
 
 if __name__ == "__main__":
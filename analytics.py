@@ -129,7 +129,7 @@ def track_event(event_name, event_params=None, value=None):
         event_params = prepare_event(event_name, value=value)
 
     # add the event to the task queue
-    task_queue.add(functools.partial(_track_event, event_name, event_params))
+    task_queue.add(functools.partial(_track_event, event_name, event_params), task_queue.PRIORITY_BACKGROUND)
 
 
 def prepare_event(event_name, generation_params=None, additional_params=None, value=None):
@@ -0,0 +1,256 @@
+import bpy
+import json
+import os
+import time
+from . import utils
+
+
+# a journal, saved next to the animation frames, of the animation render in progress: the
+# frames to render (with their resolved prompts), the settings they're rendered with, and
+# each frame that's been completed (with its seed and output file). It's rewritten after
+# every frame, so if Blender crashes (or the backend goes down) part way through, the
+# render can be resumed from where it stopped, with the same parameters. If any of the
+# settings can't be restored (e.g. a model that's been removed, or a different backend),
+# the render isn't resumed, since the rest of its frames wouldn't match the first ones.
+
+JOURNAL_FILENAME = "ai-render-journal.json"
+JOURNAL_VERSION = 3
+
+# the settings that affect the generated frames, which are restored when resuming
+PROPS_SETTINGS = [
+    "prompt_text",
+    "negative_prompt_text",
+    "use_animated_prompts",
+    "animated_prompts_blend_frames",
+    "use_preset",
+    "preset_style",
+    "image_similarity",
+    "cfg_scale",
+    "use_random_seed",
+    "seed",
+    "steps",
+    "sd_model",
+    "sampler",
+    "automatic1111_tiling",
+    "do_upscale_automatically",
+    "upscale_factor",
+    "upscaler_model",
+    "use_local_upscaler",
+    "use_tiled_generation",
+    "tiled_generation_overlap",
+    "inpaint_mask_source",
+    "inpaint_mask_path",
+    "inpaint_mask_object_index",
+    "inpaint_mask_invert",
+    "inpaint_mask_feather",
+    "inpaint_full_res",
+    "inpaint_padding",
+    "animation_skip_unchanged_frames",
+]
+CONTROLNET_SETTINGS = [
+    "input_source",
+    "aov_name",
+    "preprocessor",
+    "model",
+    "conditioning",
+    "lowvram",
+    "preprocessor_res",
+    "preprocessor_threshold_a",
+    "preprocessor_threshold_b",
+    "model_guidance_start",
+    "model_guidance_end",
+    "control_mode",
+    "pixel_perfect",
+]
+RENDER_SETTINGS = [
+    "resolution_x",
+    "resolution_y",
+    "resolution_percentage",
+]
+
+
+# private
+journals = {} # output dir -> journal
+recording = set() # output dirs of the journals for the renders in progress
+
+
+def get_journal_path(output_dir):
+    return os.path.join(output_dir, JOURNAL_FILENAME)
+
+
+def save(output_dir):
+    journal_path = get_journal_path(output_dir)
+    partial_path = journal_path + ".tmp"
+
+    # write to a temp file and then rename it, so a crash never leaves a broken journal
+    try:
+        with open(partial_path, 'w') as file:
+            json.dump(journals[output_dir], file, indent=1)
+        os.replace(partial_path, journal_path)
+    except OSError as e:
+        print(f"AI Render: couldn't save the animation journal ({e})")
+
+
+def get_controlnet_settings(unit):
+    settings = {name: getattr(unit, name) for name in CONTROLNET_SETTINGS}
+    settings["image"] = unit.image.name if unit.image else None
+    return settings
+
+
+def apply_controlnet_settings(unit, settings):
+    for name, value in settings.items():
+        try:
+            if name == "image":
+                unit.image = bpy.data.images.get(value) if value else None
+            else:
+                setattr(unit, name, value)
+        except (TypeError, ValueError, AttributeError) as e:
+            print(f"AI Render: couldn't restore the ControlNet setting \"{name}\" from the animation journal ({e})")
+
+
+# public methods
+def get_settings(scene):
+    """Get the settings that affect the generated frames (everything that goes into a frame's fingerprint, other than
+    the rendered image), to save in the journal"""
+    props = scene.air_props
+    return {
+        "backend": utils.sd_backend(),
+        "props": {name: getattr(props, name) for name in PROPS_SETTINGS},
+        "control_nets": [get_controlnet_settings(unit) for unit in props.control_nets],
+        "render": {name: getattr(scene.render, name) for name in RENDER_SETTINGS},
+    }
+
+
+def apply_settings(scene, settings):
+    """Restore the settings saved in the journal (the backend is a preference, so it isn't changed). Returns the names
+    of the settings that are still different afterwards (e.g. a model that's been removed), so the render isn't resumed
+    with them"""
+    targets = {
+        "props": scene.air_props,
+        "render": scene.render,
+    }
+
+    for section, target in targets.items():
+        for name, value in settings[section].items():
+            try:
+                setattr(target, name, value)
+            except (TypeError, ValueError, AttributeError) as e:
+                print(f"AI Render: couldn't restore the setting \"{name}\" from the animation journal ({e})")
+
+    control_nets = scene.air_props.control_nets
+    control_nets.clear()
+    for unit_settings in settings["control_nets"]:
+        apply_controlnet_settings(control_nets.add(), unit_settings)
+
+    return get_changed_settings(settings, get_settings(scene))
+
+
+def get_changed_settings(settings, current_settings):
+    """Get the names of the settings that differ between two sets of settings (from get_settings)"""
+    changed = []
+    if settings["backend"] != current_settings["backend"]:
+        changed.append("backend")
+    for section in ["props", "render"]:
+        changed += [name for name, value in settings[section].items() if current_settings[section].get(name) != value]
+
+    units, current_units = settings["control_nets"], current_settings["control_nets"]
+    if len(units) != len(current_units):
+        changed.append("control_nets")
+    else:
+        for i, (unit, current_unit) in enumerate(zip(units, current_units)):
+            changed += [f"control_nets[{i}].{name}" for name, value in unit.items() if current_unit.get(name) != value]
+
+    return changed
+
+
+def load(output_dir):
+    """Load the journal in an animation output path, or None if there isn't one"""
+    if output_dir not in journals:
+        journal = None
+        try:
+            with open(get_journal_path(output_dir), 'r') as file:
+                journal = json.load(file)
+            if journal.get("version") != JOURNAL_VERSION:
+                journal = None
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"AI Render: couldn't read the animation journal ({e})")
+            journal = None
+
+        journals[output_dir] = journal
+    return journals[output_dir]
+
+
+def start(output_dir, frames, settings):
+    """Start a new journal for an animation render. frames is a list of (frame, prompts) tuples, in the order they'll be rendered"""
+    journals[output_dir] = {
+        "version": JOURNAL_VERSION,
+        "started_at": time.time(),
+        "finished": False,
+        "settings": settings,
+        "frames": [
+            {"frame": frame, "prompts": prompts, "done": False}
+            for frame, prompts in frames
+        ],
+    }
+    recording.add(output_dir)
+    save(output_dir)
+
+
+def resume(output_dir):
+    """Start recording frames in the existing journal again, when resuming its render"""
+    if load(output_dir):
+        recording.add(output_dir)
+
+
+def stop(output_dir):
+    """Stop recording frames in the journal (e.g. when its render is stopped or canceled)"""
+    recording.discard(output_dir)
+
+
+def record_frame(frame_file, frame, seed):
+    """Record that a frame has been saved (this does nothing if there's no journal being recorded for the frame's folder)"""
+    output_dir = os.path.dirname(frame_file)
+    if output_dir not in recording:
+        return
+
+    for entry in journals[output_dir]["frames"]:
+        if entry["frame"] == frame:
+            entry.update({
+                "done": True,
+                "seed": seed,
+                "file": os.path.basename(frame_file),
+                "completed_at": time.time(),
+            })
+            save(output_dir)
+            return
+
+
+def finish(output_dir):
+    """Mark the journal's render as finished, so there's nothing left to resume"""
+    if output_dir in recording:
+        journals[output_dir]["finished"] = True
+        save(output_dir)
+        recording.discard(output_dir)
+
+
+def get_remaining_frames(output_dir, check_files=True):
+    """Get the (frame, prompts) tuples that still need to be rendered, in order, or None if there's nothing to resume"""
+    journal = load(output_dir)
+    if not journal or journal["finished"]:
+        return None
+
+    # a frame also needs to be rendered again if its image has been removed since
+    remaining_frames = [
+        (entry["frame"], entry["prompts"])
+        for entry in journal["frames"]
+        if not entry["done"] or (check_files and not os.path.exists(os.path.join(output_dir, entry["file"])))
+    ]
+    return remaining_frames or None
+
+
+def reset():
+    """Forget the loaded journals, so they're read from disk again"""
+    journals.clear()
+    recording.clear()
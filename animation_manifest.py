@@ -0,0 +1,81 @@
+import json
+import os
+from . import result_cache
+
+
+# a manifest, saved next to the animation frames, with a fingerprint of everything that
+# went into each frame (the rendered image, prompts, seed and backend params). When an
+# animation is rendered again, frames with a matching fingerprint don't need to be sent
+# to Stable Diffusion again.
+
+MANIFEST_FILENAME = "ai-render-manifest.json"
+MANIFEST_VERSION = 1
+
+
+# private
+manifests = {} # output dir -> {frame: {"fingerprint": ..., "file": ...}}
+
+
+def get_manifest_path(output_dir):
+    return os.path.join(output_dir, MANIFEST_FILENAME)
+
+
+def load(output_dir):
+    if output_dir not in manifests:
+        frames = {}
+        try:
+            with open(get_manifest_path(output_dir), 'r') as file:
+                manifest = json.load(file)
+            if manifest.get("version") == MANIFEST_VERSION:
+                frames = manifest.get("frames", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"AI Render: couldn't read the animation manifest, so every frame will be rendered ({e})")
+
+        manifests[output_dir] = frames
+    return manifests[output_dir]
+
+
+def save(output_dir):
+    manifest_path = get_manifest_path(output_dir)
+    partial_path = manifest_path + ".tmp"
+
+    # write to a temp file and then rename it, so a crash never leaves a broken manifest
+    try:
+        with open(partial_path, 'w') as file:
+            json.dump({"version": MANIFEST_VERSION, "frames": manifests[output_dir]}, file, indent=1, sort_keys=True)
+        os.replace(partial_path, manifest_path)
+    except OSError as e:
+        print(f"AI Render: couldn't save the animation manifest ({e})")
+
+
+# public methods
+def get_fingerprint(backend_name, params, img_file=None, output_settings=None):
+    """Get a fingerprint of everything that goes into a frame: the backend, params (including prompts and seed), input image and output settings"""
+    return result_cache.get_key(backend_name, {"params": params, "output_settings": output_settings}, img_file)
+
+
+def is_frame_unchanged(frame_file, frame, fingerprint):
+    """Check whether the frame was already generated from the exact same inputs, and its image still exists"""
+    entry = load(os.path.dirname(frame_file)).get(str(frame))
+    return (
+        entry is not None
+        and entry.get("fingerprint") == fingerprint
+        and entry.get("file") == os.path.basename(frame_file)
+        and os.path.exists(frame_file)
+    )
+
+
+def record_frame(frame_file, frame, fingerprint):
+    output_dir = os.path.dirname(frame_file)
+    load(output_dir)[str(frame)] = {
+        "fingerprint": fingerprint,
+        "file": os.path.basename(frame_file),
+    }
+    save(output_dir)
+
+
+def reset():
+    """Forget the loaded manifests, so they're read from disk again (in case the frames were changed outside of Blender)"""
+    manifests.clear()
@@ -0,0 +1,112 @@
+import threading
+
+
+# a cancel token is shared by everything working on a request (the operator, the worker
+# thread and the backend), so the request can be stopped from the main thread. Cancelling
+# aborts the request locally (the next time the body is sent or the response is read, a
+# Cancelled exception is raised), and runs any callbacks the backend has registered, e.g.
+# to close the connection while waiting for the response, or to stop the request on the
+# server (only Automatic1111 and Stable Horde can be told to stop; the other servers
+# keep generating an image that's been sent to them, and the result is just dropped).
+
+
+class Cancelled(Exception):
+    """Raised when a request is stopped because its token was cancelled"""
+
+
+class CancelToken:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks = []
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.event.is_set():
+            raise Cancelled()
+
+    def wait(self, timeout):
+        """Sleep for up to timeout seconds, waking up early if the token is cancelled. Returns True if it was cancelled"""
+        return self.event.wait(timeout)
+
+    def on_cancel(self, callback):
+        """Call a function when the token is cancelled (or right away, if it already has been). Returns the callback, so it can be removed"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return callback
+
+        run_callbacks([callback])
+        return callback
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def cancel(self):
+        """Cancel the token. Returns False if it was already cancelled"""
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+
+        run_callbacks(callbacks)
+        return True
+
+
+# private
+lock = threading.Lock()
+active_tokens = {} # token -> number of requests using it
+
+
+def run_callbacks(callbacks):
+    if not callbacks:
+        return
+
+    def run():
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"AI Render: couldn't cancel the request on the server ({e})")
+
+    # the callbacks usually send a request to the server, so don't block the caller (which
+    # is usually the main thread), and don't wait behind the requests in the worker pool
+    threading.Thread(target=run, name="ai-render-cancel", daemon=True).start()
+
+
+# public methods
+def acquire(token=None):
+    """Mark a token (or a new one, if none is given) as being used by a request, so cancel_all() can find it"""
+    if token is None:
+        token = CancelToken()
+
+    with lock:
+        active_tokens[token] = active_tokens.get(token, 0) + 1
+    return token
+
+
+def release(token):
+    """Mark a request using the token as finished"""
+    with lock:
+        count = active_tokens.get(token, 0) - 1
+        if count > 0:
+            active_tokens[token] = count
+        else:
+            active_tokens.pop(token, None)
+
+
+def cancel_all():
+    """Cancel every request that's in progress. Returns the number of tokens that were cancelled"""
+    with lock:
+        tokens = list(active_tokens)
+    return sum(1 for token in tokens if token.cancel())
+
+
+def get_active_count():
+    with lock:
+        return len(active_tokens)
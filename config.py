@@ -1,6 +1,7 @@
 package_name = 'AI-Render'
 default_prompt_text = 'Describe anything you can imagine'
 tmp_path_subfolder = 'ai-render-temp'
+result_cache_subfolder = 'ai-render-cache'
 workspace_id = 'AI Render'
 animated_prompts_text_name = 'AI Render Animated Prompts'
 
@@ -0,0 +1,103 @@
+import array
+import base64
+import hashlib
+import os
+import bpy
+from . import json_stream
+
+
+# ControlNet input images are usually the same for every frame of an animation (e.g. a
+# reference pose or depth map), so each one is encoded once and kept in memory, keyed by
+# its image datablock, along with a fingerprint of the image. The image is only saved and
+# encoded again when its fingerprint changes.
+#
+# For an image loaded from a file (and not edited since), the fingerprint comes from the
+# file's size and modification time. Otherwise (a generated, packed or edited image), it's
+# a hash of the pixels, which is still much faster than saving and encoding the image.
+
+MAX_ENTRIES = 16
+
+# these change with every render, or every frame, so there's no point caching them
+UNCACHEABLE_IMAGE_TYPES = {'RENDER_RESULT', 'COMPOSITING'}
+UNCACHEABLE_IMAGE_SOURCES = {'SEQUENCE', 'MOVIE', 'VIEWER'}
+
+
+# private
+entries = {} # (pointer, name) -> (fingerprint, Base64Data), in order of last use
+
+
+def get_datablock_key(image):
+    return image.as_pointer(), image.name_full
+
+
+def get_pixels_hash(image):
+    pixels = array.array('f', bytes(4 * len(image.pixels)))
+    image.pixels.foreach_get(pixels)
+    return hashlib.sha256(pixels).hexdigest()
+
+
+def get_fingerprint(image, scene):
+    # save_render uses the scene's color management and output format, so those are part of it too
+    image_settings = scene.render.image_settings
+    view_settings = scene.view_settings
+    fingerprint = [
+        tuple(image.size),
+        image.colorspace_settings.name,
+        image_settings.file_format,
+        image_settings.color_mode,
+        image_settings.color_depth,
+        scene.display_settings.display_device,
+        view_settings.view_transform,
+        view_settings.look,
+        round(view_settings.exposure, 4),
+        round(view_settings.gamma, 4),
+    ]
+
+    filepath = bpy.path.abspath(image.filepath) if image.source == 'FILE' else ""
+    if filepath and not image.packed_file and not image.is_dirty and os.path.exists(filepath):
+        stat = os.stat(filepath)
+        fingerprint.extend([filepath, stat.st_size, stat.st_mtime_ns])
+    else:
+        fingerprint.append(get_pixels_hash(image))
+
+    return tuple(fingerprint)
+
+
+def is_cacheable(image):
+    return image.type not in UNCACHEABLE_IMAGE_TYPES and image.source not in UNCACHEABLE_IMAGE_SOURCES
+
+
+def create_input_image(data):
+    return json_stream.Base64Data(base64.b64encode(data), content_hash=hashlib.sha256(data).hexdigest())
+
+
+# public methods
+def get_input_image(image, scene, encode):
+    """Get an image as base64 encoded data for a ControlNet unit, only calling encode(image) (which returns the encoded
+    bytes, or False) if the image has changed since it was last encoded"""
+    if not is_cacheable(image):
+        data = encode(image)
+        return create_input_image(data) if data else False
+
+    key = get_datablock_key(image)
+    fingerprint = get_fingerprint(image, scene)
+
+    entry = entries.pop(key, None)
+    if entry and entry[0] == fingerprint:
+        input_image = entry[1]
+    else:
+        data = encode(image)
+        if not data:
+            return False
+        input_image = create_input_image(data)
+
+    # keep it as the most recently used, and forget the least recently used ones
+    entries[key] = (fingerprint, input_image)
+    while len(entries) > MAX_ENTRIES:
+        del entries[next(iter(entries))]
+
+    return input_image
+
+
+def clear():
+    entries.clear()
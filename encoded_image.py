@@ -0,0 +1,36 @@
+import base64
+import io
+
+
+class EncodedImage:
+    """An image that has been encoded once (e.g. to PNG) and is kept in memory, so its bytes can be shared by everything that needs them"""
+
+    def __init__(self, data, file_format, name="image"):
+        self.data = data
+        self.file_format = file_format
+        self.name = name
+        self._base64 = None
+
+    def get_filename(self):
+        return f"{self.name}.{self.file_format.lower()}"
+
+    def open(self):
+        """Get a file-like object for the image, which can be used anywhere an opened image file is expected"""
+        img_file = io.BytesIO(self.data)
+        img_file.name = self.get_filename()
+        return img_file
+
+    def base64(self):
+        """Get the base64 encoded image (this is only encoded the first time it's needed)"""
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode()
+        return self._base64
+
+    def save(self, filepath):
+        with open(filepath, 'wb') as file:
+            file.write(self.data)
+
+
+def from_file(filepath, file_format, name="image"):
+    with open(filepath, 'rb') as file:
+        return EncodedImage(file.read(), file_format, name)
@@ -0,0 +1,197 @@
+import json
+import os
+import re
+import socket
+import time
+import uuid
+
+
+# lets several Blender instances (e.g. render farm nodes) share the work of rendering one
+# animation. Before a frame is rendered, it's claimed with a lock file next to the frames
+# in the animation output path. The lock file is created atomically, so only one instance
+# gets each frame, and it's touched regularly while the frame is in progress. A claim that
+# hasn't been touched for a while was left by an instance that crashed, so it's taken over.
+# Once a frame is done, its claim is marked as done, so it isn't rendered again.
+#
+# NOTE: This relies on the file system creating files atomically (O_EXCL), which local
+# disks and SMB shares do, but some older NFS setups don't.
+
+CLAIM_FILENAME = "ai-render-{}.claim"
+
+# one item in a frame list: a frame (e.g. "15") or a range of frames (e.g. "1-10")
+FRAME_LIST_ITEM = re.compile(r"(\d+)(?:\s*-\s*(\d+))?")
+
+# how often to touch the claims that are in progress, relative to the claim timeout
+REFRESH_FRACTION = 0.25
+
+
+def get_claim_path(output_dir, frame):
+    return os.path.join(output_dir, CLAIM_FILENAME.format(str(frame).zfill(4)))
+
+
+def read_claim(claim_path):
+    try:
+        with open(claim_path, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        # it's being written right now (or it's broken), so treat it as in progress
+        return {}
+
+
+def write_new_claim(claim_path, claim):
+    """Create the claim file, only if it doesn't already exist. Returns True if it was created"""
+    try:
+        file = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(file, 'w') as claim_file:
+        json.dump(claim, claim_file)
+    return True
+
+
+def parse_frame_list(text):
+    """Parse a list of frames and frame ranges, like "1-10, 15, 20-30". Raises a ValueError if it can't be parsed"""
+    frames = []
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+
+        match = FRAME_LIST_ITEM.fullmatch(item)
+        if not match:
+            raise ValueError(f"\"{item}\" isn't a frame or a range of frames (use e.g. \"1-10, 15, 20-30\")")
+
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else start
+        frames.extend(range(start, end + 1) if end >= start else range(start, end - 1, -1))
+
+    # remove duplicates, but keep the order
+    return list(dict.fromkeys(frames))
+
+
+# public methods
+def get_frames_to_render(frames, shard_index=0, shard_count=1, frame_list=""):
+    """Get the frames to try to claim, in order: this shard's frames first, and then the rest (to help with them, if they're still unclaimed)"""
+    if frame_list.strip():
+        frames = parse_frame_list(frame_list)
+    else:
+        frames = list(frames)
+
+    if shard_count <= 1:
+        return frames
+
+    shard_frames = frames[shard_index % shard_count::shard_count]
+    shard_frames_set = set(shard_frames)
+    return shard_frames + [frame for frame in frames if frame not in shard_frames_set]
+
+
+class FrameClaims:
+    """The frames claimed by this instance, for one animation render"""
+
+    def __init__(self, output_dir, timeout):
+        self.output_dir = output_dir
+        self.timeout = timeout
+        self.owner = {
+            "id": uuid.uuid4().hex,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+        }
+        self.claimed = set()
+        self.refreshed_at = time.time()
+
+    def create_claim(self):
+        return {**self.owner, "claimed_at": time.time(), "done": False}
+
+    def is_stale(self, claim_path):
+        try:
+            return time.time() - os.path.getmtime(claim_path) > self.timeout
+        except OSError:
+            return False
+
+    def take_over_stale_claim(self, claim_path, stale_claim):
+        # move the stale claim out of the way (only one instance can succeed at this), and
+        # make sure it's the one we saw, and not a fresh claim made in the meantime
+        moved_path = f"{claim_path}.{self.owner['id']}.stale"
+        try:
+            os.rename(claim_path, moved_path)
+        except OSError:
+            return False
+
+        if read_claim(moved_path) != stale_claim:
+            if not os.path.exists(claim_path):
+                os.rename(moved_path, claim_path)
+            return False
+
+        os.remove(moved_path)
+        print(f"AI Render: taking over the stale claim for {os.path.basename(claim_path)} (from {stale_claim.get('host')}, pid {stale_claim.get('pid')})")
+        return write_new_claim(claim_path, self.create_claim())
+
+    def claim(self, frame):
+        """Try to claim a frame. Returns True if this instance should render it"""
+        claim_path = get_claim_path(self.output_dir, frame)
+
+        if write_new_claim(claim_path, self.create_claim()):
+            self.claimed.add(frame)
+            return True
+
+        # it's already claimed, so only take it if the claim is stale (and not done)
+        existing_claim = read_claim(claim_path)
+        if existing_claim is None:
+            return self.claim(frame)
+        if existing_claim.get("done") or not self.is_stale(claim_path):
+            return False
+
+        if self.take_over_stale_claim(claim_path, existing_claim):
+            self.claimed.add(frame)
+            return True
+        return False
+
+    def refresh(self, force=False):
+        """Touch the claims that are in progress, so other instances know this one is still working on them"""
+        now = time.time()
+        if not force and now - self.refreshed_at < self.timeout * REFRESH_FRACTION:
+            return
+
+        self.refreshed_at = now
+        for frame in self.claimed:
+            try:
+                os.utime(get_claim_path(self.output_dir, frame))
+            except OSError:
+                pass
+
+    def finish(self, frame, success):
+        """Mark a claimed frame as done, or release it (so it can be tried again) if it failed"""
+        if frame not in self.claimed:
+            return
+        self.claimed.discard(frame)
+
+        claim_path = get_claim_path(self.output_dir, frame)
+        try:
+            if success:
+                with open(claim_path, 'w') as file:
+                    json.dump({**self.owner, "finished_at": time.time(), "done": True}, file)
+            else:
+                os.remove(claim_path)
+        except OSError as e:
+            print(f"AI Render: couldn't update the claim for frame {frame} ({e})")
+
+    def release_all(self):
+        """Release the claims that are still in progress (e.g. when the render is canceled)"""
+        for frame in list(self.claimed):
+            self.finish(frame, False)
+
+
+def clear(output_dir):
+    """Remove all the claims in an animation output path, so every frame can be rendered again"""
+    removed = 0
+    try:
+        for entry in os.scandir(output_dir):
+            if entry.name.startswith("ai-render-") and (entry.name.endswith(".claim") or entry.name.endswith(".stale")):
+                os.remove(entry.path)
+                removed += 1
+    except OSError as e:
+        print(f"AI Render: couldn't clear the frame claims ({e})")
+    return removed
@@ -2,6 +2,7 @@ import bpy
 from bpy.app.handlers import persistent
 import functools
 from . import (
+    controlnet_cache,
     operators,
     preferences,
     properties,
@@ -15,6 +16,9 @@ def load_post_handler(loaded_filename):
     """Handle new blender file load (and new scene load)"""
     context = bpy.context
 
+    # the cached ControlNet images belonged to the last file's images
+    controlnet_cache.clear()
+
     # if AI Render has been enabled in this file, do the enable steps
     # right now, to ensure everything is running and in place
     if context.scene.air_props.is_enabled:
@@ -99,8 +103,9 @@ def render_complete_handler(scene):
         # do pre-api setup
         operators.do_pre_api_setup(scene)
 
-        # post to the api (on a different thread, outside the handler)
-        task_queue.add(functools.partial(operators.sd_generate, scene))
+        # post to the api (on a different thread, outside the handler). If the render
+        # completes again before this runs, only the latest one is sent
+        task_queue.add(functools.partial(operators.sd_generate, scene), key="auto_run_generate")
     else:
         operators.handle_error(scene, "Rendered image is not ready. Try generating a new image manually under AI Render > Operation", "image_not_ready")
 
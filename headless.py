@@ -0,0 +1,385 @@
+import argparse
+import functools
+import json
+import os
+import sys
+import time
+import bpy
+from . import (
+    animation_journal,
+    animation_manifest,
+    cancellation,
+    operators,
+    task_queue,
+    utils,
+)
+
+
+# run AI Render without any ui (e.g. on a render farm), from Blender's background mode.
+# Everything runs synchronously: the task queue is run right here (app timers don't run
+# while a script is running), and Blender exits with one of the status codes below.
+#
+#   blender -b shot.blend --addons AI-Render \
+#       --python-expr "import sys; sys.modules['AI-Render'].headless.main()" \
+#       -- --frames 1-100 --overrides '{"props": {"seed": 1234}}'
+#
+# To split an animation across several farm nodes, give each one a different --shard
+# (e.g. --shard 1/4 to --shard 4/4), with the same output path. If a render stops part
+# way (e.g. Blender crashed), run it again with --resume to pick up where it left off.
+#
+# The overrides (a JSON file, or a JSON string) can set any of AI Render's scene
+# properties ("props"), its add-on preferences ("preferences"), and the scene's render
+# settings ("render"), e.g. {"props": {"prompt_text": "a castle"}, "render": {"resolution_x": 768}}
+
+EXIT_SUCCESS = 0
+EXIT_FAILED = 1
+EXIT_INVALID_ARGS = 2
+EXIT_INVALID_SETUP = 3
+EXIT_CANCELLED = 130
+
+POLL_INTERVAL = 0.05
+
+
+class InvalidArgs(Exception):
+    pass
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="AI Render headless", description="Generate AI Render images without the ui")
+    parser.add_argument("--frame", type=int, help="generate a single image from this frame (defaults to the current frame)")
+    parser.add_argument("--frames", help="generate an animation from a frame range, like 1-100 (defaults to the scene's frame range)")
+    parser.add_argument("--animation", action="store_true", help="generate an animation from the scene's frame range")
+    parser.add_argument("--step", type=int, help="the frame step for an animation (defaults to the scene's frame step)")
+    parser.add_argument("--shard", help="share the animation's frames with other instances, starting with shard I of N, like 2/4 (frames are claimed with lock files in the output path)")
+    parser.add_argument("--resume", action="store_true", help="continue the last animation render in the output path from where it stopped, with the same settings")
+    parser.add_argument("--txt2img", action="store_true", help="generate a single image from the prompt only, without rendering")
+    parser.add_argument("--overrides", help="a JSON file, or JSON string, with settings to override")
+    parser.add_argument("--output", help="where to save the image (for a single image) or the frames (for an animation)")
+
+    # Blender's own arguments come before "--"
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+
+    try:
+        return parser.parse_args(argv)
+    except SystemExit as e:
+        raise InvalidArgs(f"Invalid arguments (exit status {e.code})")
+
+
+def load_overrides(overrides):
+    if not overrides:
+        return {}
+
+    try:
+        if overrides.lstrip().startswith("{"):
+            return json.loads(overrides)
+        with open(overrides, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        raise InvalidArgs(f"Couldn't read the overrides ({e})")
+
+
+def apply_overrides(context, overrides):
+    targets = {
+        "props": context.scene.air_props,
+        "preferences": utils.get_addon_preferences(context),
+        "render": context.scene.render,
+    }
+
+    for section, values in overrides.items():
+        if section not in targets or not isinstance(values, dict):
+            raise InvalidArgs(f"Unknown overrides section \"{section}\" (use {', '.join(targets)})")
+
+        target = targets[section]
+        for key, value in values.items():
+            if key not in target.bl_rna.properties:
+                raise InvalidArgs(f"Unknown setting \"{section}.{key}\"")
+            try:
+                setattr(target, key, value)
+            except (TypeError, ValueError, AttributeError) as e:
+                raise InvalidArgs(f"Invalid value for \"{section}.{key}\" ({e})")
+
+
+def apply_shard(scene, shard):
+    try:
+        index, _, count = shard.partition("/")
+        index, count = int(index), int(count)
+    except ValueError:
+        raise InvalidArgs(f"Invalid shard \"{shard}\" (use e.g. 2/4)")
+    if count < 1 or index < 1 or index > count:
+        raise InvalidArgs(f"Invalid shard \"{shard}\" (the shard must be between 1 and the number of shards)")
+
+    props = scene.air_props
+    props.animation_use_sharding = True
+    props.animation_shard_index = index
+    props.animation_shard_count = count
+
+
+def parse_frame_range(scene, args):
+    if args.frames:
+        try:
+            start, _, end = args.frames.partition("-")
+            start = int(start)
+            end = int(end) if end else start
+        except ValueError:
+            raise InvalidArgs(f"Invalid frame range \"{args.frames}\" (use e.g. 1-100)")
+    else:
+        start, end = scene.frame_start, scene.frame_end
+
+    step = args.step or scene.frame_step
+    if end < start or step < 1:
+        raise InvalidArgs(f"Invalid frame range {start}-{end}, step {step}")
+
+    return range(start, end + 1, step)
+
+
+def wait_for(is_done):
+    """Run the task queue (which also loads the results coming back from the worker threads) until is_done() returns True"""
+    while not is_done():
+        task_queue.execute_queued_functions()
+        time.sleep(POLL_INTERVAL)
+
+    # finish anything left in the queue (e.g. reporting an error)
+    while task_queue.get_queue_depth():
+        task_queue.execute_queued_functions()
+
+
+def print_error(scene):
+    if scene.air_props.error_message:
+        print(f"AI Render: {scene.air_props.error_message}", file=sys.stderr)
+
+
+def generate_image(context, args):
+    scene = context.scene
+    props = scene.air_props
+
+    if args.frame is not None:
+        scene.frame_set(args.frame)
+
+    # render the frame to start from (unless we're just using the prompt)
+    if not args.txt2img:
+        bpy.ops.render.render()
+
+    results = []
+    if not operators.sd_generate(scene, txt2img=args.txt2img, callback=results.append):
+        return EXIT_INVALID_SETUP
+
+    wait_for(lambda: results)
+    if not results[0]:
+        return EXIT_FAILED
+
+    output_file = props.last_generated_image_filename
+    if args.output:
+        destination = args.output
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, os.path.basename(output_file))
+        utils.copy_file(output_file, destination)
+        output_file = destination
+
+    print(f"AI Render: saved {output_file}")
+    return EXIT_SUCCESS
+
+
+def get_animation_prompts(scene, frames):
+    """Get the prompts (and blend weights) for every frame up front"""
+    props = scene.air_props
+
+    if not props.use_animated_prompts:
+        prompts = {
+            "prompt": operators.get_full_prompt(scene),
+            "negative_prompt": props.negative_prompt_text.strip(),
+        }
+        return {frame: prompts for frame in frames}
+
+    timeline = operators.validate_and_process_animated_prompt_text(scene)
+    if not timeline:
+        return None
+
+    return timeline.get_prompts_for_frames(frames)
+
+
+def generate_animation(context, args):
+    scene = context.scene
+    props = scene.air_props
+
+    if args.output:
+        props.animation_output_path = args.output
+    if args.shard:
+        apply_shard(scene, args.shard)
+
+    if not operators.validate_animation_output_path(scene):
+        return EXIT_INVALID_SETUP
+    output_dir = operators.get_animation_output_dir(scene)
+
+    # when resuming, use the settings, frames and prompts from the journal
+    if args.resume:
+        remaining_frames = animation_journal.get_remaining_frames(output_dir)
+        if not remaining_frames:
+            raise InvalidArgs("There's no unfinished animation render to resume in the output path")
+        changed_settings = animation_journal.apply_settings(scene, animation_journal.load(output_dir)["settings"])
+        if changed_settings:
+            raise InvalidArgs(f"Can't resume the render, because some of its settings can't be restored ({', '.join(changed_settings)})")
+        animation_journal.resume(output_dir)
+
+        frame_prompts = dict(remaining_frames)
+        frames = list(frame_prompts)
+    else:
+        # (the frame list would silently win over --frames, so don't allow both)
+        if args.frames and props.animation_use_sharding and props.animation_shard_frames.strip():
+            raise InvalidArgs("Use either --frames or the scene's list of frames to render, not both")
+        try:
+            frames = operators.get_animation_frames(scene, parse_frame_range(scene, args))
+        except ValueError as e:
+            raise InvalidArgs(f"Invalid list of frames to render ({e})")
+        frame_prompts = get_animation_prompts(scene, frames)
+        if not frame_prompts:
+            return EXIT_INVALID_SETUP
+
+    claims = operators.create_frame_claims(scene)
+
+    if not operators.validate_params(scene):
+        return EXIT_INVALID_SETUP
+
+    # keep a journal, so the render can be resumed if it stops part way (unless the frame
+    # claims are already keeping track of the finished frames)
+    if not args.resume and not claims:
+        animation_journal.start(output_dir, [(frame, frame_prompts[frame]) for frame in frames], animation_journal.get_settings(scene))
+
+    # send frames off like the Render Animation operator does, keeping the pipeline full
+    pipeline_depth = operators.get_animation_pipeline_depth(scene)
+    frame_results = {}
+    skipped_frames = []
+    retries = {}
+    retry_frames = []
+    cancel_token = cancellation.CancelToken()
+
+    def finish_frame(frame, success):
+        # retry a failed frame a few times (it may have been a temporary problem), waiting longer each time
+        attempt = retries.get(frame, 0) + 1
+        if not success and not cancel_token.is_cancelled() and attempt <= props.animation_frame_retries:
+            retries[frame] = attempt
+            delay = operators.get_frame_retry_delay(attempt)
+            print(f"AI Render: frame {frame} failed, retrying in {delay} seconds (attempt {attempt})")
+
+            del frame_results[frame]
+            retry_frames.append((time.time() + delay, frame))
+            return
+
+        frame_results[frame] = success
+        if claims:
+            claims.finish(frame, success)
+
+    def send_frame(frame):
+        frame_results[frame] = None
+        if not operators.render_frame(context, frame, frame_prompts[frame], functools.partial(finish_frame, frame), cancel_token):
+            # the frame couldn't even be sent (e.g. invalid settings), so there's no point retrying it
+            retries[frame] = props.animation_frame_retries
+            finish_frame(frame, False)
+
+    def send_ready_retries():
+        now = time.time()
+        for retry in list(retry_frames):
+            retry_time, frame = retry
+            if retry_time <= now and not has_failed() and get_frames_in_progress() < pipeline_depth:
+                retry_frames.remove(retry)
+                send_frame(frame)
+
+    def get_frames_in_progress():
+        return sum(1 for result in frame_results.values() if result is None)
+
+    def has_failed():
+        return False in frame_results.values()
+
+    def is_ready_for_next_frame():
+        if claims:
+            claims.refresh()
+        send_ready_retries()
+        return has_failed() or get_frames_in_progress() < pipeline_depth
+
+    animation_manifest.reset()
+    props.is_rendering_animation_manually = True
+
+    try:
+        for frame in frames:
+            wait_for(is_ready_for_next_frame)
+            if has_failed():
+                break
+
+            # another instance has already claimed this frame
+            if claims and not claims.claim(frame):
+                skipped_frames.append(frame)
+                continue
+
+            send_frame(frame)
+
+            print(f"AI Render: frame {frame} sent ({sum(1 for result in frame_results.values() if result)}/{len(frames) - len(skipped_frames)} done)")
+
+        # stop the frames still in progress if one failed, and wait for the rest to come back
+        if has_failed():
+            cancel_token.cancel()
+        wait_for(lambda: is_ready_for_next_frame() and (has_failed() or not retry_frames) and get_frames_in_progress() == 0)
+    except KeyboardInterrupt:
+        cancel_token.cancel()
+        wait_for(lambda: get_frames_in_progress() == 0)
+        return EXIT_CANCELLED
+    finally:
+        props.is_rendering_animation_manually = False
+        if claims:
+            claims.release_all()
+        animation_journal.stop(output_dir)
+
+    completed_frames = sum(1 for result in frame_results.values() if result)
+    if skipped_frames:
+        print(f"AI Render: {len(skipped_frames)} frames were claimed by other instances")
+    print(f"AI Render: {completed_frames}/{len(frames) - len(skipped_frames)} frames saved to {bpy.path.abspath(props.animation_output_path)}")
+    if completed_frames < len(frames) - len(skipped_frames):
+        return EXIT_FAILED
+
+    animation_journal.finish(output_dir)
+    return EXIT_SUCCESS
+
+
+# public methods
+def run(argv=None, context=None):
+    """Generate an image or an animation without the ui, and return an exit status code"""
+    if context is None:
+        context = bpy.context
+
+    try:
+        args = parse_args(argv)
+        apply_overrides(context, load_overrides(args.overrides))
+        is_animation = args.animation or args.resume or args.frames is not None
+        if is_animation and (args.frame is not None or args.txt2img):
+            raise InvalidArgs("--frame and --txt2img can't be used for an animation")
+        if args.resume and args.frames is not None:
+            raise InvalidArgs("--frames can't be used with --resume (the frames come from the journal)")
+    except InvalidArgs as e:
+        print(f"AI Render: {e}", file=sys.stderr)
+        return EXIT_INVALID_ARGS
+
+    scene = context.scene
+    operators.do_pre_render_setup(scene)
+
+    # a render would otherwise start another generation on its own
+    scene.air_props.auto_run = False
+
+    try:
+        if is_animation:
+            status = generate_animation(context, args)
+        else:
+            status = generate_image(context, args)
+    except InvalidArgs as e:
+        print(f"AI Render: {e}", file=sys.stderr)
+        return EXIT_INVALID_ARGS
+    except KeyboardInterrupt:
+        cancellation.cancel_all()
+        return EXIT_CANCELLED
+
+    if status != EXIT_SUCCESS:
+        print_error(scene)
+    return status
+
+
+def main(argv=None):
+    """Run from the command line, and exit Blender with the status code"""
+    sys.exit(run(argv))
@@ -0,0 +1,173 @@
+import contextlib
+import functools
+import socket
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+
+# number of hosts each session keeps connections open to, and number of connections
+# per host (this should be at least worker_pool.max_workers, so parallel requests
+# don't have to open and throw away extra connections)
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 10
+
+
+# private
+sessions = {}
+sessions_lock = threading.Lock()
+active_connections = {} # thread id -> the connection that thread last sent a request on
+active_connections_lock = threading.Lock()
+
+
+# the connections remember which thread is sending a request on them, so a request that's
+# waiting for its response can be stopped from another thread (by closing its socket)
+class TrackedConnectionMixin:
+    def request(self, *args, **kwargs):
+        track_connection(self)
+        return super().request(*args, **kwargs)
+
+    def request_chunked(self, *args, **kwargs):
+        # (older versions of urllib3 send streamed bodies with this instead of request)
+        track_connection(self)
+        return super().request_chunked(*args, **kwargs)
+
+
+class TrackedHTTPConnection(TrackedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TrackedHTTPSConnection(TrackedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TrackedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TrackedHTTPConnection
+
+
+class TrackedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TrackedHTTPSConnection
+
+
+def track_connection(connection):
+    with active_connections_lock:
+        active_connections[threading.get_ident()] = connection
+
+
+def abort_connection(thread_id):
+    # shutting the socket down wakes up the thread that's waiting on it (which then
+    # gets a ConnectionError)
+    with active_connections_lock:
+        connection = active_connections.get(thread_id)
+
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def create_retry():
+    # only retry requests that are safe to send again: connections that failed before the
+    # request reached the server, and GET requests that got a temporary server error. A
+    # POST that reached the server is never retried, since it could generate (and bill) twice.
+    return Retry(
+        total=3,
+        connect=2,
+        read=0,
+        status=2,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False,
+    )
+
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=create_retry())
+    adapter.poolmanager.pool_classes_by_scheme = {"http": TrackedHTTPConnectionPool, "https": TrackedHTTPSConnectionPool}
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session_stats(session):
+    num_requests = 0
+    num_connections = 0
+
+    for adapter in session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+
+    return {
+        "requests": num_requests,
+        "connections": num_connections,
+        "reuse_rate": (num_requests - num_connections) / num_requests if num_requests else 0,
+    }
+
+
+# public methods
+def get_session(name):
+    """Get the shared session for a backend (creating it the first time it's needed), so connections are kept alive between requests"""
+    with sessions_lock:
+        session = sessions.get(name)
+        if session is None:
+            session = create_session()
+            sessions[name] = session
+        return session
+
+
+@contextlib.contextmanager
+def abort_on_cancel(cancel_token):
+    """While in this block, cancelling the token closes the connection this thread is sending a request on, so a request
+    that's still waiting for its response stops right away (with a ConnectionError) instead of when it times out"""
+    if cancel_token is None:
+        yield
+        return
+
+    callback = cancel_token.on_cancel(functools.partial(abort_connection, threading.get_ident()))
+    try:
+        yield
+    finally:
+        cancel_token.remove_callback(callback)
+        with active_connections_lock:
+            active_connections.pop(threading.get_ident(), None)
+
+
+def get_stats():
+    """Get the number of requests and new connections for each backend's session, and how often connections were reused"""
+    with sessions_lock:
+        return {name: get_session_stats(session) for name, session in sessions.items()}
+
+
+def get_stats_summary():
+    summary = []
+    for name, stats in get_stats().items():
+        summary.append(f"{name}: {stats['requests']} requests, {stats['connections']} connections ({round(stats['reuse_rate'] * 100)}% reused)")
+    return "\n".join(summary)
+
+
+def close_sessions():
+    with sessions_lock:
+        for name, session in sessions.items():
+            stats = get_session_stats(session)
+            print(f"AI Render: closing {name} connections ({stats['requests']} requests, {stats['connections']} connections)")
+            session.close()
+        sessions.clear()
+
+
+def register():
+    pass
+
+
+def unregister():
+    close_sessions()
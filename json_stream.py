@@ -0,0 +1,362 @@
+import base64
+import io
+import json
+import math
+import os
+import re
+
+
+# raw bytes read from a file at a time. This is a multiple of 3, so each chunk
+# base64 encodes on its own (without padding), and the chunks can just be joined
+ENCODE_CHUNK_SIZE = 3 * 16 * 1024
+
+# bytes read from a response at a time
+DECODE_CHUNK_SIZE = 64 * 1024
+
+PLACEHOLDER = "__ai_render_base64_file_{}__"
+PLACEHOLDER_REGEX = re.compile(r'"__ai_render_base64_file_(\d+)__"')
+
+STRING_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class Base64File:
+    """A file that will be streamed into a JsonBody as a base64 encoded string (with an optional prefix, like a data url)"""
+
+    def __init__(self, file, prefix=""):
+        self.file = file
+        self.prefix = prefix.encode()
+        self.start = file.tell()
+        self.size = file.seek(0, io.SEEK_END) - self.start
+        file.seek(self.start)
+
+    def get_encoded_length(self):
+        return len(self.prefix) + 4 * math.ceil(self.size / 3)
+
+    def iter_encoded_chunks(self):
+        self.file.seek(self.start)
+        yield self.prefix
+        while True:
+            chunk = self.file.read(ENCODE_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield base64.b64encode(chunk)
+
+    def close(self):
+        self.file.close()
+
+
+class Base64Data:
+    """Data that's already been base64 encoded (e.g. a cached image), which is streamed into a JsonBody as it is"""
+
+    def __init__(self, encoded, prefix="", content_hash=None):
+        self.encoded = encoded
+        self.prefix = prefix.encode()
+        self.content_hash = content_hash
+
+    def get_encoded_length(self):
+        return len(self.prefix) + len(self.encoded)
+
+    def iter_encoded_chunks(self):
+        yield self.prefix
+        yield self.encoded
+
+
+class JsonBody:
+    """A JSON request body that base64 encodes its files while it's being sent, so the whole encoded body is never held in memory"""
+
+    def __init__(self, data, cancel_token=None):
+        self.cancel_token = cancel_token
+        self.files = []
+        text = json.dumps(data, default=self._add_file)
+
+        # split the JSON text around the placeholders for the files
+        self.parts = []
+        for i, part in enumerate(PLACEHOLDER_REGEX.split(text)):
+            if i % 2 == 0:
+                self.parts.append(part.encode())
+            else:
+                self.parts.append(self.files[int(part)])
+
+        self.length = sum(len(part) if isinstance(part, bytes) else part.get_encoded_length() + 2 for part in self.parts)
+        self.seek(0)
+
+    def _add_file(self, obj):
+        if isinstance(obj, (Base64File, Base64Data)):
+            self.files.append(obj)
+            return PLACEHOLDER.format(len(self.files) - 1)
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    def _iter_chunks(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield b'"'
+                yield from part.iter_encoded_chunks()
+                yield b'"'
+
+    def __len__(self):
+        return self.length
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # only rewinding is supported (which is what's needed to retry a request)
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("JsonBody can only be rewound to the start")
+
+        self.chunks = self._iter_chunks()
+        self.chunk = b""
+        self.chunk_offset = 0
+        self.position = 0
+        return 0
+
+    def read(self, size=-1):
+        # stop sending the body if the request has been cancelled
+        if self.cancel_token:
+            self.cancel_token.raise_if_cancelled()
+
+        output = []
+        remaining = size
+
+        while size < 0 or remaining > 0:
+            if self.chunk_offset >= len(self.chunk):
+                self.chunk = next(self.chunks, None)
+                self.chunk_offset = 0
+                if self.chunk is None:
+                    self.chunk = b""
+                    break
+
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.chunk_offset + remaining)
+            output.append(self.chunk[self.chunk_offset:end])
+            remaining -= end - self.chunk_offset
+            self.chunk_offset = end
+
+        data = b"".join(output)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        for file in self.files:
+            file.close()
+
+
+class JsonReader:
+    """A minimal pull parser for reading a JSON response as it streams in"""
+
+    def __init__(self, chunks, cancel_token=None):
+        self.chunks = iter(chunks)
+        self.cancel_token = cancel_token
+        self.buffer = ""
+        self.index = 0
+
+    def fill(self):
+        # stop reading the response if the request has been cancelled
+        if self.cancel_token:
+            self.cancel_token.raise_if_cancelled()
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+
+        # NOTE: latin-1 maps each byte to one character, so multi-byte characters in
+        # other values can't be confused with the JSON syntax or the base64 text
+        self.buffer = self.buffer[self.index:] + chunk.decode('latin-1')
+        self.index = 0
+        return True
+
+    def peek_raw(self):
+        while self.index >= len(self.buffer):
+            if not self.fill():
+                return None
+        return self.buffer[self.index]
+
+    def peek(self):
+        while True:
+            char = self.peek_raw()
+            if char is None or char not in " \t\r\n":
+                return char
+            self.index += 1
+
+    def take(self):
+        char = self.peek()
+        if char is not None:
+            self.index += 1
+        return char
+
+    def iter_string(self):
+        """Yield the contents of a string (after its opening quote has been taken) in chunks"""
+        while True:
+            quote_index = self.buffer.find('"', self.index)
+            escape_index = self.buffer.find('\\', self.index)
+
+            if escape_index != -1 and (quote_index == -1 or escape_index < quote_index):
+                yield self.buffer[self.index:escape_index]
+                self.index = escape_index + 1
+                if self.peek_raw() is None:
+                    raise ValueError("Unterminated string in JSON response")
+                escaped = self.buffer[self.index]
+                self.index += 1
+                if escaped == 'u':
+                    while len(self.buffer) - self.index < 4:
+                        if not self.fill():
+                            raise ValueError("Unterminated string in JSON response")
+                    yield chr(int(self.buffer[self.index:self.index + 4], 16))
+                    self.index += 4
+                else:
+                    yield STRING_ESCAPES.get(escaped, escaped)
+            elif quote_index != -1:
+                yield self.buffer[self.index:quote_index]
+                self.index = quote_index + 1
+                return
+            else:
+                yield self.buffer[self.index:]
+                self.index = len(self.buffer)
+                if not self.fill():
+                    raise ValueError("Unterminated string in JSON response")
+
+    def read_string(self):
+        return "".join(self.iter_string())
+
+    def skip_container(self, depth=1):
+        while depth:
+            char = self.take()
+            if char is None:
+                raise ValueError("Unexpected end of JSON response")
+            elif char == '"':
+                for _ in self.iter_string():
+                    pass
+            elif char in "{[":
+                depth += 1
+            elif char in "}]":
+                depth -= 1
+
+    def skip_value(self):
+        char = self.take()
+        if char == '"':
+            for _ in self.iter_string():
+                pass
+        elif char in ("{", "["):
+            self.skip_container()
+        elif char is None:
+            raise ValueError("Unexpected end of JSON response")
+        else:
+            # a number, true, false or null
+            while self.peek_raw() not in (None, ",", "}", "]", " ", "\t", "\r", "\n"):
+                self.index += 1
+
+    def iter_image_strings(self, keys):
+        """Yield an iterator for each image in the response (the strings in an "images" list, or an "image" string). Each one has to be read before moving on to the next"""
+        if self.take() != "{":
+            raise ValueError("JSON response is not an object")
+
+        while True:
+            char = self.take()
+            if char == "}" or char is None:
+                return
+            elif char == ",":
+                continue
+            elif char != '"':
+                raise ValueError("Invalid key in JSON response")
+
+            key = self.read_string()
+            if self.take() != ":":
+                raise ValueError("Invalid JSON response")
+
+            if key in keys and self.peek() == "[":
+                self.take()
+                while True:
+                    char = self.take()
+                    if char == "]":
+                        break
+                    elif char == ",":
+                        continue
+                    elif char == '"':
+                        yield self.iter_string()
+                    elif char is None:
+                        raise ValueError("Unexpected end of JSON response")
+                    else:
+                        self.index -= 1
+                        self.skip_value()
+            elif key in keys and self.peek() == '"':
+                self.take()
+                yield self.iter_string()
+            else:
+                self.skip_value()
+
+
+def decode_base64_to_file(string_chunks, file):
+    pending = ""
+    is_prefix_removed = False
+
+    for chunk in string_chunks:
+        pending += chunk
+
+        # remove a data url prefix (e.g. "data:image/png;base64,") if there is one
+        if not is_prefix_removed:
+            if pending.startswith("data:"):
+                comma_index = pending.find(",")
+                if comma_index == -1:
+                    continue
+                pending = pending[comma_index + 1:]
+            elif len(pending) < 5 and "data:".startswith(pending):
+                continue
+            is_prefix_removed = True
+
+        # decode everything we can (base64 decodes in groups of 4 characters)
+        usable_length = len(pending) - len(pending) % 4
+        if usable_length:
+            file.write(base64.b64decode(pending[:usable_length]))
+            pending = pending[usable_length:]
+
+    if pending:
+        file.write(base64.b64decode(pending + "=" * (-len(pending) % 4)))
+
+
+# public methods
+def close_files(data):
+    """Close any Base64Files in a params dict that won't be sent after all"""
+    if isinstance(data, Base64File):
+        data.close()
+    elif isinstance(data, dict):
+        for value in data.values():
+            close_files(value)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            close_files(value)
+
+
+def save_images_from_response(response, create_output_file, max_images=1, keys=("images", "image"), cancel_token=None):
+    """Decode base64 images in a streamed JSON response straight into files (created by create_output_file(index)), and return the files.
+
+    Raises cancellation.Cancelled if the cancel token is cancelled while the response is being read"""
+    output_files = []
+    try:
+        reader = JsonReader(response.iter_content(chunk_size=DECODE_CHUNK_SIZE), cancel_token)
+        for image_string in reader.iter_image_strings(keys):
+            output_file = create_output_file(len(output_files))
+
+            # decode into a partial file, so a failed download never leaves half an image behind
+            partial_file = output_file + ".partial"
+            try:
+                with open(partial_file, 'wb') as file:
+                    decode_base64_to_file(image_string, file)
+                os.replace(partial_file, output_file)
+            except:
+                if os.path.exists(partial_file):
+                    os.remove(partial_file)
+                raise
+            output_files.append(output_file)
+
+            if len(output_files) >= max_images:
+                break
+
+        return output_files
+    finally:
+        response.close()
+
+
+def save_image_from_response(response, output_file, keys=("images", "image"), cancel_token=None):
+    """Decode the first base64 image in a streamed JSON response straight into a file. Returns False if the response has no image"""
+    return len(save_images_from_response(response, lambda index: output_file, 1, keys, cancel_token)) > 0
@@ -0,0 +1,184 @@
+import concurrent.futures
+import math
+import os
+import threading
+import time
+import numpy as np
+from . import (
+    operators,
+    pixel_utils,
+    utils,
+)
+
+
+# upscale images on this computer, on the CPU, for backends that can't upscale (or when
+# we'd rather not pay for another round trip). The image is resized with a Lanczos
+# filter, with each resized pixel clamped to the range of the source pixels nearest to
+# it, so edges stay sharp without the light and dark halos Lanczos otherwise leaves
+# around them.
+#
+# The resize is separable: each axis is a few vectorized taps (one per source pixel the
+# filter reaches). The output is split into bands of rows, which are resized on a small
+# pool of threads (NumPy lets go of the GIL while it works, so they run in parallel).
+#
+# Everything here works on pixels that have already been read (which has to happen in
+# the main thread), so the upscale itself can run on a worker thread.
+
+LANCZOS_LOBES = 3
+
+# how many output rows each thread works on at a time
+BAND_HEIGHT = 128
+
+# the size of the image used to measure the throughput
+BENCHMARK_SIZE = 512
+BENCHMARK_FACTOR = 2
+
+# private
+max_threads = min(8, os.cpu_count() or 1)
+executor = None
+executor_lock = threading.Lock()
+last_throughput = None
+
+
+def get_executor():
+    # the upscaler has its own threads, since it already runs on one of the worker pool's
+    # threads (and waiting on the same pool could leave it waiting forever)
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="ai-render-upscale")
+        return executor
+
+
+def lanczos(distance, lobes=LANCZOS_LOBES):
+    distance = np.abs(distance)
+    return np.where(distance < lobes, np.sinc(distance) * np.sinc(distance / lobes), 0)
+
+
+def get_taps(size, new_size, lobes=LANCZOS_LOBES):
+    """Get the source pixels that each resized pixel is made from, and how much each one counts, as (new_size, taps)
+    arrays. When upscaling, also get the two source pixels nearest each resized pixel, as (new_size, 2), for clamping"""
+    scale = new_size / size
+
+    # when making the image smaller, stretch the filter so it averages the pixels it covers
+    filter_scale = min(1, scale)
+    support = lobes / filter_scale
+
+    centers = (np.arange(new_size, dtype=np.float64) + 0.5) / scale - 0.5
+    first = np.floor(centers - support).astype(np.int64) + 1
+    indices = first[:, np.newaxis] + np.arange(2 * math.ceil(support) + 1)
+
+    weights = lanczos((indices - centers[:, np.newaxis]) * filter_scale, lobes)
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    # past the edges, reuse the edge pixels
+    indices = np.clip(indices, 0, size - 1)
+
+    nearest = None
+    if scale > 1:
+        below = np.floor(centers).astype(np.int64)
+        nearest = np.clip(np.stack([below, below + 1], axis=1), 0, size - 1)
+
+    return indices, weights.astype(np.float32), nearest
+
+
+def resample_rows(pixels, indices, weights, nearest):
+    # resize along the first axis, adding up the weighted taps
+    result = np.zeros((indices.shape[0],) + pixels.shape[1:], dtype=np.float32)
+    for tap in range(indices.shape[1]):
+        tap_pixels = pixels[indices[:, tap]]
+        tap_pixels *= weights[:, tap, np.newaxis, np.newaxis]
+        result += tap_pixels
+
+    # keep each pixel within the range of its nearest source pixels (which is what
+    # stops the ringing along edges)
+    if nearest is not None:
+        first = pixels[nearest[:, 0]]
+        second = pixels[nearest[:, 1]]
+        np.clip(result, np.minimum(first, second), np.maximum(first, second), out=result)
+
+    return result
+
+
+def upscale_band(pixels, output, rows, row_taps, column_taps, cancel_token=None):
+    if cancel_token is not None and cancel_token.is_cancelled():
+        return
+
+    row_indices, row_weights, row_nearest = row_taps
+    column_indices, column_weights, column_nearest = column_taps
+
+    band = resample_rows(pixels, row_indices[rows], row_weights[rows], None if row_nearest is None else row_nearest[rows])
+    # (the columns are resized as rows, since gathering whole rows is much quicker)
+    band = resample_rows(np.ascontiguousarray(band.transpose(1, 0, 2)), column_indices, column_weights, column_nearest)
+    output[rows] = band.transpose(1, 0, 2)
+
+
+# public methods
+def resize(pixels, width, height, cancel_token=None):
+    """Resize (height, width, channels) pixels to width x height with the edge-aware Lanczos filter, in bands of rows
+    on the upscaler's threads. Returns None if the request was cancelled"""
+    pixels = pixels.astype(np.float32, copy=False)
+    row_taps = get_taps(pixels.shape[0], height)
+    column_taps = get_taps(pixels.shape[1], width)
+
+    output = np.empty((height, width, pixels.shape[2]), dtype=np.float32)
+    futures = [
+        get_executor().submit(upscale_band, pixels, output, slice(start, min(start + BAND_HEIGHT, height)), row_taps, column_taps, cancel_token)
+        for start in range(0, height, BAND_HEIGHT)
+    ]
+    for future in futures:
+        future.result()
+
+    if cancel_token is not None and cancel_token.is_cancelled():
+        return None
+    return output
+
+
+def upscale(pixels, width, height, filename_prefix, cancel_token=None):
+    """Upscale pixels (as read by pixel_utils.read_image_file) to width x height, and save them as a PNG in a temp file.
+    Returns the file's path, or False if the upscale failed or was cancelled"""
+    # NOTE: This runs on a worker thread, so it must not touch any bpy data.
+    global last_throughput
+
+    try:
+        start_time = time.perf_counter()
+        upscaled = resize(pixels, width, height, cancel_token)
+        if upscaled is None:
+            return False
+
+        output_file = utils.create_temp_file(filename_prefix + "-", suffix=".png")
+        with open(output_file, 'wb') as file:
+            file.write(pixel_utils.encode_png(pixel_utils.to_uint8(upscaled)))
+
+        last_throughput = width * height / 1_000_000 / max(time.perf_counter() - start_time, 1e-6)
+        print(f"AI Render: upscaled locally to {width} x {height} ({last_throughput:.1f} megapixels per second)")
+        return output_file
+    except Exception as e:
+        print(e)
+        return operators.handle_error(None, "Couldn't upscale the image locally", "local_upscale")
+
+
+def benchmark(size=BENCHMARK_SIZE, factor=BENCHMARK_FACTOR):
+    """Measure how many megapixels per second the upscaler makes (not counting saving the image), by upscaling a noisy
+    test image"""
+    global last_throughput
+
+    pixels = np.random.default_rng(0).random((size, size, 4), dtype=np.float32)
+    new_size = size * factor
+
+    start_time = time.perf_counter()
+    resize(pixels, new_size, new_size)
+    last_throughput = new_size * new_size / 1_000_000 / max(time.perf_counter() - start_time, 1e-6)
+    return last_throughput
+
+
+def register():
+    pass
+
+
+def unregister():
+    global executor
+    with executor_lock:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = None
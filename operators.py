@@ -1,23 +1,53 @@
 import bpy
+import contextlib
+import copy
 import functools
-import math
+import os
 import random
-import re
+import threading
 import time
+import traceback
 
 from . import (
     analytics,
+    animation_journal,
+    animation_manifest,
+    cancellation,
     config,
+    encoded_image,
+    frame_claims,
+    json_stream,
+    local_upscaler,
+    output_images,
+    pixel_utils,
     progress_bar,
+    prompt_timeline,
+    render_passes,
+    result_cache,
     task_queue,
+    temp_files,
+    tiled_generation,
     utils,
+    worker_pool,
 )
 
-from .sd_backends import automatic1111_api
+from .sd_backends import (
+    automatic1111_api,
+    automatic1111_progress,
+    automatic1111_server_pool,
+    stablehorde_jobs,
+)
 
 
 example_dimensions_tuple_list = utils.generate_example_dimensions_tuple_list()
 
+# how long to wait before retrying a failed animation frame (doubled with each retry)
+FRAME_RETRY_DELAY = 5
+FRAME_RETRY_MAX_DELAY = 120
+
+# private
+error_capture = threading.local() # the errors handled on each thread, while capturing them (see capture_errors)
+
 
 def enable_air(scene):
     # register the task queue (this also needs to be done post-load,
@@ -26,7 +56,9 @@ def enable_air(scene):
 
     # ensure that we have our AI Render workspace with an image viewer,
     # so the new rendered image will be shown after the render is complete
-    ensure_air_workspace()
+    # (there are no windows in background mode, so there's nothing to show it in)
+    if not bpy.app.background:
+        ensure_air_workspace()
 
     # clear any possible past errors in the file (this would happen if ai render
     # was enabled in a file that we just opened, and it had been saved with
@@ -77,16 +109,42 @@ def set_image_dimensions(context, width, height):
 
 def handle_error(scene, msg, error_key = ''):
     """Show an error popup, and set the error message to be displayed in the ui"""
+
+    # while the errors are being captured, leave it to the caller to report them
+    captured_errors = getattr(error_capture, "errors", None)
+    if captured_errors is not None:
+        captured_errors.append((scene, msg, error_key))
+        return False
+
+    # the backends can hit errors while running on a worker thread, so hand those
+    # over to the main thread, which is the only place we can touch the ui
+    if not worker_pool.is_main_thread():
+        task_queue.add(functools.partial(handle_error, scene, msg, error_key), task_queue.PRIORITY_UI)
+        return False
+
     print("AI Render Error:", msg)
     if scene:
         scene.air_props.error_message = msg
     else:
         bpy.context.scene.air_props.error_message = msg
-    task_queue.add(functools.partial(bpy.ops.ai_render.show_error_popup, 'INVOKE_DEFAULT', error_message=msg, error_key=error_key))
+    if not bpy.app.background:
+        task_queue.add(functools.partial(bpy.ops.ai_render.show_error_popup, 'INVOKE_DEFAULT', error_message=msg, error_key=error_key), task_queue.PRIORITY_UI)
     analytics.track_event('ai_render_error', value=error_key)
     return False
 
 
+@contextlib.contextmanager
+def capture_errors():
+    """Collect the errors handled on this thread while in this block, as (scene, msg, error_key) tuples, instead of
+    showing them"""
+    errors = []
+    error_capture.errors = errors
+    try:
+        yield errors
+    finally:
+        error_capture.errors = None
+
+
 def set_silent_error(scene, msg, error_key = ''):
     """Set the error message to be displayed in the ui, but don't show a popup"""
     print("AI Render Error:", msg)
@@ -120,6 +178,9 @@ def ensure_animated_prompts_text():
         text.write("30: Stable Diffusion Prompt starting at frame 30\n")
         text.write("# etc...\n")
         text.write("\n")
+        text.write("# To blend from one prompt into the next, give it a range of frames, e.g.\n")
+        text.write("# 60-90: Stable Diffusion Prompt blending in from frame 60 to 90\n")
+        text.write("\n")
         text.write("# You can also include negative prompts\n")
         text.write(f"# See more info at {config.HELP_WITH_NEGATIVE_PROMPTS_URL}\n")
         text.write("Negative:\n")
@@ -146,7 +207,7 @@ def ensure_animated_prompts_text_editor_in_workspace(context):
     script_area.spaces[0].text = utils.get_animated_prompt_text_data_block()
 
 
-def render_frame(context, current_frame, prompts):
+def render_frame(context, current_frame, prompts, callback=None, cancel_token=None):
     """Render the current frame as part of an animation"""
     # set the frame
     context.scene.frame_set(current_frame)
@@ -155,7 +216,7 @@ def render_frame(context, current_frame, prompts):
     bpy.ops.render.render()
 
     # post to the api
-    return sd_generate(context.scene, prompts)
+    return sd_generate(context.scene, prompts, callback=callback, cancel_token=cancel_token)
 
 
 def save_render_to_file(scene, filename_prefix):
@@ -183,6 +244,27 @@ def save_render_to_file(scene, filename_prefix):
 
     return temp_file
 
+
+def encode_render(scene, filename_prefix):
+    """Encode the rendered image once (in the active backend's format), and keep it in memory"""
+    temp_file = save_render_to_file(scene, filename_prefix)
+    if not temp_file:
+        return False
+
+    try:
+        render_image = encoded_image.from_file(temp_file, utils.get_active_backend().get_image_format(), filename_prefix)
+    except:
+        return handle_error(scene, "Couldn't read the rendered image", "save_render")
+
+    # we only needed the file to get the encoded bytes, so clean it up right away
+    try:
+        os.remove(temp_file)
+    except OSError:
+        pass
+
+    return render_image
+
+
 def save_image_to_temp_file(scene, image_name):
     try:
         temp_file = utils.create_temp_file(image_name + "-")
@@ -197,14 +279,25 @@ def save_image_to_temp_file(scene, image_name):
     return temp_file
     
 
-def save_before_image(scene, filename_prefix):
-    ext = utils.get_extension_from_file_format(scene.render.image_settings.file_format)
+def save_before_image(scene, filename_prefix, render_image=None):
+    image_settings = scene.render.image_settings
+    ext = utils.get_extension_from_file_format(image_settings.file_format)
     if ext:
         ext = f".{ext}"
     filename = f"{filename_prefix}{ext}"
     full_path_and_filename = utils.get_absolute_path_for_output_file(scene.air_props.autosave_image_path, filename)
     try:
-        bpy.data.images['Render Result'].save_render(bpy.path.abspath(full_path_and_filename))
+        # if the render has already been encoded with the same settings as the scene's output, write
+        # those bytes out directly, instead of encoding the whole render again
+        if (
+            render_image
+            and render_image.file_format == image_settings.file_format
+            and image_settings.color_mode == 'RGBA'
+            and image_settings.color_depth == '8'
+        ):
+            render_image.save(bpy.path.abspath(full_path_and_filename))
+        else:
+            bpy.data.images['Render Result'].save_render(bpy.path.abspath(full_path_and_filename))
     except:
         return handle_error(scene, f"Couldn't save 'before' image to {bpy.path.abspath(full_path_and_filename)}", "save_image")
 
@@ -219,9 +312,13 @@ def save_after_image(scene, filename_prefix, img_file):
         return handle_error(scene, f"Couldn't save 'after' image to {bpy.path.abspath(full_path_and_filename)}", "save_image")
 
 
-def save_animation_image(scene, filename_prefix, img_file):
-    filename = f"{filename_prefix}{str(scene.frame_current).zfill(4)}.{utils.get_active_backend().get_image_format().lower()}"
-    full_path_and_filename = utils.get_absolute_path_for_output_file(scene.air_props.animation_output_path, filename)
+def get_animation_image_path(scene, filename_prefix, frame):
+    filename = f"{filename_prefix}{str(frame).zfill(4)}.{utils.get_active_backend().get_image_format().lower()}"
+    return utils.get_absolute_path_for_output_file(scene.air_props.animation_output_path, filename)
+
+
+def save_animation_image(scene, filename_prefix, img_file, frame):
+    full_path_and_filename = get_animation_image_path(scene, filename_prefix, frame)
     try:
         utils.copy_file(img_file, full_path_and_filename)
         return full_path_and_filename
@@ -229,6 +326,61 @@ def save_animation_image(scene, filename_prefix, img_file):
         return handle_error(scene, f"Couldn't save animation image to {bpy.path.abspath(full_path_and_filename)}", "save_image")
 
 
+def get_animation_output_dir(scene):
+    return os.path.abspath(bpy.path.abspath(scene.air_props.animation_output_path))
+
+
+def get_animation_frames(scene, frames=None):
+    """Get the frames to render in an animation (when sharing frames with other instances, in the order to try claiming them)"""
+    props = scene.air_props
+    if frames is None:
+        frames = range(scene.frame_start, scene.frame_end + 1, scene.frame_step)
+
+    if not props.animation_use_sharding:
+        return list(frames)
+    return frame_claims.get_frames_to_render(frames, props.animation_shard_index - 1, props.animation_shard_count, props.animation_shard_frames)
+
+
+def validate_animation_frames(scene):
+    """Make sure the explicit list of frames to render (if there is one) can be parsed"""
+    props = scene.air_props
+    if props.animation_use_sharding:
+        try:
+            frame_claims.parse_frame_list(props.animation_shard_frames)
+        except ValueError as e:
+            return handle_error(scene, f"Couldn't read the list of frames to render: {e}", "animation_frames")
+    return True
+
+
+def create_frame_claims(scene):
+    """Start keeping track of the frames this instance claims, if we're sharing frames with other instances"""
+    props = scene.air_props
+    if not props.animation_use_sharding:
+        return None
+    return frame_claims.FrameClaims(get_animation_output_dir(scene), props.animation_claim_timeout)
+
+
+def get_frame_retry_delay(attempt):
+    """Get how long to wait before retrying a failed animation frame (doubling with each attempt)"""
+    return min(FRAME_RETRY_MAX_DELAY, FRAME_RETRY_DELAY * 2 ** (attempt - 1))
+
+
+def get_animation_pipeline_depth(scene):
+    """Get how many animation frames to have in progress at once"""
+    pipeline_depth = scene.air_props.animation_pipeline_depth
+
+    # when spreading frames across a pool of Automatic1111 servers, keep every server busy
+    if utils.sd_backend() == "automatic1111" and utils.is_local_sd_server_pool_enabled():
+        pipeline_depth = max(pipeline_depth, automatic1111_server_pool.get_capacity(utils.local_sd_server_pool()))
+
+    # Stable Horde jobs spend most of their time waiting in a queue, so send lots of frames
+    # at once, and their waiting overlaps instead of adding up
+    elif utils.sd_backend() == "stablehorde":
+        pipeline_depth = max(pipeline_depth, stablehorde_jobs.MAX_JOBS_IN_FLIGHT)
+
+    return pipeline_depth
+
+
 def do_pre_render_setup(scene):
     # Lock the user interface when rendering, so that we can change
     # compositor nodes in the render_init handler without causing a crash!
@@ -241,20 +393,26 @@ def do_pre_render_setup(scene):
     # mute the legacy compositor node group, if it exists
     mute_legacy_compositor_node_group(scene)
 
+    # make sure the render pass that ControlNet or the inpaint mask uses (if any) will be there after the render
+    render_passes.setup(scene)
+
 
 def do_pre_api_setup(scene):
     # switch the workspace to our AI Render workspace, so we can show the output when it's done
     activate_air_workspace(scene)
 
 
-def validate_params(scene, prompt=None):
+def validate_params(scene, prompt=None, can_tile=False):
     if utils.get_dream_studio_api_key().strip() == "" and utils.sd_backend() == "dreamstudio":
         return handle_error(scene, "You must enter an API Key to render with DreamStudio", "api_key")
     if not utils.are_dimensions_valid(scene):
         return handle_error(scene, "Please set width and height to valid values", "invalid_dimensions")
     if utils.are_dimensions_too_small(scene):
         return handle_error(scene, "Image dimensions are too small. Please increase width and/or height", "dimensions_too_small")
-    if utils.are_dimensions_too_large(scene):
+    if utils.should_generate_in_tiles(scene):
+        if not can_tile:
+            return handle_error(scene, "Image dimensions are too large. Only images generated from the render (or from the last image) can be generated in tiles, so please decrease width and/or height", "dimensions_too_large")
+    elif utils.are_dimensions_too_large(scene):
         return handle_error(scene, "Image dimensions are too large. Please decrease width and/or height", "dimensions_too_large")
     if prompt == "":
         return handle_error(scene, "Please enter a prompt for Stable Diffusion", "prompt")
@@ -286,97 +444,69 @@ def get_full_prompt(scene, prompt=None):
     return prompt
 
 
-def get_prompt_at_frame(animated_prompts, frame):
-    for line in reversed(animated_prompts):
-        if line['start_frame'] <= frame:
-            return line['prompt']
-    return ""
-
-
 def validate_and_process_animated_prompt_text(scene):
+    """Get the compiled timeline of the animated prompts (it's only compiled again when the text or preset style changes)"""
     text_data = utils.get_animated_prompt_text_data_block()
     if text_data is None:
         return handle_error(scene, "Animated prompt text does not exist. Please edit animated prompts.", "animated_prompt_text_data_block")
 
-    lines = text_data.as_string().splitlines()
-    lines = [line.strip() for line in lines]
-
-    # find "Negative:" in lines, if it exists
-    negative_index = -1
-    for i, line in enumerate(lines):
-        if line.lower() == "negative:":
-            negative_index = i
-            break
-
-    if negative_index > -1:
-        positive_lines = lines[:negative_index]
-        negative_lines = lines[negative_index+1:]
-    else:
-        positive_lines = lines
-        negative_lines = []
-
-    def parse_lines(lines, is_positive=True):
-        r = re.compile('^(\d+):(.*)')
-        lines = list(filter(r.match, lines))
-
-        processed_lines = []
-        for line in lines:
-            m = r.match(line)
-            if m:
-                start_frame = int(m.group(1))
-                prompt = m.group(2).strip()
-                processed_lines.append({
-                    'start_frame': start_frame,
-                    'prompt': get_full_prompt(scene, prompt=prompt) if is_positive else prompt,
-                })
-
-        if is_positive:
-            processed_lines = list(filter(lambda x: x['prompt'] != "", processed_lines))
-
-        if len(processed_lines) == 0 and is_positive:
-            return handle_error(scene, f"Animated Prompt text is empty or invalid. [Get help with animated prompts]({config.HELP_WITH_ANIMATED_PROMPTS_URL})", "animated_prompt_text")
-
-        if len(processed_lines) > 0:
-            processed_lines.sort(key=lambda x: x['start_frame'])
-            processed_lines[0]['start_frame'] = 1 # ensure the first frame is 1
-
-        return processed_lines
+    props = scene.air_props
+    timeline = prompt_timeline.get(
+        text_data.as_string(),
+        format_prompt=functools.partial(get_full_prompt, scene),
+        format_key=(props.use_preset, props.preset_style),
+        blend_frames=props.animated_prompts_blend_frames,
+    )
 
-    positive_lines = parse_lines(positive_lines)
-    negative_lines = parse_lines(negative_lines, is_positive=False)
+    if timeline.is_empty():
+        return handle_error(scene, f"Animated Prompt text is empty or invalid. [Get help with animated prompts]({config.HELP_WITH_ANIMATED_PROMPTS_URL})", "animated_prompt_text")
 
-    return positive_lines, negative_lines
+    return timeline
 
 
 def validate_and_process_animated_prompt_text_for_single_frame(scene, frame):
-    positive_lines, negative_lines = validate_and_process_animated_prompt_text(scene)
-    if not positive_lines:
+    timeline = validate_and_process_animated_prompt_text(scene)
+    if not timeline:
         return None, None
     else:
-        return get_prompt_at_frame(positive_lines, frame), get_prompt_at_frame(negative_lines, frame)
+        prompts = timeline.get_prompts(frame)
+        return prompts["prompt"], prompts["negative_prompt"]
 
 
-def sd_generate(scene, prompts=None, use_last_sd_image=False, txt2img=False):
+def sd_generate(scene, prompts=None, use_last_sd_image=False, txt2img=False, callback=None, cancel_token=None):
     """Post to the API to generate a Stable Diffusion image and then process it"""
+    # NOTE: The API request runs on a worker thread, so this returns as soon as the request
+    # has been started. If it returns True, the callback (if given) will be called in the
+    # main thread with True or False, once the new image has been processed. The request
+    # can be stopped with the cancel token (a new one is used if none is given).
     props = scene.air_props
 
     # get the prompt if we haven't been given one
     if not prompts:
         if props.use_animated_prompts:
-            prompt, negative_prompt = validate_and_process_animated_prompt_text_for_single_frame(scene, scene.frame_current)
-            if not prompt:
+            timeline = validate_and_process_animated_prompt_text(scene)
+            if not timeline:
                 return False
+            prompts = timeline.get_prompts(scene.frame_current)
         else:
-            prompt = get_full_prompt(scene)
-            negative_prompt = props.negative_prompt_text.strip()
-    else:
-        prompt = prompts["prompt"]
-        negative_prompt = prompts["negative_prompt"]
+            prompts = {
+                "prompt": get_full_prompt(scene),
+                "negative_prompt": props.negative_prompt_text.strip(),
+            }
+
+    prompt = prompts["prompt"]
+    negative_prompt = prompts["negative_prompt"]
 
     # validate the parameters we will send
-    if not validate_params(scene, prompt):
+    if not validate_params(scene, prompt, can_tile=not txt2img):
         return False
 
+    # an image that's too large for the backend is generated in tiles (only from an image, since tiles generated from
+    # text would have nothing to tie them together)
+    is_tiled = not txt2img and utils.should_generate_in_tiles(scene)
+    if is_tiled and props.control_nets and utils.sd_backend() == "automatic1111":
+        return handle_error(scene, "ControlNet can't be used when generating in tiles. Please remove the ControlNet units, or decrease width and/or height", "tiled_generation")
+
     # generate a new seed, if we want a random one
     generate_new_random_seed(scene)
 
@@ -384,9 +514,9 @@ def sd_generate(scene, prompts=None, use_last_sd_image=False, txt2img=False):
     timestamp = int(time.time())
     before_output_filename_prefix = f"ai-render-{timestamp}-1-before"
     after_output_filename_prefix = f"ai-render-{timestamp}-2-after"
-    animation_output_filename_prefix = "ai-render-"
 
     img_file = None
+    render_image = None
 
     # if we want to use the last SD image, try loading it now
     if not txt2img:
@@ -400,11 +530,11 @@ def sd_generate(scene, prompts=None, use_last_sd_image=False, txt2img=False):
         else:
             # else, use the rendered image...
 
-            # save the rendered image and then read it back in
-            temp_input_file = save_render_to_file(scene, before_output_filename_prefix)
-            if not temp_input_file:
+            # encode the rendered image once, and share it with everything that needs it
+            render_image = encode_render(scene, before_output_filename_prefix)
+            if not render_image:
                 return False
-            img_file = open(temp_input_file, 'rb')
+            img_file = render_image.open()
 
             # autosave the before image, if we want that, and we're not rendering an animation
             if (
@@ -413,11 +543,29 @@ def sd_generate(scene, prompts=None, use_last_sd_image=False, txt2img=False):
                 and not props.is_rendering_animation
                 and not props.is_rendering_animation_manually
             ):
-                save_before_image(scene, before_output_filename_prefix)
+                save_before_image(scene, before_output_filename_prefix, render_image)
 
     # get the backend we're using
     sd_backend = utils.get_active_backend()
 
+    # split the image into tiles now, because reading its pixels has to happen in the main thread
+    tiles = None
+    tile_images = None
+    if is_tiled:
+        tiles = tiled_generation.get_tiles(utils.get_output_width(scene), utils.get_output_height(scene), sd_backend.max_image_size(), props.tiled_generation_overlap)
+        tile_images = tiled_generation.split_image(
+            scene,
+            props.last_generated_image_filename if use_last_sd_image else render_image,
+            utils.get_output_width(scene),
+            utils.get_output_height(scene),
+            tiles,
+            before_output_filename_prefix,
+        )
+        if not tile_images:
+            if img_file:
+                img_file.close()
+            return False
+
     # prepare data for the API request
     params = {
         "override_settings": {
@@ -440,54 +588,306 @@ def sd_generate(scene, prompts=None, use_last_sd_image=False, txt2img=False):
             "sd_model_checkpoint": props.sd_model,
         }
 
-    # send to whichever API we're using
-    start_time = time.time()
-    generated_image_file = sd_backend.generate(params, img_file, after_output_filename_prefix, props, txt2img)
+    # while blending between animated prompts, send them all with their weights (if the
+    # backend can't weight prompts, it just gets the prompt with the most weight)
+    if sd_backend.supports_prompt_weights():
+        for key in ["prompt_weights", "negative_prompt_weights"]:
+            if key in prompts:
+                params[key] = [[text, weight] for text, weight in prompts[key]]
+
+    # add the ControlNet units now, because saving their images has to happen in the main thread
+    if props.control_nets and utils.sd_backend() == "automatic1111":
+        if not automatic1111_api.map_controlnet_params(params, props, render_image):
+            return False
+
+    # generate several variations in one request, if we want them (but never for an animation frame)
+    batch_size = 1
+    if sd_backend.supports_batches() and not props.is_rendering_animation and not props.is_rendering_animation_manually and not is_tiled:
+        batch_size = props.batch_size
+    if batch_size > 1:
+        params["batch_size"] = batch_size
+
+    # a batch isn't upscaled automatically (the chosen variation can be upscaled afterwards)
+    # (backends that can't upscale are upscaled locally instead)
+    upscale_locally = utils.should_upscale_locally(props)
+    should_upscale = props.do_upscale_automatically and (upscale_locally or sd_backend.is_upscaler_model_list_loaded()) and batch_size == 1 and not is_tiled
+
+    # use the result cache, if it's enabled (there's no point with a random seed, since it would never match)
+    cache = None
+    if utils.is_result_cache_enabled() and not props.use_random_seed and batch_size == 1:
+        cache = {
+            "backend": utils.sd_backend(),
+            "path": utils.result_cache_path(),
+            "max_size": utils.result_cache_max_size(),
+            "file_format": sd_backend.get_image_format(),
+        }
+
+    # when rendering an animation, skip frames that have already been generated from exactly the same inputs
+    fingerprint = None
+    if props.is_rendering_animation_manually and props.animation_skip_unchanged_frames:
+        output_settings = {
+            "upscale_factor": props.upscale_factor if should_upscale else None,
+            "upscaler_model": props.upscaler_model if should_upscale and not upscale_locally else None,
+            "upscale_locally": upscale_locally if should_upscale else None,
+        }
+        fingerprint = animation_manifest.get_fingerprint(utils.sd_backend(), params, img_file, output_settings)
+        frame_file = get_animation_image_path(scene, "ai-render-", scene.frame_current)
+
+        if animation_manifest.is_frame_unchanged(frame_file, scene.frame_current, fingerprint):
+            print(f"AI Render: frame {scene.frame_current} hasn't changed, so it won't be generated again")
+            animation_journal.record_frame(frame_file, scene.frame_current, props.seed)
+            if img_file:
+                img_file.close()
+            json_stream.close_files(params)
+            if callback:
+                task_queue.add(functools.partial(callback, True), task_queue.PRIORITY_RESULT)
+            return True
+
+    # keep track of everything we'll need once the request is done (the scene can
+    # change while we're waiting, e.g. the frame during an animation)
+    job = {
+        "scene": scene,
+        "sd_backend": sd_backend,
+        "filename_prefix": after_output_filename_prefix,
+        "frame": scene.frame_current,
+        "is_animation_frame": props.is_rendering_animation_manually,
+        "should_autosave_after_image": utils.should_autosave_after_image(props),
+        "should_upscale": should_upscale,
+        "upscale_locally": should_upscale and upscale_locally,
+        "upscaled_size": get_upscaled_size(scene, sd_backend, upscale_locally),
+        "output_image_name": "AI Render Output",
+        "fingerprint": fingerprint,
+        "seed": props.seed,
+        "start_time": time.time(),
+        "callback": callback,
+        "cancel_token": cancellation.acquire(cancel_token),
+    }
+
+    # send the tiles all at once, and put them back together when they've all come back
+    if is_tiled:
+        if img_file:
+            img_file.close()
+        submit_tile_requests(job, params, tiles, tile_images, utils.get_props_snapshot(props), cache)
+        return True
+
+    # send to whichever API we're using (on a worker thread, so the ui stays responsive)
+    worker_pool.submit(
+        functools.partial(request_generated_images, sd_backend, params, img_file, after_output_filename_prefix, utils.get_props_snapshot(props), txt2img, job["should_upscale"] and not job["upscale_locally"], cache, job["cancel_token"]),
+        functools.partial(process_generated_images, job),
+    )
+
+    # return success
+    return True
+
+
+def submit_tile_requests(job, params, tiles, tile_images, props, cache=None):
+    """Send a request for each tile (on worker threads, so they run at the same time), and blend the tiles together once
+    they're all done"""
+    # the tiles get their own cancel token, so the first tile to fail can stop the rest of them
+    # (without cancelling anything else that shares the job's token, like an animation render)
+    tiles_cancel_token = cancellation.CancelToken()
+    cancel_tiles = job["cancel_token"].on_cancel(tiles_cancel_token.cancel)
+    tiled_request = tiled_generation.TiledRequest(len(tiles), functools.partial(process_generated_tiles, job, tiles, cancel_tiles), tiles_cancel_token)
+
+    for i, (tile, tile_image) in enumerate(zip(tiles, tile_images)):
+        # (the backend changes the params as it sends them, so each tile gets its own copy)
+        tile_params = copy.deepcopy(params)
+        tile_params["width"] = tile["width"]
+        tile_params["height"] = tile["height"]
+
+        worker_pool.submit(
+            functools.partial(request_generated_tile, job["sd_backend"], tile_params, tile_image.open(), f"{job['filename_prefix']}-tile-{i + 1}", props, cache, tiles_cancel_token),
+            functools.partial(tiled_request.handle_result, i),
+        )
+
+
+def request_generated_tile(sd_backend, params, img_file, filename_prefix, props, cache=None, cancel_token=None):
+    """Send the generate request for one tile. Returns (tile_file, errors), with the errors it hit (which aren't shown
+    here, since every tile could hit the same one)"""
+    # NOTE: This runs on a worker thread, so it must not touch any bpy data. (props is a snapshot)
+    with capture_errors() as errors:
+        try:
+            tile_file, _ = request_generated_images(sd_backend, params, img_file, filename_prefix, props, False, False, cache, cancel_token)
+        except Exception as e:
+            # (caught here, so it's reported along with the other tiles' errors, instead of on its own)
+            traceback.print_exc()
+            tile_file = handle_error(None, f"Something went wrong while talking to the Stable Diffusion server: {e}", "unexpected_error")
+    return tile_file, errors
+
+
+def process_generated_tiles(job, tiles, cancel_tiles, tile_files):
+    """Blend the generated tiles back into one image, and then process it like any other generated image"""
+    job["cancel_token"].remove_callback(cancel_tiles)
+
+    # if any tile failed (or the request was cancelled), there's no image to put together
+    if not all(tile_files) or is_cancelled(job["cancel_token"]):
+        process_generated_images(job, (False, None))
+        return
+
+    generated_image_file = tiled_generation.blend_tiles(job["scene"], tiles, tile_files, job["sd_backend"].get_image_format(), job["filename_prefix"])
+    process_generated_images(job, (generated_image_file, None))
+
+
+def request_generated_images(sd_backend, params, img_file, filename_prefix, props, txt2img=False, should_upscale=False, cache=None, cancel_token=None):
+    """Send the generate request (and the upscale request, if we want one) to the backend"""
+    # NOTE: This runs on a worker thread, so it must not touch any bpy data. (props is a snapshot)
+    generated_image_file = None
+
+    # if we've generated this exact image before, use the cached one instead of calling the backend
+    if cache:
+        cache_key = result_cache.get_key(cache["backend"], params, None if txt2img else img_file)
+        generated_image_file = result_cache.get(cache["path"], cache_key, cache["file_format"], filename_prefix)
+
+        if generated_image_file:
+            print("AI Render: using the cached image for this request")
+            if img_file:
+                img_file.close()
+            json_stream.close_files(params)
+
+    if not generated_image_file:
+        generated_image_file = sd_backend.generate(params, img_file, filename_prefix, props, txt2img, cancel_token=cancel_token)
+
+        # keep the new image in the cache, so it can be reused
+        if generated_image_file and cache:
+            result_cache.put(cache["path"], cache_key, cache["file_format"], generated_image_file, cache["max_size"])
+
+    # if we didn't get a successful image, stop here (an error will have been handled by the api function)
+    if not generated_image_file:
+        return False, None
+
+    # if the request was cancelled while the image was coming back, don't go on to upscale it
+    if is_cancelled(cancel_token):
+        return False, None
+
+    # if we want to automatically upscale, do it now
+    if should_upscale:
+        opened_image_file = open(generated_image_file, 'rb')
+        return generated_image_file, sd_backend.upscale(opened_image_file, filename_prefix + "-upscaled", props, cancel_token=cancel_token)
+
+    return generated_image_file, None
+
+
+def is_cancelled(cancel_token):
+    return cancel_token is not None and cancel_token.is_cancelled()
+
+
+def get_upscaled_size(scene, sd_backend, upscale_locally=False):
+    """Get the size to upscale to, within the local upscaler's limit or the backend's"""
+    max_upscaled_image_size = utils.max_local_upscaled_image_size if upscale_locally else sd_backend.max_upscaled_image_size()
+    return utils.sanitized_upscaled_width(max_upscaled_image_size, scene), utils.sanitized_upscaled_height(max_upscaled_image_size, scene)
+
+
+def submit_local_upscale(scene, image_file, upscaled_size, filename_prefix, callback, cancel_token=None):
+    """Read an image (which has to happen in the main thread) and upscale it locally on a worker thread, calling
+    callback with the upscaled image's path (or False) in the main thread"""
+    try:
+        pixels = pixel_utils.read_image_file(image_file)
+    except:
+        return handle_error(scene, "Couldn't load the image to upscale it", "local_upscale")
+
+    width, height = upscaled_size
+    worker_pool.submit(
+        functools.partial(local_upscaler.upscale, pixels, width, height, filename_prefix, cancel_token=cancel_token),
+        callback,
+    )
+    return True
+
+
+def process_locally_upscaled_image(job, generated_image_file, upscaled_image_file):
+    process_generated_images(job, (generated_image_file, upscaled_image_file))
+
+
+def process_generated_images(job, result):
+    """Save and load the images returned from the backend, and then call the job's callback"""
+    # if we're upscaling locally, do that before going on (each image is only upscaled once)
+    generated_image_file = result[0] if result else False
+    if job.get("upscale_locally") and generated_image_file and not is_cancelled(job["cancel_token"]):
+        job["upscale_locally"] = False
+        if submit_local_upscale(job["scene"], generated_image_file, job["upscaled_size"], job["filename_prefix"] + "-upscaled", functools.partial(process_locally_upscaled_image, job, generated_image_file), job["cancel_token"]):
+            return
+        result = (generated_image_file, False)
+
+    cancellation.release(job["cancel_token"])
+
+    # if the request was cancelled, drop whatever came back
+    if is_cancelled(job["cancel_token"]):
+        success = False
+    else:
+        success = load_generated_images(job, result)
+
+    if job["callback"]:
+        job["callback"](success)
+
+
+def load_generated_images(job, result):
+    scene = job["scene"]
+    props = scene.air_props
+    sd_backend = job["sd_backend"]
+    after_output_filename_prefix = job["filename_prefix"]
+    animation_output_filename_prefix = "ai-render-"
+    start_time = job["start_time"]
+
+    generated_image_file, upscaled_image_file = result or (False, None)
 
     # if we didn't get a successful image, stop here (an error will have been handled by the api function)
     if not generated_image_file:
         return False
- 
-    # autosave the after image, if we should
-    if utils.should_autosave_after_image(props):
-        generated_image_file = save_after_image(scene, after_output_filename_prefix, generated_image_file)
+
+    # a batch returns a list of images, which are kept as variations to choose from
+    if isinstance(generated_image_file, list):
+        variation_files = []
+        for i, variation_file in enumerate(generated_image_file):
+            if job["should_autosave_after_image"]:
+                variation_file = save_after_image(scene, f"{after_output_filename_prefix}-{i + 1}", variation_file)
+                if not variation_file:
+                    return False
+            variation_files.append(variation_file)
+
+        # use the first variation until another one is chosen
+        props.variation_files = "||||".join(variation_files)
+        temp_files.set_reference("variations", variation_files)
+        props.selected_variation = 0
+        generated_image_file = variation_files[0]
+    else:
+        props.variation_files = ""
+        temp_files.set_reference("variations", [])
+
+        # autosave the after image, if we should
+        if job["should_autosave_after_image"]:
+            generated_image_file = save_after_image(scene, after_output_filename_prefix, generated_image_file)
 
     # store this image filename as the last generated image
     props.last_generated_image_filename = generated_image_file
+    temp_files.set_reference("last_generated_image", generated_image_file)
 
-    # if we want to automatically upscale (and the backend supports it), do it now
-    if props.do_upscale_automatically and sd_backend.supports_upscaling() and sd_backend.is_upscaler_model_list_loaded():
+    # if we automatically upscaled, use the upscaled image from here on
+    if job["should_upscale"]:
         after_output_filename_prefix = after_output_filename_prefix + "-upscaled"
-
-        opened_image_file = open(generated_image_file, 'rb')
-        generated_image_file = sd_backend.upscale(opened_image_file, after_output_filename_prefix, props)
+        generated_image_file = upscaled_image_file
 
         # if the upscale failed, stop here (an error will have been handled by the api function)
         if not generated_image_file:
             return False
 
         # autosave the upscaled after image, if we should
-        if utils.should_autosave_after_image(props):
+        if job["should_autosave_after_image"]:
             generated_image_file = save_after_image(scene, after_output_filename_prefix, generated_image_file)
 
     # if we're rendering an animation manually, save the image to the animation output path
-    if props.is_rendering_animation_manually:
-        generated_image_file = save_animation_image(scene, animation_output_filename_prefix, generated_image_file)
+    if job["is_animation_frame"]:
+        generated_image_file = save_animation_image(scene, animation_output_filename_prefix, generated_image_file, job["frame"])
 
-    # load the image into our scene
-    try:
-        print("Looking for AI Render output_file", generated_image_file)
-        ai_image_output = bpy.data.images.load(generated_image_file, check_existing=False)
-        ai_image_output.name = "AI Render Output"
-        print("AI Render output_file", ai_image_output)
-    except:
-        return handle_error(scene, "Couldn't load the image from Stable Diffusion", "load_sd_image")
+        # remember what went into this frame, so it can be skipped if it's rendered again without changes
+        if generated_image_file and job.get("fingerprint"):
+            animation_manifest.record_frame(generated_image_file, job["frame"], job["fingerprint"])
 
-    # view the image in the AIR workspace
-    try:
-        utils.view_sd_result_in_air_image_editor(ai_image_output)
-    except:
-        return handle_error(scene, "Couldn't switch the view to the image from Stable Diffusion", "view_sd_image")
+        # and keep the journal up to date, so the render can be resumed from here
+        if generated_image_file:
+            animation_journal.record_frame(generated_image_file, job["frame"], job["seed"])
+
+    # load the image into our scene, and view it
+    if not load_and_view_image(scene, generated_image_file, job["output_image_name"]):
+        return False
 
     # track an analytics event
     """ additional_params = {
@@ -517,7 +917,48 @@ def sd_generate(scene, prompts=None, use_last_sd_image=False, txt2img=False):
     return True
 
 
-def sd_upscale(scene, apply_to_last_image=True):
+def load_controlnet_models_and_modules():
+    return automatic1111_api.load_controlnet_models() and automatic1111_api.load_controlnet_modules()
+
+
+def load_and_view_image(scene, image_file, image_name):
+    # load the image into our scene
+    try:
+        print("Looking for AI Render output_file", image_file)
+        # reuse the same few images, so long runs don't keep adding images to the file
+        ai_image_output = output_images.load(image_file, image_name, utils.output_image_history())
+        print("AI Render output_file", ai_image_output)
+    except:
+        return handle_error(scene, "Couldn't load the image from Stable Diffusion", "load_sd_image")
+
+    # view the image in the AIR workspace (unless we're in background mode, with no ui)
+    try:
+        if not bpy.app.background:
+            utils.view_sd_result_in_air_image_editor(ai_image_output)
+    except:
+        return handle_error(scene, "Couldn't switch the view to the image from Stable Diffusion", "view_sd_image")
+
+    return True
+
+
+def choose_variation(scene, index):
+    """Use one of the variations from the last batch as the last generated image"""
+    props = scene.air_props
+    variation_files = utils.get_variation_files(props)
+
+    if index < 0 or index >= len(variation_files):
+        return handle_error(scene, "Couldn't find that variation", "choose_variation")
+    if not os.path.exists(variation_files[index]):
+        return handle_error(scene, "Couldn't load that variation. It's probably been deleted or moved.", "choose_variation")
+
+    props.selected_variation = index
+    props.last_generated_image_filename = variation_files[index]
+    temp_files.set_reference("last_generated_image", variation_files[index])
+
+    return load_and_view_image(scene, variation_files[index], "AI Render Output")
+
+
+def sd_upscale(scene, apply_to_last_image=True, callback=None, cancel_token=None):
     """Post to the API to upscale the most recent Stable Diffusion image and then process it"""
     props = scene.air_props
 
@@ -547,30 +988,72 @@ def sd_upscale(scene, apply_to_last_image=True):
     # get the backend we're using
     sd_backend = utils.get_active_backend()
 
-    # send to whichever API we're using
-    start_time = time.time()
-    generated_image_file = sd_backend.upscale(img_file, filename_prefix, props)
+    job = {
+        "scene": scene,
+        "filename_prefix": filename_prefix,
+        "should_autosave_after_image": utils.should_autosave_after_image(props),
+        "start_time": time.time(),
+        "callback": callback,
+        "cancel_token": cancellation.acquire(cancel_token),
+    }
+
+    # upscale on this computer, if we should (there's nothing to send)
+    if utils.should_upscale_locally(props):
+        img_file.close()
+        if not submit_local_upscale(scene, target_file_path, get_upscaled_size(scene, sd_backend, True), filename_prefix, functools.partial(process_upscaled_image, job), job["cancel_token"]):
+            cancellation.release(job["cancel_token"])
+            return False
+        return True
+
+    # send to whichever API we're using (on a worker thread, so the ui stays responsive)
+    worker_pool.submit(
+        functools.partial(sd_backend.upscale, img_file, filename_prefix, utils.get_props_snapshot(props), cancel_token=job["cancel_token"]),
+        functools.partial(process_upscaled_image, job),
+    )
+
+    # return success
+    return True
+
+
+def process_upscaled_image(job, generated_image_file):
+    """Save and load the upscaled image returned from the backend, and then call the job's callback"""
+    cancellation.release(job["cancel_token"])
+
+    # if the request was cancelled, drop whatever came back
+    if is_cancelled(job["cancel_token"]):
+        success = False
+    else:
+        success = load_upscaled_image(job, generated_image_file)
+
+    if job["callback"]:
+        job["callback"](success)
+
+
+def load_upscaled_image(job, generated_image_file):
+    scene = job["scene"]
+    props = scene.air_props
+    filename_prefix = job["filename_prefix"]
 
     # if we didn't get a successful image, stop here (an error will have been handled by the api function)
     if not generated_image_file:
         return False
 
     # autosave the image, if we should
-    if utils.should_autosave_after_image(props):
+    if job["should_autosave_after_image"]:
         generated_image_file = save_after_image(scene, filename_prefix, generated_image_file)
 
     # load the image into our scene
     try:
         print("Looking for AI Render UPSCALE output_file", generated_image_file)
-        upscaled_image = bpy.data.images.load(generated_image_file, check_existing=False)
-        upscaled_image.name = "AI Render Upscale Output"
+        upscaled_image = output_images.load(generated_image_file, "AI Render Upscale Output", utils.output_image_history())
         print("AI Render output_file", upscaled_image)
     except:
         return handle_error(scene, "Couldn't load the image from Stable Diffusion", "load_sd_image")
 
-    # view the image in the AIR workspace
+    # view the image in the AIR workspace (unless we're in background mode, with no ui)
     try:
-        utils.view_sd_result_in_air_image_editor(upscaled_image)
+        if not bpy.app.background:
+            utils.view_sd_result_in_air_image_editor(upscaled_image)
     except:
         return handle_error(scene, "Couldn't switch the view to the image from Stable Diffusion", "view_sd_image")
 
@@ -579,7 +1062,7 @@ def sd_upscale(scene, apply_to_last_image=True):
         "backend": utils.sd_backend(),
         "upscale_factor": props.upscale_factor,
         "upscaler_model": props.upscaler_model,
-        "duration": round(time.time() - start_time),
+        "duration": round(time.time() - job["start_time"]),
     }
     event_params = analytics.prepare_event('upscale_image', additional_params=additional_params)
     analytics.track_event('upscale_image', event_params=event_params)
@@ -589,7 +1072,7 @@ def sd_upscale(scene, apply_to_last_image=True):
 
 
 # Inpainting
-def sd_inpaint(scene):
+def sd_inpaint(scene, callback=None, cancel_token=None):
     """Post to the API to generate a Stable Diffusion image with inpainting, and then process it"""
     props = scene.air_props
 
@@ -614,7 +1097,6 @@ def sd_inpaint(scene):
     timestamp = int(time.time())
     before_output_filename_prefix = f"ai-render-{timestamp}-1-before"
     after_output_filename_prefix = f"ai-render-{timestamp}-2-inpainted"
-    animation_output_filename_prefix = "ai-render-"
 
     # if we want to use the last SD image, try loading it now
     if not props.last_generated_image_filename:
@@ -624,13 +1106,19 @@ def sd_inpaint(scene):
     except:
         return handle_error(scene, "Couldn't load the last Stable Diffusion image. It's probably been deleted or moved. You'll need to restore it or render a new image.", "load_last_generated_image")
 
-    # load mask here
-    if props.inpaint_mask_path == "":
+    # load the mask (or make it from the last render)
+    if props.inpaint_mask_source != 'FILE':
+        mask_image = render_passes.get_inpaint_mask(scene, utils.get_output_width(scene), utils.get_output_height(scene))
+        if not mask_image:
+            return False
+        mask_file = mask_image.open()
+    elif props.inpaint_mask_path == "":
         return handle_error(scene, "Couldn't find the Inpaint Mask File", "inpaint_mask_path")
-    try:
-        mask_file = open(props.inpaint_mask_path, 'rb')
-    except:
-        return handle_error(scene, "Couldn't load the uploaded inpaint mask file", "inpaint_mask_path")
+    else:
+        try:
+            mask_file = open(props.inpaint_mask_path, 'rb')
+        except:
+            return handle_error(scene, "Couldn't load the uploaded inpaint mask file", "inpaint_mask_path")
 
     # prepare data for the API request
     params = {
@@ -648,43 +1136,37 @@ def sd_inpaint(scene):
     # get the backend we're using
     sd_backend = utils.get_active_backend()
 
-    # send to whichever API we're using
-    start_time = time.time()
-    generated_image_file = sd_backend.inpaint(params, img_file, mask_file, after_output_filename_prefix, props)
-
-    # if we didn't get a successful image, stop here (an error will have been handled by the api function)
-    if not generated_image_file:
-        return False
-
-    # autosave the after image, if we should
-    if utils.should_autosave_after_image(props):
-        generated_image_file = save_after_image(scene, after_output_filename_prefix, generated_image_file)
-
-    # store this image filename as the last generated image
-    props.last_generated_image_filename = generated_image_file
-
-    # if we're rendering an animation manually, save the image to the animation output path
-    if props.is_rendering_animation_manually:
-        generated_image_file = save_animation_image(scene, animation_output_filename_prefix, generated_image_file)
-
-    # load the image into our scene
-    try:
-        img = bpy.data.images.load(generated_image_file, check_existing=False)
-    except:
-        return handle_error(scene, "Couldn't load the image from Stable Diffusion", "load_sd_image")
+    job = {
+        "scene": scene,
+        "sd_backend": sd_backend,
+        "filename_prefix": after_output_filename_prefix,
+        "frame": scene.frame_current,
+        "is_animation_frame": props.is_rendering_animation_manually,
+        "should_autosave_after_image": utils.should_autosave_after_image(props),
+        "should_upscale": False,
+        "output_image_name": "AI Render Inpaint Output",
+        "start_time": time.time(),
+        "callback": callback,
+        "cancel_token": cancellation.acquire(cancel_token),
+    }
 
-    # view the image in the AIR workspace
-    try:
-        utils.view_sd_result_in_air_image_editor(img)
-    except:
-        return handle_error(scene, "Couldn't switch the view to the image from Stable Diffusion", "view_sd_image")
+    # send to whichever API we're using (on a worker thread, so the ui stays responsive)
+    worker_pool.submit(
+        functools.partial(request_inpainted_image, sd_backend, params, img_file, mask_file, after_output_filename_prefix, utils.get_props_snapshot(props), job["cancel_token"]),
+        functools.partial(process_generated_images, job),
+    )
 
     # return success
     return True
 
 
+def request_inpainted_image(sd_backend, params, img_file, mask_file, filename_prefix, props, cancel_token=None):
+    # NOTE: This runs on a worker thread, so it must not touch any bpy data. (props is a snapshot)
+    return sd_backend.inpaint(params, img_file, mask_file, filename_prefix, props, cancel_token=cancel_token), None
+
+
 # Outpainting
-def sd_outpaint(scene):
+def sd_outpaint(scene, callback=None, cancel_token=None):
     """Post to the API to generate a Stable Diffusion image with outpainting, and then process it"""
     props = scene.air_props
 
@@ -709,7 +1191,6 @@ def sd_outpaint(scene):
     timestamp = int(time.time())
     before_output_filename_prefix = f"ai-render-{timestamp}-1-before"
     after_output_filename_prefix = f"ai-render-{timestamp}-2-outpainted"
-    animation_output_filename_prefix = "ai-render-"
 
     # if we want to use the last SD image, try loading it now
     if not props.last_generated_image_filename:
@@ -739,41 +1220,35 @@ def sd_outpaint(scene):
     # get the backend we're using
     sd_backend = utils.get_active_backend()
 
-    # send to whichever API we're using
-    start_time = time.time()
-    generated_image_file = sd_backend.outpaint(params, img_file, after_output_filename_prefix, props)
-
-    # if we didn't get a successful image, stop here (an error will have been handled by the api function)
-    if not generated_image_file:
-        return False
-
-    # autosave the after image, if we should
-    if utils.should_autosave_after_image(props):
-        generated_image_file = save_after_image(scene, after_output_filename_prefix, generated_image_file)
-
-    # store this image filename as the last generated image
-    props.last_generated_image_filename = generated_image_file
-
-    # if we're rendering an animation manually, save the image to the animation output path
-    if props.is_rendering_animation_manually:
-        generated_image_file = save_animation_image(scene, animation_output_filename_prefix, generated_image_file)
-
-    # load the image into our scene
-    try:
-        img = bpy.data.images.load(generated_image_file, check_existing=False)
-    except:
-        return handle_error(scene, "Couldn't load the image from Stable Diffusion", "load_sd_image")
+    job = {
+        "scene": scene,
+        "sd_backend": sd_backend,
+        "filename_prefix": after_output_filename_prefix,
+        "frame": scene.frame_current,
+        "is_animation_frame": props.is_rendering_animation_manually,
+        "should_autosave_after_image": utils.should_autosave_after_image(props),
+        "should_upscale": False,
+        "output_image_name": "AI Render Outpaint Output",
+        "start_time": time.time(),
+        "callback": callback,
+        "cancel_token": cancellation.acquire(cancel_token),
+    }
 
-    # view the image in the AIR workspace
-    try:
-        utils.view_sd_result_in_air_image_editor(img)
-    except:
-        return handle_error(scene, "Couldn't switch the view to the image from Stable Diffusion", "view_sd_image")
+    # send to whichever API we're using (on a worker thread, so the ui stays responsive)
+    worker_pool.submit(
+        functools.partial(request_outpainted_image, sd_backend, params, img_file, after_output_filename_prefix, utils.get_props_snapshot(props), job["cancel_token"]),
+        functools.partial(process_generated_images, job),
+    )
 
     # return success
     return True
 
 
+def request_outpainted_image(sd_backend, params, img_file, filename_prefix, props, cancel_token=None):
+    # NOTE: This runs on a worker thread, so it must not touch any bpy data. (props is a snapshot)
+    return sd_backend.outpaint(params, img_file, filename_prefix, props, cancel_token=cancel_token), None
+
+
 class AIR_OT_enable(bpy.types.Operator):
     "Enable AI Render in this scene"
     bl_idname = "ai_render.enable"
@@ -794,6 +1269,7 @@ class AIR_OT_disable(bpy.types.Operator):
 
     def execute(self, context):
         context.scene.air_props.is_enabled = False
+        render_passes.teardown(context.scene)
         return {'FINISHED'}
 
 
@@ -882,6 +1358,67 @@ class AIR_OT_copy_preset_text(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class AIR_OT_choose_variation(bpy.types.Operator):
+    "Use this variation as the last AI image (to upscale it, or generate a new image from it)"
+    bl_idname = "ai_render.choose_variation"
+    bl_label = "Choose Variation"
+
+    index: bpy.props.IntProperty(
+        name="Variation",
+        default=0,
+        min=0,
+    )
+
+    def execute(self, context):
+        if not choose_variation(context.scene, self.index):
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+
+class AIR_OT_clear_result_cache(bpy.types.Operator):
+    "Remove all the cached images"
+    bl_idname = "ai_render.clear_result_cache"
+    bl_label = "Clear Result Cache"
+
+    def execute(self, context):
+        result_cache.clear(utils.result_cache_path(context))
+        self.report({'INFO'}, "Result cache cleared")
+        return {'FINISHED'}
+
+
+class AIR_OT_clear_frame_claims(bpy.types.Operator):
+    "Remove the frame claims in the animation output path, so every frame can be rendered again"
+    bl_idname = "ai_render.clear_frame_claims"
+    bl_label = "Clear Frame Claims"
+
+    def execute(self, context):
+        removed = frame_claims.clear(get_animation_output_dir(context.scene))
+        self.report({'INFO'}, f"Removed {removed} frame claim(s)")
+        return {'FINISHED'}
+
+
+class AIR_OT_cancel_generation(bpy.types.Operator):
+    "Stop the images that are being generated (and stop them on the Stable Diffusion server, for backends that allow it)"
+    bl_idname = "ai_render.cancel_generation"
+    bl_label = "Cancel"
+
+    def execute(self, context):
+        cancelled = cancellation.cancel_all()
+        self.report({'INFO'}, f"Canceled {cancelled} request(s)" if cancelled else "Nothing to cancel")
+        return {'FINISHED'}
+
+
+class AIR_OT_benchmark_local_upscaler(bpy.types.Operator):
+    "Measure how quickly images can be upscaled on this computer"
+    bl_idname = "ai_render.benchmark_local_upscaler"
+    bl_label = "Benchmark Local Upscaler"
+
+    def execute(self, context):
+        throughput = local_upscaler.benchmark()
+        self.report({'INFO'}, f"The local upscaler makes {throughput:.1f} megapixels per second")
+        return {'FINISHED'}
+
+
 class AIR_OT_edit_animated_prompts(bpy.types.Operator):
     "Show the animated prompts panel, and focus it"
     bl_idname = "ai_render.edit_animated_prompts"
@@ -890,7 +1427,7 @@ class AIR_OT_edit_animated_prompts(bpy.types.Operator):
     def execute(self, context):
         ensure_animated_prompts_text()
         utils.activate_workspace(workspace_id=config.workspace_id)
-        task_queue.add(functools.partial(ensure_animated_prompts_text_editor_in_workspace, context))
+        task_queue.add(functools.partial(ensure_animated_prompts_text_editor_in_workspace, context), task_queue.PRIORITY_UI, key="show_animated_prompts_text_editor")
 
         return {'FINISHED'}
 
@@ -972,36 +1509,76 @@ class AIR_OT_render_animation(bpy.types.Operator):
     bl_idname = "ai_render.render_animation"
     bl_label = "Render Animation"
 
+    resume: bpy.props.BoolProperty(
+        name="Resume",
+        default=False,
+        description="Continue the last animation render in the animation output path from where it stopped, with the same settings",
+        options={'SKIP_SAVE'},
+    )
+
     _timer = None
     _ticks_since_last_render = 0
     _finished = True
-    _start_frame = 0
-    _end_frame = 0
-    _frame_step = 1
-    _current_frame = 0
+    _frames = None
+    _frame_index = 0
+    _skipped_frames = 0
+    _claims = None
+    _pipeline_depth = 1
     _orig_current_frame = 0
-    _animated_prompts = None
-    _animated_negative_prompts = None
+    _prompt_timeline = None
+    _frame_prompts = None
     _static_prompt = None
     _negative_static_prompt = None
+    _frame_results = None
+    _max_retries = 0
+    _retries = None
+    _retry_frames = None
+    _journal_prompts = None
+    _cancel_token = None
+
+    def _load_journal(self, context):
+        """Restore the settings and remaining frames of the animation render we're resuming"""
+        scene = context.scene
+        if not validate_animation_output_path(scene):
+            return False
+
+        animation_journal.reset()
+        output_dir = get_animation_output_dir(scene)
+        remaining_frames = animation_journal.get_remaining_frames(output_dir)
+        if not remaining_frames:
+            return handle_error(scene, "There's no unfinished animation render to resume in the animation output path", "resume_animation")
+
+        changed_settings = animation_journal.apply_settings(scene, animation_journal.load(output_dir)["settings"])
+        if changed_settings:
+            return handle_error(scene, f"Couldn't resume the animation render, because some of its settings can't be restored ({', '.join(changed_settings)}). Its remaining frames wouldn't match the ones already rendered", "resume_animation")
+        animation_journal.resume(output_dir)
+        self._journal_prompts = dict(remaining_frames)
+        return True
 
     def _pre_render(self, context):
         scene = context.scene
 
-        # do validation and setup
-        if validate_params(scene) and validate_animation_output_path(scene):
+        # when resuming, use the settings and prompts from the journal
+        self._journal_prompts = None
+        if self.resume and not self._load_journal(context):
+            return False
+
+        # do validation and setup (the frames come from the journal when resuming)
+        if validate_params(scene) and validate_animation_output_path(scene) and (self._journal_prompts or validate_animation_frames(scene)):
             do_pre_render_setup(scene)
             do_pre_api_setup(scene)
         else:
             return False
 
         # validate and process the animated prompts, if we are using them
-        if context.scene.air_props.use_animated_prompts:
-            self._animated_prompts, self._animated_negative_prompts = validate_and_process_animated_prompt_text(context.scene)
-            if not self._animated_prompts:
+        if self._journal_prompts:
+            pass
+        elif context.scene.air_props.use_animated_prompts:
+            self._prompt_timeline = validate_and_process_animated_prompt_text(context.scene)
+            if not self._prompt_timeline:
                 return False
         else:
-            self._animated_prompts = None
+            self._prompt_timeline = None
             self._static_prompt = get_full_prompt(context.scene)
             self._negative_static_prompt = scene.air_props.negative_prompt_text.strip()
 
@@ -1011,10 +1588,31 @@ class AIR_OT_render_animation(bpy.types.Operator):
         self._finished = False
 
         self._orig_current_frame = context.scene.frame_current
-        self._start_frame = context.scene.frame_start
-        self._end_frame = context.scene.frame_end
-        self._frame_step = context.scene.frame_step
-        self._current_frame = context.scene.frame_start
+        self._frame_index = 0
+        self._skipped_frames = 0
+        self._claims = create_frame_claims(context.scene)
+        self._pipeline_depth = get_animation_pipeline_depth(context.scene)
+
+        # work out every frame's prompts (and blend weights) up front
+        if self._journal_prompts:
+            self._frames = list(self._journal_prompts)
+            self._frame_prompts = self._journal_prompts
+        else:
+            self._frames = get_animation_frames(context.scene)
+            self._frame_prompts = self._get_prompts_for_frames(context, self._frames)
+
+            # start a journal of the render, so it can be resumed if it stops part way (when sharing
+            # frames with other instances, the frame claims already keep track of the finished frames)
+            if not self._claims:
+                frames = [(frame, self._frame_prompts[frame]) for frame in self._frames]
+                animation_journal.start(get_animation_output_dir(context.scene), frames, animation_journal.get_settings(context.scene))
+
+        self._frame_results = {}
+        self._max_retries = context.scene.air_props.animation_frame_retries
+        self._retries = {}
+        self._retry_frames = []
+        self._cancel_token = cancellation.CancelToken()
+        animation_manifest.reset()
         context.scene.air_props.is_rendering_animation_manually = True
 
         context.scene.air_progress_status_message = ""
@@ -1028,6 +1626,16 @@ class AIR_OT_render_animation(bpy.types.Operator):
     def _end_render(self, context, status_message):
         self._finished = True
 
+        # stop any frames that are still being generated (e.g. when canceled or after an error)
+        self._cancel_token.cancel()
+
+        # let other instances have the frames we didn't finish
+        if self._claims:
+            self._claims.release_all()
+
+        # the journal is left as it is, so the render can be resumed later
+        animation_journal.stop(get_animation_output_dir(context.scene))
+
         context.scene.frame_current = self._orig_current_frame
         context.scene.air_props.is_rendering_animation_manually = False
 
@@ -1036,27 +1644,79 @@ class AIR_OT_render_animation(bpy.types.Operator):
 
         context.window_manager.event_timer_remove(self._timer)
 
-    def _advance_frame(self, context):
-        self._current_frame += self._frame_step
-        if self._current_frame > context.scene.frame_end:
-            self._end_render(context, "Animation Render Complete")
+    def _get_next_frame(self):
+        """Get the next frame to render (claiming it, when sharing frames with other instances), or None if there are no more"""
+        # failed frames go first, once they've waited long enough to be retried
+        now = time.time()
+        for retry in self._retry_frames:
+            retry_time, frame = retry
+            if retry_time <= now:
+                self._retry_frames.remove(retry)
+                return frame
+
+        while self._frame_index < len(self._frames):
+            frame = self._frames[self._frame_index]
+            self._frame_index += 1
+
+            if self._claims is None or self._claims.claim(frame):
+                return frame
+
+            # another instance has it
+            self._skipped_frames += 1
+        return None
+
+    def _finish_frame(self, frame, success):
+        # a frame can fail because of a temporary problem (e.g. a timeout, or the server
+        # restarting), so try it again a few times, waiting longer each time
+        attempt = self._retries.get(frame, 0) + 1
+        if not success and not self._finished and attempt <= self._max_retries:
+            self._retries[frame] = attempt
+            delay = get_frame_retry_delay(attempt)
+            print(f"AI Render: frame {frame} failed, retrying in {delay} seconds (attempt {attempt})")
+
+            del self._frame_results[frame]
+            self._retry_frames.append((time.time() + delay, frame))
+            return
+
+        self._frame_results[frame] = success
+        if self._claims:
+            self._claims.finish(frame, success)
 
     def _report_complete(self):
         print("AI Render animation completed")
         self.report({'INFO'}, "AI Render animation completed")
 
     def _get_total_frames(self):
-        return math.floor(((self._end_frame - self._start_frame) / self._frame_step) + 1)
+        return max(1, len(self._frames) - self._skipped_frames)
 
     def _get_completed_frames(self):
-        return math.floor((self._current_frame - self._start_frame) / self._frame_step)
+        return sum(1 for result in self._frame_results.values() if result)
+
+    def _get_frames_in_progress(self):
+        return sum(1 for result in self._frame_results.values() if result is None)
 
     def _get_completed_percent(self):
-        return round(self._get_completed_frames() / self._get_total_frames(), 2)
+        completed_frames = self._get_completed_frames()
+
+        # include how far along the frames in progress are, when Automatic1111 reports it
+        if utils.sd_backend() == "automatic1111":
+            completed_frames += min(automatic1111_progress.get_progress_of_all(), self._get_frames_in_progress())
+
+        return round(completed_frames / self._get_total_frames(), 2)
 
     def _get_label(self):
         return f"AI Render (Frame {self._get_completed_frames()}/{self._get_total_frames()})"
 
+    def _get_prompts_for_frames(self, context, frames):
+        if context.scene.air_props.use_animated_prompts:
+            return self._prompt_timeline.get_prompts_for_frames(frames)
+        else:
+            prompts = {
+                "prompt": self._static_prompt,
+                "negative_prompt": self._negative_static_prompt,
+            }
+            return {frame: prompts for frame in frames}
+
     def modal(self, context, event):
         if event.type == 'ESC':
             print("AI Render animation canceled")
@@ -1065,6 +1725,37 @@ class AIR_OT_render_animation(bpy.types.Operator):
             return {'CANCELLED'}
 
         elif event.type == 'TIMER' and not self._finished:
+            # if any frame failed, quit here with an error
+            if False in self._frame_results.values():
+                print("AI Render animation ended with error")
+                self.report({'INFO'}, "AI Render animation ended with error")
+                self._end_render(context, "Animation Render Error")
+                return {'CANCELLED'}
+
+            # update the progress bar (when pipelining, frames can complete in any order,
+            # so this counts the finished frames rather than using the current frame)
+            context.scene.air_progress_label = self._get_label()
+            context.scene.air_progress = self._get_completed_percent() * 100
+
+            # keep our frame claims fresh, so other instances don't take them over
+            if self._claims:
+                self._claims.refresh()
+
+            # once every frame has been rendered, wait for the last ones to come back
+            # from Stable Diffusion, and then report success and quit
+            if self._frame_index >= len(self._frames) and not self._retry_frames:
+                if self._get_frames_in_progress() == 0:
+                    animation_journal.finish(get_animation_output_dir(context.scene))
+                    self._end_render(context, "Animation Render Complete")
+                    self._report_complete()
+                    return {'FINISHED'}
+                else:
+                    return {'PASS_THROUGH'}
+
+            # wait until there's room in the pipeline for another frame
+            if self._get_frames_in_progress() >= self._pipeline_depth:
+                return {'PASS_THROUGH'}
+
             # after each render, wait a few ticks before starting the next one,
             # to give Blender time to update the UI
             if self._ticks_since_last_render < 2:
@@ -1073,36 +1764,21 @@ class AIR_OT_render_animation(bpy.types.Operator):
             else:
                 self._ticks_since_last_render = 0
 
-            # render the current frame
-            if context.scene.air_props.use_animated_prompts:
-                prompt = get_prompt_at_frame(self._animated_prompts, self._current_frame)
-                negative_prompt = get_prompt_at_frame(self._animated_negative_prompts, self._current_frame)
-            else:
-                prompt = self._static_prompt
-                negative_prompt = self._negative_static_prompt
+            # render the next frame and send it off to Stable Diffusion. The
+            # result will be stored in _frame_results when it comes back.
+            frame = self._get_next_frame()
+            if frame is None:
+                return {'PASS_THROUGH'}
 
-            was_successful = render_frame(context, self._current_frame, {"prompt": prompt, "negative_prompt": negative_prompt})
+            self._frame_results[frame] = None
+            callback = functools.partial(self._finish_frame, frame)
 
-            # if the render was successful, advance to the next frame.
-            # otherwise, quit here with an error.
-            if was_successful:
-                self._advance_frame(context)
-            else:
-                print("AI Render animation ended with error")
-                self.report({'INFO'}, "AI Render animation ended with error")
-                self._end_render(context, "Animation Render Error")
-                return {'CANCELLED'}
+            if not render_frame(context, frame, self._frame_prompts[frame], callback, self._cancel_token):
+                # the frame couldn't even be sent (e.g. invalid settings), so there's no point retrying it
+                self._retries[frame] = self._max_retries
+                self._finish_frame(frame, False)
 
-            # update the progress bar
-            context.scene.air_progress_label = self._get_label()
-            context.scene.air_progress = self._get_completed_percent() * 100
-
-            # if we're done, report success and quit. otherwise, pass through
-            if self._finished:
-                self._report_complete()
-                return {'FINISHED'}
-            else:
-                return {'PASS_THROUGH'}
+            return {'PASS_THROUGH'}
 
         elif self._finished:
             self._report_complete()
@@ -1192,7 +1868,7 @@ class AIR_OT_automatic1111_load_upscaler_models(bpy.types.Operator):
     bl_label = "Load ControlNet Models"
 
     def execute(self, context):
-        automatic1111_api.load_upscaler_models(context)
+        automatic1111_api.load_upscaler_models()
         return {'FINISHED'}
 
 class AIR_OT_automatic1111_load_sd_models(bpy.types.Operator):
@@ -1201,7 +1877,7 @@ class AIR_OT_automatic1111_load_sd_models(bpy.types.Operator):
     bl_label = "Load Stable Diffusion Models"
 
     def execute(self, context):
-        automatic1111_api.load_sd_models(context)
+        automatic1111_api.load_sd_models()
         return {'FINISHED'}
 
 
@@ -1211,7 +1887,7 @@ class AIR_OT_automatic1111_load_controlnet_models(bpy.types.Operator):
     bl_label = "Load ControlNet Models"
 
     def execute(self, context):
-        automatic1111_api.load_controlnet_models(context)
+        automatic1111_api.load_controlnet_models()
         return {'FINISHED'}
 
 
@@ -1221,7 +1897,7 @@ class AIR_OT_automatic1111_load_controlnet_modules(bpy.types.Operator):
     bl_label = "Load ControlNet Modules"
 
     def execute(self, context):
-        automatic1111_api.load_controlnet_modules(context)
+        automatic1111_api.load_controlnet_modules()
         return {'FINISHED'}
 
 
@@ -1232,7 +1908,7 @@ class AIR_OT_automatic1111_load_controlnet_models_and_modules(bpy.types.Operator
 
     def execute(self, context):
         # load the models and modules from the Automatic1111 API
-        automatic1111_api.load_controlnet_models(context) and automatic1111_api.load_controlnet_modules(context)
+        load_controlnet_models_and_modules()
 
         # set the default values for the ControlNet model and module
         return {'FINISHED'}
@@ -1293,11 +1969,16 @@ classes = [
     AIR_OT_set_image_size_to_768x768,
     AIR_OT_show_other_dimension_options,
     AIR_OT_copy_preset_text,
+    AIR_OT_choose_variation,
+    AIR_OT_clear_result_cache,
+    AIR_OT_cancel_generation,
+    AIR_OT_clear_frame_claims,
     AIR_OT_edit_animated_prompts,
     AIR_OT_generate_new_image_from_render,
     AIR_OT_generate_new_image_from_last_sd_image,
     AIR_OT_upscale_last_sd_image,
     AIR_OT_upscale_sd_image,
+    AIR_OT_benchmark_local_upscaler,
     AIR_OT_render_animation,
     AIR_OT_setup_instructions_popup,
     AIR_OT_show_error_popup,
@@ -0,0 +1,51 @@
+import bpy
+import time
+from . import temp_files
+
+
+# generated images are loaded into a small ring of image datablocks that are reused,
+# instead of a new datablock for every image. Otherwise, rendering a long animation would
+# leave hundreds of images ("AI Render Output.001", ...) in memory and in the blend file.
+
+LOADED_AT_KEY = "ai_render_loaded_at"
+
+
+def get_slot_names(image_name, history_size):
+    return [image_name] + [f"{image_name} {i}" for i in range(2, history_size + 1)]
+
+
+def get_least_recently_loaded(images):
+    return min(images, key=lambda image: image.get(LOADED_AT_KEY, 0))
+
+
+# public methods
+def load(image_file, image_name, history_size=1):
+    """Load an image file into the least recently used image in the ring for image_name, and return the image"""
+    slot_names = get_slot_names(image_name, max(1, history_size))
+
+    # fill any empty slots first, and then reuse the one that was loaded longest ago
+    empty_slot_name = next((name for name in slot_names if name not in bpy.data.images), None)
+    if empty_slot_name:
+        image = None
+    else:
+        image = get_least_recently_loaded([bpy.data.images[name] for name in slot_names])
+
+        # a packed image would keep its packed pixels when reloaded, so replace it instead
+        if image.packed_file:
+            empty_slot_name = image.name
+            bpy.data.images.remove(image)
+            image = None
+
+    if image:
+        image.filepath = image_file
+        image.reload()
+    else:
+        image = bpy.data.images.load(image_file, check_existing=False)
+        image.name = empty_slot_name
+
+    image[LOADED_AT_KEY] = time.time()
+
+    # keep the image's file while it's loaded, in case Blender needs to reload it
+    temp_files.set_reference("output_image:" + image.name, image_file)
+    return image
+
@@ -0,0 +1,227 @@
+import bpy
+import math
+import os
+import struct
+import zlib
+import numpy as np
+from . import utils
+
+
+# vectorized helpers for working with image pixels in memory (Blender's image pixels are
+# floats from 0 to 1, RGBA, with the bottom row first), so images can be prepared and
+# encoded without saving them to disk and reading them back.
+#
+# Pixels are (height, width, channels) arrays, and masks are (height, width) arrays,
+# where 1 is the area to repaint. Nothing here loops over the pixels in Python.
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6} # channels -> PNG color type (gray, gray + alpha, RGB, RGBA)
+PNG_COMPRESSION_LEVEL = 6
+
+# a feathered edge is three box blurs, which together are close to a gaussian blur
+FEATHER_BLUR_PASSES = 3
+
+
+# private
+read_buffer = None
+
+
+def get_image_pixels(image, reuse_buffer=False):
+    """Read an image's pixels into a (height, width, channels) float32 array, with the bottom row first. With
+    reuse_buffer, the pixels are read into a buffer that's kept between calls (so the array is only valid until
+    the next call)"""
+    global read_buffer
+
+    width, height = image.size
+    size = width * height * image.channels
+    if reuse_buffer:
+        if read_buffer is None or read_buffer.size < size:
+            read_buffer = np.empty(size, dtype=np.float32)
+        pixels = read_buffer[:size]
+    else:
+        pixels = np.empty(size, dtype=np.float32)
+
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(height, width, image.channels)
+
+
+def read_image_file(image_file):
+    """Read an image file's pixels, as a (height, width, 4) float32 array (adding an alpha channel if it doesn't have
+    one). The image is only loaded into Blender long enough to read it"""
+    image = bpy.data.images.load(image_file, check_existing=False)
+    try:
+        pixels = get_image_pixels(image)
+    finally:
+        bpy.data.images.remove(image)
+
+    # make sure every image has an alpha channel, so they can be combined
+    if pixels.shape[2] < 4:
+        rgba = np.ones(pixels.shape[:2] + (4,), dtype=np.float32)
+        rgba[..., :3] = pixels[..., :3] if pixels.shape[2] >= 3 else pixels[..., :1]
+        pixels = rgba
+    return pixels
+
+
+def to_uint8(pixels):
+    """Convert float pixels (0 to 1) to 8 bit pixels"""
+    return (np.clip(pixels, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+
+def rgba_to_rgb(pixels, background=(0, 0, 0)):
+    """Drop the alpha channel, blending the pixels over a background color"""
+    if pixels.shape[2] < 4:
+        return pixels[..., :3]
+    alpha = pixels[..., 3:4]
+    return pixels[..., :3] * alpha + np.asarray(background, dtype=np.float32) * (1 - alpha)
+
+
+# masks
+def mask_from_alpha(alpha, threshold=0.5):
+    """Get a mask of the transparent parts of an image, from its alpha channel"""
+    return (alpha < threshold).astype(np.float32)
+
+
+def mask_from_ids(ids, mask_ids):
+    """Get a mask of the pixels with one of the given IDs (e.g. from an object or material index pass)"""
+    return np.isin(np.rint(ids).astype(np.int32), list(mask_ids)).astype(np.float32)
+
+
+def box_blur(pixels, radius, axis):
+    # a running sum along one axis (with the edge pixels extended), so the cost doesn't
+    # depend on the radius
+    padding = [(0, 0)] * pixels.ndim
+    padding[axis] = (radius + 1, radius)
+    summed = np.cumsum(np.pad(pixels, padding, mode='edge'), axis=axis, dtype=np.float64)
+
+    length = pixels.shape[axis]
+    upper = np.take(summed, np.arange(2 * radius + 1, 2 * radius + 1 + length), axis=axis)
+    lower = np.take(summed, np.arange(length), axis=axis)
+    return ((upper - lower) / (2 * radius + 1)).astype(np.float32)
+
+
+def feather(mask, radius):
+    """Soften the edges of a mask (or image) by about radius pixels"""
+    if radius < 1:
+        return mask
+
+    blur_radius = max(1, round(radius / FEATHER_BLUR_PASSES))
+    for _ in range(FEATHER_BLUR_PASSES):
+        mask = box_blur(mask, blur_radius, 0)
+        mask = box_blur(mask, blur_radius, 1)
+    return mask
+
+
+# resizing
+def get_area_weights(size, new_size):
+    # how much of each pixel ends up in each resized pixel (each resized pixel is the
+    # average of the pixels it covers), as a (new_size, size) matrix
+    scale = size / new_size
+    starts = np.arange(new_size, dtype=np.float64)[:, np.newaxis] * scale
+    positions = np.arange(size, dtype=np.float64)[np.newaxis, :]
+    overlap = np.minimum(starts + scale, positions + 1) - np.maximum(starts, positions)
+    return (np.clip(overlap, 0, None) / scale).astype(np.float32)
+
+
+def resize_with_weights(pixels, row_weights, column_weights):
+    # resize the rows and then the columns, as two matrix multiplications
+    is_mask = pixels.ndim == 2
+    if is_mask:
+        pixels = pixels[:, :, np.newaxis]
+
+    resized = np.tensordot(row_weights, pixels, axes=(1, 0))
+    resized = np.tensordot(column_weights, resized, axes=(1, 1)).transpose(1, 0, 2)
+
+    return resized[:, :, 0] if is_mask else resized
+
+
+def resize(pixels, width, height):
+    """Resize pixels (or a mask), averaging the pixels that are combined when making it smaller"""
+    if pixels.shape[1] == width and pixels.shape[0] == height:
+        return pixels
+    return resize_with_weights(pixels.astype(np.float32, copy=False), get_area_weights(pixels.shape[0], height), get_area_weights(pixels.shape[1], width))
+
+
+def get_size_within(width, height, max_pixels, multiple=1):
+    """Get the largest size with the same aspect ratio that's at most max_pixels (rounded down to a multiple)"""
+    if width * height <= max_pixels:
+        return width, height
+    scale = math.sqrt(max_pixels / (width * height))
+    return max(multiple, int(width * scale) // multiple * multiple), max(multiple, int(height * scale) // multiple * multiple)
+
+
+def downscale_to_max_pixels(pixels, max_pixels, multiple=1):
+    """Make pixels small enough for a backend (e.g. max_pixels=sd_backend.max_image_size())"""
+    height, width = pixels.shape[:2]
+    new_width, new_height = get_size_within(width, height, max_pixels, multiple)
+    return resize(pixels, new_width, new_height)
+
+
+# encoding
+def png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def encode_png(pixels, flip=True):
+    """Encode 8 bit (height, width, channels) pixels as a PNG, in memory. If flip is True, the pixels are bottom row first, like Blender's"""
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+    if flip:
+        pixels = pixels[::-1]
+
+    height, width, channels = pixels.shape
+    if channels not in PNG_COLOR_TYPES:
+        raise ValueError(f"Can't encode an image with {channels} channels as a PNG")
+
+    # each row starts with its filter type (0, for none)
+    rows = np.empty((height, 1 + width * channels), dtype=np.uint8)
+    rows[:, 0] = 0
+    rows[:, 1:] = pixels.reshape(height, width * channels)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[channels], 0, 0, 0)
+    return b"".join([
+        PNG_SIGNATURE,
+        png_chunk(b"IHDR", header),
+        png_chunk(b"IDAT", zlib.compress(rows.tobytes(), PNG_COMPRESSION_LEVEL)),
+        png_chunk(b"IEND", b""),
+    ])
+
+
+def encode_with_blender(pixels, file_format):
+    # for the formats we can't encode ourselves (e.g. WEBP), hand the pixels to Blender
+    # in a temporary image, and let it save them
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+    height, width, channels = pixels.shape
+
+    rgba = np.full((height, width, 4), 255, dtype=np.float32)
+    rgba[..., :3] = pixels[..., :3] if channels >= 3 else pixels[..., :1]
+    if channels in (2, 4):
+        rgba[..., 3] = pixels[..., -1]
+
+    image = bpy.data.images.new("AIR Encoded Image", width, height, alpha=True)
+    temp_file = None
+    try:
+        image.pixels.foreach_set((rgba / 255).ravel())
+        temp_file = utils.create_temp_file("ai-render-encoded-", suffix=f".{file_format.lower()}")
+        image.filepath_raw = temp_file
+        image.file_format = file_format
+        image.save()
+        with open(temp_file, 'rb') as file:
+            return file.read()
+    finally:
+        bpy.data.images.remove(image)
+        if temp_file:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+
+
+def encode_image(pixels, file_format='PNG', flip=True):
+    """Encode 8 bit pixels in a backend's image format (e.g. sd_backend.get_image_format()). PNGs are encoded in memory,
+    and other formats (e.g. WEBP) are encoded by Blender"""
+    if file_format == 'PNG':
+        return encode_png(pixels, flip)
+
+    # Blender's images are already bottom row first
+    return encode_with_blender(pixels if flip else pixels[::-1], file_format)
@@ -2,10 +2,22 @@ import bpy
 from . import (
     addon_updater_ops,
     config,
+    http_sessions,
     operators,
     properties,
     utils,
 )
+from .sd_backends import automatic1111_server_pool
+
+
+def update_preferences_snapshot(self, context):
+    utils.update_preferences_snapshot(context)
+
+
+def update_server_pool(self, context):
+    # start over with the new list of servers (and check them all again)
+    utils.update_preferences_snapshot(context)
+    automatic1111_server_pool.reset()
 
 
 class AIRPreferences(bpy.types.AddonPreferences):
@@ -54,6 +66,20 @@ class AIRPreferences(bpy.types.AddonPreferences):
         default="http://127.0.0.1:7860",
     )
 
+    use_local_sd_server_pool: bpy.props.BoolProperty(
+        name="Use a Server Pool",
+        description="Spread requests across several Automatic1111 servers, instead of only using the one URL above",
+        default=False,
+        update=update_server_pool,
+    )
+
+    local_sd_server_pool: bpy.props.StringProperty(
+        name="Server Pool",
+        description="Comma separated list of Automatic1111 server URLs. Add *N after a URL to let that server run N images at once (e.g. http://192.168.1.10:7860*2, http://192.168.1.11:7860). All servers should have the same models installed",
+        default="",
+        update=update_server_pool,
+    )
+
     local_sd_timeout: bpy.props.IntProperty(
         name="Timeout (in seconds)",
         description="How long to wait for your local Stable Diffusion installation to run (in seconds, per image)",
@@ -62,6 +88,44 @@ class AIRPreferences(bpy.types.AddonPreferences):
         max=3600,
     )
 
+    use_result_cache: bpy.props.BoolProperty(
+        name="Cache Generated Images",
+        description="Keep generated images on disk, and reuse them when the exact same image is generated again with a fixed seed (e.g. re-rendering an animation where only some frames changed)",
+        default=False,
+    )
+
+    result_cache_path: bpy.props.StringProperty(
+        name="Cache Location",
+        description="The folder to keep cached images in. Leave this empty to use a folder in your system's temp directory",
+        default="",
+        subtype="DIR_PATH",
+    )
+
+    result_cache_max_size: bpy.props.IntProperty(
+        name="Max Cache Size (MB)",
+        description="When the cache gets bigger than this, the least recently used images are removed",
+        default=1024,
+        min=10,
+        max=100000,
+    )
+
+    output_image_history: bpy.props.IntProperty(
+        name="Images to Keep in Blender",
+        description="How many of the most recent generated images to keep loaded in Blender. Older ones are replaced (their files aren't deleted), so long animations don't fill up memory and the blend file",
+        default=1,
+        min=1,
+        max=50,
+    )
+
+    temp_files_max_size: bpy.props.IntProperty(
+        name="Max Temp Files Size (MB)",
+        description="When AI Render's temp files (renders, generated images and upscales) get bigger than this, the least recently used ones are removed. The last generated image is always kept",
+        default=2048,
+        min=100,
+        max=100000,
+        update=update_preferences_snapshot,
+    )
+
     is_opted_out_of_analytics: bpy.props.BoolProperty(
         name="Opt out of analytics",
         description="If this is checked, the add-on will not send or store any analytics data",
@@ -176,6 +240,15 @@ class AIRPreferences(bpy.types.AddonPreferences):
                 col = row.column()
                 col.prop(self, "local_sd_timeout", text="")
 
+                row = box.row()
+                row.prop(self, "use_local_sd_server_pool")
+
+                if self.use_local_sd_server_pool:
+                    row = box.row()
+                    row.prop(self, "local_sd_server_pool", text="")
+
+                    utils.label_multiline(box, text="Requests will go to whichever server is least busy. Add *N after a URL to let it run N images at once. Models are still loaded from the URL above.", width=width_guess)
+
                 box.separator()
                 utils.label_multiline(box, text=f"AI Render will use your local Stable Diffusion installation. Please make sure the Web UI is launched and running in a terminal.", icon="KEYTYPE_BREAKDOWN_VEC", width=width_guess)
 
@@ -220,6 +293,51 @@ class AIRPreferences(bpy.types.AddonPreferences):
 
             utils.label_multiline(box, text="AI image generation is an incredible technology, and it's only in its infancy. Please use it responsibly and ethically.", width=width_guess)
 
+            # Generated images
+            box = layout.box()
+            box.label(text="Generated Images:")
+
+            row = box.row()
+            col = row.column()
+            col.label(text="Images to Keep in Blender:")
+            col = row.column()
+            col.prop(self, "output_image_history", text="")
+
+            row = box.row()
+            col = row.column()
+            col.label(text="Max Temp Files Size (MB):")
+            col = row.column()
+            col.prop(self, "temp_files_max_size", text="")
+
+            # Result cache
+            box = layout.box()
+            box.label(text="Result Cache:")
+
+            row = box.row()
+            row.prop(self, "use_result_cache")
+
+            if self.use_result_cache:
+                row = box.row()
+                col = row.column()
+                col.label(text="Cache Location:")
+                col = row.column()
+                col.prop(self, "result_cache_path", text="")
+
+                row = box.row()
+                col = row.column()
+                col.label(text="Max Cache Size (MB):")
+                col = row.column()
+                col.prop(self, "result_cache_max_size", text="")
+
+                utils.label_multiline(box, text="Images are only reused when the seed is fixed. You can see how the cache is doing in AI Render's Advanced Options.", width=width_guess)
+
+            # Connection stats (to see how well connections are being reused)
+            connection_stats = http_sessions.get_stats_summary()
+            if connection_stats:
+                box = layout.box()
+                box.label(text="Connections:")
+                utils.label_multiline(box, text=connection_stats, width=width_guess)
+
             box = layout.box()
             box.label(text="Analytics:")
             utils.label_multiline(box, text="AI Render sends anonymous meta information to Google Analytics, to help improve the add-on. No prompt text or images are sent or stored in any way.", width=width_guess)
@@ -247,7 +365,16 @@ def register():
     for cls in classes:
         bpy.utils.register_class(cls)
 
+    # copy the preferences now, for the threads that can't read them (the add-on's
+    # preferences aren't always available yet while it's being enabled)
+    try:
+        utils.update_preferences_snapshot()
+    except (AttributeError, KeyError):
+        pass
+
 
 def unregister():
     for cls in classes:
         bpy.utils.unregister_class(cls)
+
+    automatic1111_server_pool.reset()
@@ -0,0 +1,163 @@
+import bisect
+import hashlib
+import re
+
+
+# animated prompts are written as lines of "frame: prompt" (with an optional "Negative:"
+# line, followed by the negative prompts). They're compiled once into a timeline, which
+# is kept until the text (or anything else that changes the prompts) changes, so getting
+# the prompts for a frame doesn't mean parsing the whole text again.
+#
+# A prompt can also blend in from the one before it over a range of frames, written as
+# "start-end: prompt" (or over a default number of frames, for every prompt). During the
+# blend, both prompts are given with weights, e.g. [("a castle", 0.75), ("a ruin", 0.25)],
+# for the backends that support weighted prompts. The weights are precomputed in one
+# pass for all the frames being rendered.
+
+PROMPT_LINE_REGEX = re.compile(r'^(\d+)(?:\s*-\s*(\d+))?:(.*)')
+NEGATIVE_SEPARATOR = "negative:"
+
+# how precisely the blend weights are given to the backends
+WEIGHT_DECIMALS = 2
+
+
+# private
+cached_key = None
+cached_timeline = None
+
+
+class PromptTrack:
+    """One list of prompts (positive or negative), sorted by the frame they start on"""
+
+    def __init__(self, keys):
+        self.start_frames = [start_frame for start_frame, _, _ in keys]
+        self.end_frames = [end_frame for _, end_frame, _ in keys]
+        self.prompts = [prompt for _, _, prompt in keys]
+
+    def find_index(self, frame):
+        # the prompt that starts on or most recently before this frame (the last one, if
+        # several start on the same frame)
+        return bisect.bisect_right(self.start_frames, frame) - 1
+
+    def get_weighted_prompts(self, index, frame):
+        """Get the [(prompt, weight), ...] for a frame, given the index of the prompt it's in"""
+        if index < 0:
+            return [("", 1.0)]
+
+        # blend in from the previous prompt, if we're in this prompt's blend range
+        start_frame, end_frame = self.start_frames[index], self.end_frames[index]
+        if index > 0 and frame < end_frame:
+            weight = round((frame - start_frame) / (end_frame - start_frame), WEIGHT_DECIMALS)
+            if weight <= 0:
+                return [(self.prompts[index - 1], 1.0)]
+            if weight < 1:
+                return [(self.prompts[index - 1], round(1 - weight, WEIGHT_DECIMALS)), (self.prompts[index], weight)]
+
+        return [(self.prompts[index], 1.0)]
+
+
+class PromptTimeline:
+    """The prompts from the animated prompt text, with the frames they start (and finish blending in) on"""
+
+    def __init__(self, prompt_keys, negative_prompt_keys):
+        self.track = PromptTrack(prompt_keys)
+        self.negative_track = PromptTrack(negative_prompt_keys)
+
+    def is_empty(self):
+        return not self.track.prompts
+
+    def get_prompts(self, frame):
+        """Get the prompts for a frame, as a dict that can be given to sd_generate"""
+        return get_prompts_dict(
+            self.track.get_weighted_prompts(self.track.find_index(frame), frame),
+            self.negative_track.get_weighted_prompts(self.negative_track.find_index(frame), frame),
+        )
+
+    def get_prompts_for_frames(self, frames):
+        """Get the prompts for a lot of frames at once (walking through the timeline once, instead of looking up each frame)"""
+        prompts_for_frames = {}
+        indices = {self.track: -1, self.negative_track: -1}
+
+        for frame in sorted(set(frames)):
+            for track, index in indices.items():
+                while index + 1 < len(track.start_frames) and track.start_frames[index + 1] <= frame:
+                    index += 1
+                indices[track] = index
+
+            prompts_for_frames[frame] = get_prompts_dict(
+                self.track.get_weighted_prompts(indices[self.track], frame),
+                self.negative_track.get_weighted_prompts(indices[self.negative_track], frame),
+            )
+
+        return prompts_for_frames
+
+
+def get_prompts_dict(weighted_prompts, weighted_negative_prompts):
+    # the plain prompts are the ones with the most weight, for the backends that can't
+    # use weighted prompts (and for everything else that just needs one prompt)
+    prompts = {
+        "prompt": max(weighted_prompts, key=lambda prompt: prompt[1])[0],
+        "negative_prompt": max(weighted_negative_prompts, key=lambda prompt: prompt[1])[0],
+    }
+    if len(weighted_prompts) > 1:
+        prompts["prompt_weights"] = weighted_prompts
+    if len(weighted_negative_prompts) > 1:
+        prompts["negative_prompt_weights"] = weighted_negative_prompts
+    return prompts
+
+
+def parse_lines(lines, format_prompt=None, blend_frames=0):
+    keys = []
+    for line in lines:
+        match = PROMPT_LINE_REGEX.match(line)
+        if match:
+            start_frame = int(match.group(1))
+            end_frame = int(match.group(2)) if match.group(2) else start_frame + blend_frames
+            prompt = match.group(3).strip()
+            if format_prompt:
+                prompt = format_prompt(prompt)
+            keys.append((start_frame, max(start_frame, end_frame), prompt))
+
+    # (an empty negative prompt is fine, and clears the negative prompt from that frame on)
+    if format_prompt:
+        keys = [key for key in keys if key[2] != ""]
+
+    if keys:
+        keys.sort(key=lambda key: key[0])
+        keys[0] = (1, 1, keys[0][2]) # ensure the first frame is 1 (with nothing to blend from)
+
+    return keys
+
+
+# public methods
+def compile_timeline(text, format_prompt=None, blend_frames=0):
+    """Compile the animated prompt text into a timeline. format_prompt (if given) is applied to each positive prompt, and
+    blend_frames is how long prompts blend in for (unless they have their own range)"""
+    lines = [line.strip() for line in text.splitlines()]
+
+    # split at the first "Negative:" line, if there is one
+    negative_index = next((i for i, line in enumerate(lines) if line.lower() == NEGATIVE_SEPARATOR), None)
+    if negative_index is not None:
+        positive_lines = lines[:negative_index]
+        negative_lines = lines[negative_index + 1:]
+    else:
+        positive_lines = lines
+        negative_lines = []
+
+    return PromptTimeline(parse_lines(positive_lines, format_prompt, blend_frames), parse_lines(negative_lines, blend_frames=blend_frames))
+
+
+def get(text, format_prompt=None, format_key=None, blend_frames=0):
+    """Get the compiled timeline for the animated prompt text, reusing the last one if the text (and format_key) haven't changed"""
+    global cached_key, cached_timeline
+
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest(), format_key, blend_frames
+    if key != cached_key:
+        cached_timeline = compile_timeline(text, format_prompt, blend_frames)
+        cached_key = key
+    return cached_timeline
+
+
+def clear_cache():
+    global cached_key, cached_timeline
+    cached_key = cached_timeline = None
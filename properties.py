@@ -73,7 +73,25 @@ def ensure_properties(self, context):
     ensure_sampler(context)
     ensure_upscaler_model(context)
 
+
 class AIRControlnet(bpy.types.PropertyGroup):
+    input_source: bpy.props.EnumProperty(
+        name="Controlnet Input",
+        items=(
+            ('IMAGE', "Image", "Use an image", 0),
+            ('DEPTH', "Depth Pass", "Use the depth (Z) pass of the frame that was just rendered", 1),
+            ('NORMAL', "Normal Pass", "Use the normal pass of the frame that was just rendered", 2),
+            ('MIST', "Mist Pass", "Use the mist pass of the frame that was just rendered", 3),
+            ('AOV', "AOV", "Use an AOV (e.g. for segmentation) of the frame that was just rendered", 4),
+        ),
+        default='IMAGE',
+        description="Where the ControlNet input image comes from. A render pass gives every frame of an animation its own input",
+    )
+    aov_name: bpy.props.StringProperty(
+        name="Controlnet AOV",
+        default="",
+        description="The name of the AOV to use (it has to exist in the view layer's Shader AOVs)",
+    )
     image: bpy.props.PointerProperty(type=bpy.types.Image)
     preprocessor: bpy.props.EnumProperty(name="Controlnet Preprocessor", items=get_available_controlnet_modules)
     model: bpy.props.EnumProperty(name="Controlnet Model", items=get_available_controlnet_models)
@@ -142,6 +160,13 @@ class AIRProperties(bpy.types.PropertyGroup):
         max=150,
         description="How long to process the image. Values in the range of 25-50 generally work well. Higher values take longer (and use more credits) and may or may not improve results",
     )
+    batch_size: bpy.props.IntProperty(
+        name="Variations",
+        default=1,
+        min=1,
+        max=8,
+        description="How many variations of the image to generate at once (in a single request, with different seeds). You can choose which one to use afterwards. Variations aren't upscaled automatically, and animations always generate one image per frame",
+    )
     sd_available_models: bpy.props.StringProperty(
         name="Stable Diffusion Models",
         default="",
@@ -203,6 +228,16 @@ class AIRProperties(bpy.types.PropertyGroup):
         default="",
         description="The full path and filename of the last image generated from Stable Diffusion (before any upscaling)",
     )
+    variation_files: bpy.props.StringProperty(
+        name="Variations",
+        default="",
+        description="Internal property to keep track of the image files from the last batch of variations",
+    )
+    selected_variation: bpy.props.IntProperty(
+        name="Selected Variation",
+        default=0,
+        description="Internal property to keep track of which variation from the last batch is being used",
+    )
     upscale_factor: bpy.props.FloatProperty(
         name="Upscale Factor",
         default=4.0,
@@ -224,11 +259,21 @@ class AIRProperties(bpy.types.PropertyGroup):
         items=get_available_upscaler_models,
         description="Which upscaler model to use",
     )
+    use_local_upscaler: bpy.props.BoolProperty(
+        name="Upscale Locally",
+        default=False,
+        description="When true, will upscale on this computer (on the CPU, with no network or GPU needed) instead of with the backend. Backends that can't upscale always upscale locally",
+    )
     automatic1111_tiling: bpy.props.BoolProperty(
         name="Automatic1111 Tiling",
         default=False,
         description="When true, will check the tiling option in the Automatic1111",
     )
+    automatic1111_live_preview: bpy.props.BoolProperty(
+        name="Live Preview",
+        default=False,
+        description="When true, will show the image while Automatic1111 is generating it (this downloads a preview every few seconds)",
+    )
     automatic1111_available_upscaler_models: bpy.props.StringProperty(
         name="Automatic1111 Upscaler Models",
         default="Lanczos||||Nearest||||ESRGAN_4x||||LDSR||||ScuNET GAN||||ScuNET PSNR||||SwinIR 4x",
@@ -240,6 +285,53 @@ class AIRProperties(bpy.types.PropertyGroup):
         description="The path to save the animation",
         subtype="DIR_PATH",
     )
+    animation_pipeline_depth: bpy.props.IntProperty(
+        name="Frames in Flight",
+        default=1,
+        min=1,
+        max=4,
+        description="How many animation frames can be waiting on Stable Diffusion at once. With more than 1, the next frames are rendered while earlier frames are still being generated, which can be much faster (especially with a local backend). Frames may finish out of order",
+    )
+    animation_frame_retries: bpy.props.IntProperty(
+        name="Retries",
+        default=2,
+        min=0,
+        max=10,
+        description="How many times to retry a frame that fails (e.g. because of a timeout, or the server restarting) before stopping the animation. Each retry waits longer than the last",
+    )
+    animation_skip_unchanged_frames: bpy.props.BoolProperty(
+        name="Skip Unchanged Frames",
+        default=False,
+        description="When re-rendering an animation, don't send frames to Stable Diffusion again if their render, prompts, seed and settings are exactly the same as last time (and the frame's image still exists). A manifest is saved with the animation frames to keep track of this",
+    )
+    animation_use_sharding: bpy.props.BoolProperty(
+        name="Share Frames with Other Instances",
+        default=False,
+        description="When true, several Blender instances (e.g. render farm nodes) can render the same animation at once. Each frame is claimed with a lock file in the animation output path, so no frame is rendered twice",
+    )
+    animation_shard_index: bpy.props.IntProperty(
+        name="Shard",
+        default=1,
+        min=1,
+        description="Which share of the frames this instance starts with (each instance should use a different shard). Once its own frames are done, it helps with any frames that haven't been claimed yet",
+    )
+    animation_shard_count: bpy.props.IntProperty(
+        name="Shards",
+        default=1,
+        min=1,
+        description="How many shares to split the frames into (usually the number of instances)",
+    )
+    animation_shard_frames: bpy.props.StringProperty(
+        name="Frames",
+        default="",
+        description="An explicit list of frames to render, like \"1-10, 15, 20-30\". Leave this empty to use the scene's frame range",
+    )
+    animation_claim_timeout: bpy.props.IntProperty(
+        name="Claim Timeout",
+        default=600,
+        min=30,
+        description="How long (in seconds) a frame's claim can go without being refreshed before it's assumed that the instance rendering it has crashed, and another instance takes it over",
+    )
     animation_init_frame: bpy.props.IntProperty(
         name="Initial Animtion Frame",
         default=1,
@@ -250,6 +342,13 @@ class AIRProperties(bpy.types.PropertyGroup):
         default=False,
         description="When true, will use the prompts from a text file to animate the image",
     )
+    animated_prompts_blend_frames: bpy.props.IntProperty(
+        name="Blend Frames",
+        default=0,
+        min=0,
+        soft_max=120,
+        description="How many frames each animated prompt takes to blend in from the one before it (0 switches prompts instantly). A prompt written with a range of frames, like \"60-90: prompt\", blends over that range instead. Blending needs a backend that supports weighted prompts (Automatic1111 or DreamStudio); other backends switch to the next prompt halfway through the blend",
+    )
     is_rendering: bpy.props.BoolProperty(
         name="Is Rendering",
         default=False,
@@ -290,12 +389,58 @@ class AIRProperties(bpy.types.PropertyGroup):
         default="",
         description="The name of the segmentation map image to use as input to ControlNet",
     )
+    render_pass_changes: bpy.props.StringProperty(
+        name="Render Pass Changes",
+        default="",
+        description="The scene settings that were changed to read a render pass (as JSON), so they can be put back once no pass is needed",
+    )
+    use_tiled_generation: bpy.props.BoolProperty(
+        name="Generate Large Images in Tiles",
+        default=False,
+        description="When the image is too large for the backend, generate it from the render in overlapping tiles (which are sent at the same time), and blend them back together",
+    )
+    tiled_generation_overlap: bpy.props.IntProperty(
+        name="Tile Overlap",
+        min=16,
+        max=512,
+        default=128,
+        description="How many pixels the tiles overlap by. The tiles fade into each other across the overlap, to hide the seams",
+    )
+    inpaint_mask_source: bpy.props.EnumProperty(
+        name="Inpaint Mask Source",
+        items=(
+            ('FILE', "File", "Use a mask image file", 0),
+            ('ALPHA', "Render Alpha", "Inpaint the transparent parts of the last render (with Film > Transparent turned on)", 1),
+            ('OBJECT_INDEX', "Object Index", "Inpaint the objects in the last render with a certain pass index", 2),
+        ),
+        default='FILE',
+        description="Where the inpaint mask comes from",
+    )
     inpaint_mask_path: bpy.props.StringProperty(
         name="Inpaint Mask Path",
         default="",
         description="Upload Inpaint Mask",
         subtype="FILE_PATH",
     )
+    inpaint_mask_object_index: bpy.props.IntProperty(
+        name="Inpaint Mask Object Index",
+        min=0,
+        max=32767,
+        default=1,
+        description="Inpaint the objects with this pass index (set in Object Properties > Relations)",
+    )
+    inpaint_mask_invert: bpy.props.BoolProperty(
+        name="Invert Mask",
+        default=False,
+        description="Inpaint everything except the masked area",
+    )
+    inpaint_mask_feather: bpy.props.IntProperty(
+        name="Inpaint Mask Feather",
+        min=0,
+        max=64,
+        default=4,
+        description="How many pixels to soften the edges of the mask by (for a mask made from the last render)",
+    )
     inpaint_full_res: bpy.props.BoolProperty(
         name="Inpaint at Full Resolution",
         default=True,
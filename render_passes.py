@@ -0,0 +1,302 @@
+import base64
+import hashlib
+import json
+import bpy
+import numpy as np
+from . import (
+    encoded_image,
+    json_stream,
+    operators,
+    pixel_utils,
+    utils,
+)
+
+
+# a ControlNet unit can use one of the render's passes (depth, normal, mist, or an AOV,
+# e.g. for segmentation) instead of a fixed image, so every frame of an animation gets
+# its own control image. The inpaint mask can also be made from the render's alpha or
+# object index pass. Python can't read the passes from the Render Result, so the pass
+# is shown in a compositor viewer node, and read from the viewer's image after the render.
+# It's normalized and encoded in memory, without saving it to disk.
+#
+# The pass is only set up when a render needs one (at the start of the render). The scene
+# settings that were changed for it are remembered, and put back (and the viewer node is
+# removed) at the start of the next render that doesn't need a pass.
+#
+# NOTE: There's only one viewer image, so only one pass can be read after each render.
+# All the ControlNet units that use a render pass have to use the same one.
+
+VIEWER_NODE_NAME = "AIR Render Pass Viewer"
+VIEWER_IMAGE_NAME = "Viewer Node"
+
+# the Render Layers node outputs, and the view layer settings that enable them
+PASS_OUTPUTS = {
+    'DEPTH': ["Depth", "Z"],
+    'NORMAL': ["Normal"],
+    'MIST': ["Mist"],
+    'ALPHA': ["Alpha"],
+    'OBJECT_INDEX': ["IndexOB"],
+}
+PASS_SETTINGS = {
+    'DEPTH': "use_pass_z",
+    'NORMAL': "use_pass_normal",
+    'MIST': "use_pass_mist",
+    'OBJECT_INDEX': "use_pass_object_index",
+}
+
+# the depth of the background (where there's nothing rendered)
+BACKGROUND_DEPTH = 1e9
+
+# the color of a normal pointing straight at the camera (used for the background)
+FLAT_NORMAL_COLOR = (0.5, 0.5, 1.0)
+
+
+def get_pass_key(controlnet_unit):
+    return controlnet_unit.input_source, controlnet_unit.aov_name if controlnet_unit.input_source == 'AOV' else ""
+
+
+def get_pass_name(pass_key):
+    input_source, aov_name = pass_key
+    return f"the \"{aov_name}\" AOV" if input_source == 'AOV' else f"the {input_source.lower().replace('_', ' ')} pass"
+
+
+def get_pass_units(props):
+    return [controlnet_unit for controlnet_unit in props.control_nets if controlnet_unit.input_source != 'IMAGE']
+
+
+def get_viewer_pass_key(scene):
+    # the pass to show in the viewer, for whatever the active backend will need after the render
+    props = scene.air_props
+    if utils.sd_backend() == "automatic1111":
+        pass_keys = set(get_pass_key(controlnet_unit) for controlnet_unit in get_pass_units(props))
+        return pass_keys.pop() if len(pass_keys) == 1 else None
+    elif utils.get_active_backend().supports_inpainting() and props.inpaint_mask_source != 'FILE':
+        return props.inpaint_mask_source, ""
+    else:
+        return None
+
+
+def get_render_layers_node(node_tree):
+    for node in node_tree.nodes:
+        if node.type == 'R_LAYERS':
+            return node
+    return node_tree.nodes.new('CompositorNodeRLayers')
+
+
+def get_pass_output(render_layers_node, pass_key):
+    input_source, aov_name = pass_key
+    output_names = [aov_name] if input_source == 'AOV' else PASS_OUTPUTS[input_source]
+    for name in output_names:
+        output = render_layers_node.outputs.get(name)
+        if output and output.enabled:
+            return output
+    return None
+
+
+def normalize_depth(pixels):
+    # near is white and far is black, like the depth maps ControlNet is trained on
+    depth = pixels[..., 0]
+    is_rendered = np.isfinite(depth) & (depth < BACKGROUND_DEPTH)
+
+    normalized = np.zeros_like(depth)
+    if is_rendered.any():
+        near, far = depth[is_rendered].min(), depth[is_rendered].max()
+        normalized[is_rendered] = 1 - (depth[is_rendered] - near) / max(far - near, 1e-6)
+
+    return np.repeat(normalized[..., np.newaxis], 3, axis=2)
+
+
+def normalize_normals(pixels, camera):
+    # Blender's normals are in world space, but ControlNet expects them relative to the
+    # camera (x to the right, y up, and z towards the camera), mapped from -1..1 to 0..1
+    normals = pixels[..., :3]
+    if camera:
+        rotation = np.array(camera.matrix_world.to_3x3().normalized(), dtype=np.float32)
+        normals = normals @ rotation
+
+    colors = normals * 0.5 + 0.5
+    colors[~np.any(pixels[..., :3] != 0, axis=2)] = FLAT_NORMAL_COLOR
+    return colors
+
+
+def normalize_mist(pixels):
+    # mist goes from 0 (near) to 1 (far), so flip it to match a depth map
+    return np.repeat(1 - pixels[..., :1], 3, axis=2)
+
+
+def normalize_pass(input_source, pixels, scene):
+    if input_source == 'DEPTH':
+        return normalize_depth(pixels)
+    elif input_source == 'NORMAL':
+        return normalize_normals(pixels, scene.camera)
+    elif input_source == 'MIST':
+        return normalize_mist(pixels)
+    else:
+        return pixel_utils.rgba_to_rgb(pixels)
+
+
+def get_changes(scene):
+    # the settings we've changed in the scene, so they can be put back
+    try:
+        return json.loads(scene.air_props.render_pass_changes)
+    except ValueError:
+        active_node = scene.node_tree.nodes.active if scene.node_tree else None
+        return {
+            "use_nodes": scene.use_nodes,
+            "use_compositing": scene.render.use_compositing,
+            "active_node": active_node.name if active_node else None,
+            "passes": [],
+        }
+
+
+def set_changes(scene, changes):
+    scene.air_props.render_pass_changes = json.dumps(changes) if changes else ""
+
+
+def revert_passes(scene, changes, keep=None):
+    # turn off the passes we turned on (other than the one to keep)
+    for view_layer_name, setting in list(changes["passes"]):
+        if [view_layer_name, setting] == keep:
+            continue
+        view_layer = scene.view_layers.get(view_layer_name)
+        if view_layer:
+            setattr(view_layer, setting, False)
+        changes["passes"].remove([view_layer_name, setting])
+
+
+def enable_pass(changes, view_layer, setting):
+    if not getattr(view_layer, setting):
+        setattr(view_layer, setting, True)
+        changes["passes"].append([view_layer.name, setting])
+
+
+def read_pass(scene, pass_key):
+    # read the pass from the viewer image (if the viewer is showing the right pass), as
+    # pixels that are only valid until the next pass is read
+    viewer_node = scene.node_tree.nodes.get(VIEWER_NODE_NAME) if scene.use_nodes and scene.node_tree else None
+    link = viewer_node.inputs[0].links[0] if viewer_node and viewer_node.inputs[0].links else None
+    viewer_image = bpy.data.images.get(VIEWER_IMAGE_NAME)
+    if (
+        not link
+        or link.from_node.type != 'R_LAYERS'
+        or get_pass_output(link.from_node, pass_key) != link.from_socket
+        or not viewer_image
+        or tuple(viewer_image.size) == (0, 0)
+    ):
+        return None
+
+    return pixel_utils.get_image_pixels(viewer_image, reuse_buffer=True)
+
+
+# public methods
+def setup(scene):
+    """Enable the render pass that will be needed after the render (for ControlNet or the inpaint mask), and show it in
+    our viewer node, so it can be read after the render"""
+    pass_key = get_viewer_pass_key(scene)
+    if not pass_key:
+        teardown(scene)
+        return False
+
+    changes = get_changes(scene)
+    scene.use_nodes = True
+    scene.render.use_compositing = True
+    node_tree = scene.node_tree
+
+    # turn on the pass in the view layer that's being composited
+    render_layers_node = get_render_layers_node(node_tree)
+    view_layer = scene.view_layers.get(render_layers_node.layer) or scene.view_layers[0]
+    setting = PASS_SETTINGS.get(pass_key[0])
+    revert_passes(scene, changes, keep=[view_layer.name, setting] if setting else None)
+    if setting:
+        enable_pass(changes, view_layer, setting)
+    set_changes(scene, changes)
+
+    output = get_pass_output(render_layers_node, pass_key)
+    if not output:
+        print(f"AI Render: couldn't find {get_pass_name(pass_key)} in the render layers, for ControlNet")
+        return False
+
+    viewer_node = node_tree.nodes.get(VIEWER_NODE_NAME)
+    if not viewer_node:
+        viewer_node = node_tree.nodes.new('CompositorNodeViewer')
+        viewer_node.name = viewer_node.label = VIEWER_NODE_NAME
+        viewer_node.location = (render_layers_node.location.x + 400, render_layers_node.location.y - 400)
+
+    if not viewer_node.inputs[0].links or viewer_node.inputs[0].links[0].from_socket != output:
+        node_tree.links.new(output, viewer_node.inputs[0])
+
+    # only the active viewer node writes to the viewer image
+    node_tree.nodes.active = viewer_node
+    return True
+
+
+def teardown(scene):
+    """Remove our viewer node, and put back the scene settings that were changed to read a render pass"""
+    if scene.node_tree:
+        viewer_node = scene.node_tree.nodes.get(VIEWER_NODE_NAME)
+        if viewer_node:
+            scene.node_tree.nodes.remove(viewer_node)
+
+    if not scene.air_props.render_pass_changes:
+        return
+
+    changes = get_changes(scene)
+    revert_passes(scene, changes)
+    if scene.node_tree and changes["active_node"] in scene.node_tree.nodes:
+        scene.node_tree.nodes.active = scene.node_tree.nodes[changes["active_node"]]
+    scene.use_nodes = changes["use_nodes"]
+    scene.render.use_compositing = changes["use_compositing"]
+    set_changes(scene, None)
+
+
+def get_input_images(scene, controlnet_units):
+    """Read the render pass for each unit from the viewer image, and encode it for ControlNet. Returns a list of
+    Base64Data (one per unit), or False if there was an error"""
+    pass_keys = set(get_pass_key(controlnet_unit) for controlnet_unit in controlnet_units)
+    if len(pass_keys) > 1:
+        return operators.handle_error(scene, "All the ControlNet units that use a render pass have to use the same one", "controlnet_render_pass")
+    pass_key = pass_keys.pop()
+
+    pixels = read_pass(scene, pass_key)
+    if pixels is None:
+        return operators.handle_error(scene, f"Couldn't read {get_pass_name(pass_key)} for ControlNet. Please render again (and if you're using an AOV, make sure it exists in the view layer)", "controlnet_render_pass")
+
+    # the pass is only normalized and encoded once, no matter how many units use it
+    try:
+        pixels = pixel_utils.downscale_to_max_pixels(normalize_pass(pass_key[0], pixels, scene), utils.get_active_backend().max_image_size())
+        png = pixel_utils.encode_png(pixel_utils.to_uint8(pixels))
+    except Exception as e:
+        print(e)
+        return operators.handle_error(scene, f"Couldn't encode {get_pass_name(pass_key)} for ControlNet", "controlnet_render_pass")
+
+    input_image = json_stream.Base64Data(base64.b64encode(png), content_hash=hashlib.sha256(png).hexdigest())
+    return [input_image] * len(controlnet_units)
+
+
+def get_inpaint_mask(scene, width, height):
+    """Make the inpaint mask (at the given size) from the last render's alpha or object index pass. Returns an
+    EncodedImage, or False if there was an error"""
+    props = scene.air_props
+    pass_key = (props.inpaint_mask_source, "")
+
+    pixels = read_pass(scene, pass_key)
+    if pixels is None:
+        return operators.handle_error(scene, f"Couldn't read {get_pass_name(pass_key)} for the inpaint mask. Please render again", "inpaint_mask")
+
+    # (the viewer shows a single value pass in the color channels)
+    try:
+        if props.inpaint_mask_source == 'ALPHA':
+            mask = pixel_utils.mask_from_alpha(pixels[..., 0])
+        else:
+            mask = pixel_utils.mask_from_ids(pixels[..., 0], [props.inpaint_mask_object_index])
+
+        if props.inpaint_mask_invert:
+            mask = 1 - mask
+
+        mask = pixel_utils.feather(pixel_utils.resize(mask, width, height), props.inpaint_mask_feather)
+        png = pixel_utils.encode_png(pixel_utils.to_uint8(mask))
+    except Exception as e:
+        print(e)
+        return operators.handle_error(scene, "Couldn't make the inpaint mask", "inpaint_mask")
+
+    return encoded_image.EncodedImage(png, 'PNG', "inpaint-mask")
@@ -0,0 +1,175 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from . import (
+    json_stream,
+    utils,
+)
+
+
+# an on-disk cache of generated images, keyed by a hash of everything that went into
+# the request (params, input images and backend). With a fixed seed, generating the
+# same thing again just copies the cached image instead of calling the backend.
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# only files named like cache entries are ever counted or removed, in case the cache
+# location is set to a folder that has other files in it
+ENTRY_FILENAME_REGEX = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]+$")
+
+
+# private
+lock = threading.Lock()
+stats = {"hits": 0, "misses": 0}
+entries = {} # cache dir -> {filename: (size, last used)}, loaded the first time it's needed
+
+
+def hash_file(file, start=None):
+    hasher = hashlib.sha256()
+    if start is None:
+        start = file.tell()
+
+    file.seek(start)
+    while True:
+        chunk = file.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    file.seek(start)
+
+    return hasher.hexdigest()
+
+
+def canonical_value(obj):
+    # images in the params (e.g. ControlNet inputs) are keyed by their contents
+    if isinstance(obj, json_stream.Base64File):
+        return {"prefix": obj.prefix.decode(), "sha256": hash_file(obj.file, obj.start)}
+    if isinstance(obj, json_stream.Base64Data):
+        return {"prefix": obj.prefix.decode(), "sha256": obj.content_hash or hashlib.sha256(base64.b64decode(obj.encoded)).hexdigest()}
+    raise TypeError(f"Object of type {type(obj).__name__} can't be part of a cache key")
+
+
+def get_entries(cache_dir):
+    # NOTE: call this with the lock held
+    if cache_dir not in entries:
+        dir_entries = {}
+        if os.path.isdir(cache_dir):
+            for item in os.scandir(cache_dir):
+                if item.is_file() and ENTRY_FILENAME_REGEX.match(item.name):
+                    stat = item.stat()
+                    dir_entries[item.name] = (stat.st_size, stat.st_mtime)
+        entries[cache_dir] = dir_entries
+    return entries[cache_dir]
+
+
+def evict(cache_dir, max_size):
+    # NOTE: call this with the lock held
+    dir_entries = get_entries(cache_dir)
+    total_size = sum(size for size, last_used in dir_entries.values())
+
+    # remove the least recently used images until we're under the max size
+    for filename, (size, last_used) in sorted(dir_entries.items(), key=lambda item: item[1][1]):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            continue
+        del dir_entries[filename]
+        total_size -= size
+
+
+# public methods
+def get_key(backend_name, params, img_file=None):
+    """Get the cache key for a request: a hash of the backend, the params (in a canonical order) and the input image"""
+    hasher = hashlib.sha256()
+    hasher.update(backend_name.encode())
+    hasher.update(json.dumps(params, sort_keys=True, default=canonical_value).encode())
+    hasher.update(hash_file(img_file).encode() if img_file else b"text2image")
+    return hasher.hexdigest()
+
+
+def get(cache_dir, key, file_format, filename_prefix):
+    """Copy a cached image to a new temp file and return it, or return None if there isn't one"""
+    filename = f"{key}.{file_format.lower()}"
+    cached_file = os.path.join(cache_dir, filename)
+
+    with lock:
+        dir_entries = get_entries(cache_dir)
+        if filename not in dir_entries or not os.path.exists(cached_file):
+            dir_entries.pop(filename, None)
+            stats["misses"] += 1
+            return None
+
+        # mark the image as recently used
+        try:
+            os.utime(cached_file)
+            dir_entries[filename] = (dir_entries[filename][0], os.path.getmtime(cached_file))
+        except OSError:
+            pass
+
+        stats["hits"] += 1
+
+    try:
+        output_file = utils.create_temp_file(filename_prefix + "-")
+        shutil.copyfile(cached_file, output_file)
+        return output_file
+    except OSError:
+        return None
+
+
+def put(cache_dir, key, file_format, image_file, max_size):
+    """Store a generated image in the cache, evicting the least recently used images if it's over the max size"""
+    filename = f"{key}.{file_format.lower()}"
+    cached_file = os.path.join(cache_dir, filename)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # copy to a temp name and then rename, so a half written image is never read
+        partial_file = f"{cached_file}.{threading.get_ident()}.tmp"
+        shutil.copyfile(image_file, partial_file)
+        os.replace(partial_file, cached_file)
+    except OSError as e:
+        print(f"AI Render: couldn't store the image in the result cache ({e})")
+        return False
+
+    with lock:
+        get_entries(cache_dir)[filename] = (os.path.getsize(cached_file), os.path.getmtime(cached_file))
+        evict(cache_dir, max_size)
+
+    return True
+
+
+def get_stats(cache_dir):
+    with lock:
+        dir_entries = get_entries(cache_dir)
+        return {
+            "hits": stats["hits"],
+            "misses": stats["misses"],
+            "images": len(dir_entries),
+            "size": sum(size for size, last_used in dir_entries.values()),
+        }
+
+
+def get_stats_summary(cache_dir):
+    cache_stats = get_stats(cache_dir)
+    return f"{cache_stats['images']} images ({round(cache_stats['size'] / (1024 * 1024), 1)} MB), {cache_stats['hits']} hits, {cache_stats['misses']} misses"
+
+
+def clear(cache_dir):
+    with lock:
+        for filename in list(get_entries(cache_dir).keys()):
+            try:
+                os.remove(os.path.join(cache_dir, filename))
+            except OSError:
+                pass
+        entries.pop(cache_dir, None)
+        stats["hits"] = 0
+        stats["misses"] = 0
@@ -1,52 +1,67 @@
 import bpy
-import base64
+import functools
+import os
+import threading
 import requests
 from .. import (
+    cancellation,
     config,
+    controlnet_cache,
+    http_sessions,
+    json_stream,
     operators,
+    render_passes,
     utils,
+    worker_pool,
 )
+from . import (
+    automatic1111_progress,
+    automatic1111_server_pool,
+)
+
+
+INTERRUPT_PATH = "/sdapi/v1/interrupt"
+INTERRUPT_TIMEOUT = 10
+
+
+# private
+loading_paths = set() # the lists that are being loaded right now (only touched in the main thread)
+sent_requests = {} # server url -> our requests that have been sent to that server, oldest first
+sent_requests_lock = threading.Lock()
 
 
 # CORE FUNCTIONS:
 
-def generate(params, img_file, filename_prefix, props, is_text2image=False):
+def generate(params, img_file, filename_prefix, props, is_text2image=False, cancel_token=None):
 
     # map the generic params to the specific ones for the Automatic1111 API
     map_params(params)
+    batch_size = params.get("batch_size", 1)
 
-    # add a base 64 encoded image to the params
+    # add the image to the params (it's base 64 encoded as the request is sent)
     if not is_text2image:
-        params["init_images"] = ["data:image/png;base64," + base64.b64encode(img_file.read()).decode()]
-        img_file.close()
+        params["init_images"] = [json_stream.Base64File(img_file, "data:image/png;base64,")]
 
-    # add args for ControlNet if it's enabled
-    if props.control_nets:
-        map_controlnet_params(params, props)
-
-    # prepare the server url
-    try:
-        if is_text2image:
-            server_url = get_server_url("/sdapi/v1/txt2img")
-        else:
-            server_url = get_server_url("/sdapi/v1/img2img")
-    except:
-        return operators.handle_error(None, f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_LOCAL_INSTALLATION_URL})", "local_server_url_missing")
+    # NOTE: args for ControlNet are added to the params by map_controlnet_params() before
+    # this is called, because saving the ControlNet images needs to happen in the main thread
 
     # send the API request
-    response = do_post(server_url, params)
+    if is_text2image:
+        response = send_request("/sdapi/v1/txt2img", params, cancel_token, True, props.automatic1111_live_preview)
+    else:
+        response = send_request("/sdapi/v1/img2img", params, cancel_token, True, props.automatic1111_live_preview)
 
     if response == False:
         return False
 
     # handle the response
     if response.status_code == 200:
-        return handle_success(response, filename_prefix)
+        return handle_success(response, filename_prefix, batch_size, cancel_token)
     else:
         return handle_error(response)
 
 
-def upscale(img_file, filename_prefix, props):
+def upscale(img_file, filename_prefix, props, cancel_token=None):
 
     # prepare the params
     data = {
@@ -56,8 +71,8 @@ def upscale(img_file, filename_prefix, props):
         "codeformer_visibility": 0,
         "codeformer_weight": 0,
         "upscaling_resize": props.upscale_factor,
-        "upscaling_resize_w": utils.sanitized_upscaled_width(max_upscaled_image_size()),
-        "upscaling_resize_h": utils.sanitized_upscaled_height(max_upscaled_image_size()),
+        "upscaling_resize_w": props.upscaled_width,
+        "upscaling_resize_h": props.upscaled_height,
         "upscaling_crop": True,
         "upscaler_1": props.upscaler_model,
         "upscaler_2": "None",
@@ -65,18 +80,11 @@ def upscale(img_file, filename_prefix, props):
         "upscale_first": True,
     }
 
-    # add a base 64 encoded image to the params
-    data["image"] = "data:image/png;base64," + base64.b64encode(img_file.read()).decode()
-    img_file.close()
-
-    # prepare the server url
-    try:
-        server_url = get_server_url("/sdapi/v1/extra-single-image")
-    except:
-        return operators.handle_error(None, f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_LOCAL_INSTALLATION_URL})", "local_server_url_missing")
+    # add the image to the params (it's base 64 encoded as the request is sent)
+    data["image"] = json_stream.Base64File(img_file, "data:image/png;base64,")
 
     # send the API request
-    response = do_post(server_url, data)
+    response = send_request("/sdapi/v1/extra-single-image", data, cancel_token)
 
     # print log info for debugging
     # debug_log(response)
@@ -86,44 +94,38 @@ def upscale(img_file, filename_prefix, props):
 
     # handle the response
     if response.status_code == 200:
-        return handle_success(response, filename_prefix)
+        return handle_success(response, filename_prefix, cancel_token=cancel_token)
     else:
         return handle_error(response)
 
 
-def handle_success(response, filename_prefix):
+def handle_success(response, filename_prefix, batch_size=1, cancel_token=None):
 
-    # ensure we have the type of response we are expecting
-    try:
-        response_obj = response.json()
-        base64_img = response_obj.get("images", [False])[0] or response_obj.get("image")
-    except:
-        print("Automatic1111 response content: ")
-        print(response.content)
-        return operators.handle_error(None, "Received an unexpected response from the Automatic1111 Stable Diffusion server.", "unexpected_response")
-
-    # create a temp file
-    try:
-        output_file = utils.create_temp_file(filename_prefix + "-")
-    except:
-        return operators.handle_error(None, "Couldn't create a temp file to save image.", "temp_file")
+    # create a temp file for each image
+    def create_output_file(index):
+        return utils.create_temp_file(filename_prefix + (f"-{index + 1}-" if batch_size > 1 else "-"))
 
-    # decode base64 image
+    # decode the base64 images into the temp files as the response downloads, so the
+    # whole response never has to be held in memory. (ControlNet can add its detected
+    # maps after the generated images, so only take as many as we asked for.)
     try:
-        img_binary = base64.b64decode(base64_img.replace("data:image/png;base64,", ""))
-    except:
-        return operators.handle_error(None, "Couldn't decode base64 image from the Automatic1111 Stable Diffusion server.", "base64_decode")
-
-    # save the image to the temp file
-    try:
-        with open(output_file, 'wb') as file:
-            file.write(img_binary)
-    except:
+        output_files = json_stream.save_images_from_response(response, create_output_file, batch_size, cancel_token=cancel_token)
+    except cancellation.Cancelled:
+        # the request was cancelled, so there's no error to show
+        return False
+    except requests.exceptions.RequestException:
+        return operators.handle_error(None, "The connection to the Automatic1111 Stable Diffusion server was lost while downloading the image.", "unexpected_response")
+    except OSError:
         return operators.handle_error(None, "Couldn't write to temp file.", "temp_file_write")
+    except ValueError:
+        return operators.handle_error(None, "Couldn't decode base64 image from the Automatic1111 Stable Diffusion server.", "base64_decode")
 
+    # ensure we got the type of response we are expecting
+    if not output_files:
+        return operators.handle_error(None, "Received an unexpected response from the Automatic1111 Stable Diffusion server.", "unexpected_response")
 
-    # return the temp file
-    return output_file
+    # return the temp file (or all of them, for a batch)
+    return output_files if batch_size > 1 else output_files[0]
 
 
 def handle_error(response):
@@ -147,6 +149,10 @@ def handle_error(response):
 
 # PRIVATE SUPPORT FUNCTIONS:
 
+def get_session():
+    return http_sessions.get_session("automatic1111")
+
+
 def create_headers():
     return {
         "User-Agent": f"Blender/{bpy.app.version_string}",
@@ -167,24 +173,70 @@ def map_params(params):
     params["denoising_strength"] = round(1 - params["image_similarity"], 2)
     params["sampler_index"] = params["sampler"]
 
-def map_controlnet_params(params, props):
+    # blend weighted prompts with composable diffusion ("a :0.7 AND b :0.3"). The negative
+    # prompt can't be composed, so its prompts are blended with attention weights instead.
+    prompt_weights = params.pop("prompt_weights", None)
+    if prompt_weights:
+        params["prompt"] = " AND ".join(f"{text} :{weight}" for text, weight in prompt_weights)
+
+    negative_prompt_weights = params.pop("negative_prompt_weights", None)
+    if negative_prompt_weights:
+        params["negative_prompt"] = ", ".join(f"({text}:{weight})" for text, weight in negative_prompt_weights if text)
+
+    # generate every image in a batch in one pass
+    if params.get("batch_size", 1) > 1:
+        params["n_iter"] = 1
+
+def encode_controlnet_image(image):
+    try:
+        temp_file = utils.create_temp_file(image.name + "-")
+    except:
+        return operators.handle_error(None, "Couldn't create temp file for segmentation image", "temp_file")
+
+    try:
+        image.save_render(temp_file)
+        with open(temp_file, 'rb') as file:
+            data = file.read()
+    except Exception as e:
+        print(e)
+        return operators.handle_error(None, "Couldn't save segmentation image", "save_segmentation_image")
+
+    # the encoded image is kept in memory, so the file isn't needed anymore
+    try:
+        os.remove(temp_file)
+    except OSError:
+        pass
+
+    return data
+
+
+def map_controlnet_params(params, props, render_image=None):
+    # the units that use a render pass get it straight from the frame that was just rendered
+    pass_units = render_passes.get_pass_units(props)
+    pass_input_images = {}
+    if pass_units:
+        input_images = render_passes.get_input_images(props.id_data, pass_units)
+        if not input_images:
+            return False
+        pass_input_images = dict(zip([unit.as_pointer() for unit in pass_units], input_images))
+
     controlnet_args = []
     for controlnet_unit in props.control_nets:
-        try:
-            temp_file = utils.create_temp_file(controlnet_unit.image.name + "-")
-        except:
-            return handle_error("Couldn't create temp file for segmentation image", "temp_file")
-        
-        try:
-            controlnet_unit.image.save_render(temp_file)
-            img_file = open(temp_file, 'rb')
-        except Exception as e:
-            print(e)
-            return operators.handle_error(None, "Couldn't save segmentation image", "save_segmentation_image")
 
+        if controlnet_unit.as_pointer() in pass_input_images:
+            input_image = pass_input_images[controlnet_unit.as_pointer()]
+
+        # if this unit uses the render itself, share the render we've already encoded
+        elif render_image and controlnet_unit.image and controlnet_unit.image.type == 'RENDER_RESULT':
+            input_image = json_stream.Base64File(render_image.open())
+        else:
+            # reuse the encoded image from the last request, if the image hasn't changed
+            input_image = controlnet_cache.get_input_image(controlnet_unit.image, props.id_data, encode_controlnet_image)
+            if not input_image:
+                return False
 
         controlnet_args.append({
-            "input_image": base64.b64encode(img_file.read()).decode(),
+            "input_image": input_image,
             "weight": controlnet_unit.conditioning,
             "module": controlnet_unit.preprocessor,
             "model": controlnet_unit.model,
@@ -198,20 +250,121 @@ def map_controlnet_params(params, props):
             "pixel_perfect": controlnet_unit.pixel_perfect,
         })
 
-        img_file.close()
-
     params["alwayson_scripts"] = {
         "controlnet": {
             "args": controlnet_args
         }
     }
 
+    return True
 
-def do_post(url, data):
-    # send the API request
+
+def send_request(path, data, cancel_token=None, show_progress=False, show_preview=False):
+    # the body is streamed, so large images are base 64 encoded while they're sent
+    body = json_stream.JsonBody(data, cancel_token)
+
+    # while a server is generating the image, show its progress, and if the request is
+    # cancelled, tell that server to stop (the server has finished once we get its response)
+    request = object()
+    sent_to = []
+    interrupt_callbacks = []
+    progress_watchers = []
+    def on_send(base_url):
+        with sent_requests_lock:
+            sent_requests.setdefault(base_url, []).append(request)
+        sent_to.append(base_url)
+        if cancel_token:
+            # (registered before the post starts, so it runs before the connection is closed,
+            # while this request is still counted as sent to the server)
+            interrupt_callbacks.append(cancel_token.on_cancel(functools.partial(interrupt, base_url, request)))
+        if show_progress:
+            progress_watchers.append(automatic1111_progress.watch(base_url, create_headers(), show_preview))
+
+    try:
+        # if we're using a pool of servers, spread the requests across them
+        if utils.is_local_sd_server_pool_enabled():
+            return do_pool_post(path, body, on_send)
+
+        # prepare the server url
+        try:
+            server_url = get_server_url(path)
+        except:
+            return operators.handle_error(None, f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_LOCAL_INSTALLATION_URL})", "local_server_url_missing")
+
+        on_send(server_url[:-len(path)])
+        return do_post(server_url, body)
+    finally:
+        body.close()
+        for callback in interrupt_callbacks:
+            cancel_token.remove_callback(callback)
+        for watcher in progress_watchers:
+            automatic1111_progress.unwatch(watcher)
+        with sent_requests_lock:
+            for base_url in sent_to:
+                sent_requests[base_url].remove(request)
+                if not sent_requests[base_url]:
+                    del sent_requests[base_url]
+
+
+def is_generating(base_url, request):
+    # the server generates one image at a time, in the order the requests arrive, so our
+    # oldest request to a server is the one it's working on
+    with sent_requests_lock:
+        requests_sent = sent_requests.get(base_url)
+        return bool(requests_sent) and requests_sent[0] is request
+
+
+def interrupt(base_url, request):
+    """Ask the server to stop generating the current image, if it's working on this request.
+
+    NOTE: Automatic1111's interrupt stops whatever the server is generating. Requests from this instance are tracked,
+    so a request still waiting behind another of ours never interrupts it, but a server that's shared with other
+    clients (e.g. other Blender instances) could be working on one of theirs, and that would be stopped instead"""
+    if not is_generating(base_url, request):
+        # (the connection is closed, but the server will still generate it once it gets to it)
+        print(f"AI Render: not interrupting the Automatic1111 server at {base_url}, since it's working on another request")
+        return
+
+    try:
+        get_session().post(base_url + INTERRUPT_PATH, headers=create_headers(), timeout=INTERRUPT_TIMEOUT)
+        print(f"AI Render: asked the Automatic1111 server at {base_url} to stop generating")
+    except requests.exceptions.RequestException as e:
+        print(f"WARN: Couldn't ask the Automatic1111 server at {base_url} to stop generating ({e})")
+
+
+def create_post_headers():
+    return {**create_headers(), "Content-Type": "application/json"}
+
+
+def do_pool_post(path, body, on_send=None):
+    automatic1111_server_pool.configure(utils.local_sd_server_pool())
+
+    # send the API request to the least busy server in the pool
     try:
-        return requests.post(url, json=data, headers=create_headers(), timeout=utils.local_sd_timeout())
+        return automatic1111_server_pool.post(path, data=body, headers=create_post_headers(), timeout=utils.local_sd_timeout(), on_send=on_send, cancel_token=body.cancel_token, stream=True)
+    except cancellation.Cancelled:
+        # the request was cancelled, so there's no error to show
+        return False
+    except requests.exceptions.ConnectionError:
+        return operators.handle_error(None, f"None of the Automatic1111 servers in your server pool could be reached. Make sure they're running, and check the server pool in the add-on preferences. [Get help]({config.HELP_WITH_LOCAL_INSTALLATION_URL})", "local_server_not_found")
+    except requests.exceptions.MissingSchema:
+        return operators.handle_error(None, f"One of the urls in your Automatic1111 server pool is invalid. Please set them correctly in the add-on preferences. [Get help]({config.HELP_WITH_LOCAL_INSTALLATION_URL})", "local_server_url_invalid")
+    except requests.exceptions.Timeout:
+        return operators.handle_error(None, "Every Automatic1111 server in your server pool timed out. Set a longer timeout in AI Render preferences, or use a smaller image size.", "timeout")
+
+
+def do_post(url, body):
+    # send the API request (streaming the response, so handle_success can decode it as it downloads)
+    try:
+        # (if the request is cancelled while we wait for the response, the connection is closed)
+        with http_sessions.abort_on_cancel(body.cancel_token):
+            return get_session().post(url, data=body, headers=create_post_headers(), timeout=utils.local_sd_timeout(), stream=True)
+    except cancellation.Cancelled:
+        # the request was cancelled, so there's no error to show
+        return False
     except requests.exceptions.ConnectionError:
+        if body.cancel_token and body.cancel_token.is_cancelled():
+            return False
         return operators.handle_error(None, f"The local Stable Diffusion server couldn't be found. It's either not running, or it's running at a different location than what you specified in the add-on preferences. [Get help]({config.HELP_WITH_LOCAL_INSTALLATION_URL})", "local_server_not_found")
     except requests.exceptions.MissingSchema:
         return operators.handle_error(None, f"The url for your local Stable Diffusion server is invalid. Please set it correctly in the add-on preferences. [Get help]({config.HELP_WITH_LOCAL_INSTALLATION_URL})", "local_server_url_invalid")
@@ -300,9 +453,17 @@ def supports_choosing_model():
 def supports_upscaling():
     return True
 
+
+def supports_batches():
+    return True
+
 def supports_tiling():
     return True
 
+
+def supports_prompt_weights():
+    return True
+
 def supports_reloading_upscaler_models():
     return True
 
@@ -391,94 +552,128 @@ def choose_controlnet_defaults(context):
             context.scene.air_props.controlnet_module = module_selection
             return
 
-def load_sd_models(context):
+def fetch_list(path):
+    """Get a list (of models, etc.) from the Automatic1111 api. Returns None if it couldn't be loaded"""
+    # NOTE: This runs on a worker thread, so it must not touch any bpy data.
     try:
-        # get the list of available controlnet models from the Automatic1111 api
-        server_url = get_server_url("/sdapi/v1/sd-models")
+        server_url = get_server_url(path)
         headers = { "Accept": "application/json" }
-        response = requests.get(server_url, headers=headers, timeout=5)
-        response_obj = response.json()
+        response = get_session().get(server_url, headers=headers, timeout=5)
+        return response.json()
+    except Exception as e:
+        print(e)
+        return None
+
+
+def load_list(path, store):
+    """Get a list from the Automatic1111 api on a worker thread, and then store it (in the main thread)"""
+    # (repeated clicks while a list is loading only load it once)
+    if path in loading_paths:
+        return True
+    loading_paths.add(path)
+
+    # the worker thread reads the server url from the copy of the preferences
+    utils.update_preferences_snapshot()
+    worker_pool.submit(functools.partial(fetch_list, path), functools.partial(finish_loading_list, path, store))
+    return True
+
+
+def finish_loading_list(path, store, response_obj):
+    loading_paths.discard(path)
+    store(bpy.context.scene, response_obj)
+
+
+def store_sd_models(scene, response_obj):
+    try:
         print("Stable Diffusion models returned from Automatic1111 API:")
         print(response_obj)
 
         # store the list of models in the scene properties
         models = [model["title"] for model in response_obj]
         if not models:
-            return operators.handle_error(context.scene, f"You don't have any Stable Diffusion models installed. You will need to download them from Hugging Face")
+            return operators.handle_error(scene, f"You don't have any Stable Diffusion models installed. You will need to download them from Hugging Face")
         else:
-            context.scene.air_props.sd_available_models = "||||".join(models)
+            scene.air_props.sd_available_models = "||||".join(models)
             return True
     except:
-        return operators.handle_error(context.scene, f"Couldn't get the list of available Stable Diffusion models from the Automatic1111 server")
+        return operators.handle_error(scene, f"Couldn't get the list of available Stable Diffusion models from the Automatic1111 server")
+
 
-def load_upscaler_models(context):
+def store_upscaler_models(scene, response_obj):
     try:
         # set a flag to indicate whether the list of models has already been loaded
-        was_already_loaded = is_upscaler_model_list_loaded(context)
+        was_already_loaded = scene.air_props.automatic1111_available_upscaler_models != ""
+
+        # (the list couldn't be loaded at all)
+        if response_obj is None:
+            raise ValueError("No response from the Automatic1111 server")
 
-        # get the list of available upscaler models from the Automatic1111 api
-        server_url = get_server_url("/sdapi/v1/upscalers")
-        headers = { "Accept": "application/json" }
-        response = requests.get(server_url, headers=headers, timeout=5)
-        response_obj = response.json()
         print("Upscaler models returned from Automatic1111 API:")
         print(response_obj)
 
         # store the list of models in the scene properties
         if not response_obj:
-            return operators.handle_error(context.scene, f"No upscaler models are installed in Automatic1111. [Get help]({config.HELP_WITH_AUTOMATIC1111_UPSCALING_URL})")
+            return operators.handle_error(scene, f"No upscaler models are installed in Automatic1111. [Get help]({config.HELP_WITH_AUTOMATIC1111_UPSCALING_URL})")
         else:
             # map the response object to a list of model names
             upscaler_models = []
             for model in response_obj:
                 if (model["name"] != "None"):
                     upscaler_models.append(model["name"])
-            context.scene.air_props.automatic1111_available_upscaler_models = "||||".join(upscaler_models)
+            scene.air_props.automatic1111_available_upscaler_models = "||||".join(upscaler_models)
 
             # if the list of models was not already loaded, set the default model
             if not was_already_loaded:
-                context.scene.air_props.upscaler_model = default_upscaler_model()
+                scene.air_props.upscaler_model = default_upscaler_model()
 
             # return success
             return True
     except:
-        return operators.handle_error(context.scene, f"Couldn't get the list of available upscaler models from the Automatic1111 server. [Get help]({config.HELP_WITH_AUTOMATIC1111_UPSCALING_URL})")
+        return operators.handle_error(scene, f"Couldn't get the list of available upscaler models from the Automatic1111 server. [Get help]({config.HELP_WITH_AUTOMATIC1111_UPSCALING_URL})")
 
 
-def load_controlnet_models(context):
+def store_controlnet_models(scene, response_obj):
     try:
-        # get the list of available controlnet models from the Automatic1111 api
-        server_url = get_server_url("/controlnet/model_list")
-        headers = { "Accept": "application/json" }
-        response = requests.get(server_url, headers=headers, timeout=5)
-        response_obj = response.json()
         print("ControlNet models returned from Automatic1111 API:")
         print(response_obj)
 
         # store the list of models in the scene properties
         models = response_obj["model_list"]
         if not models:
-            return operators.handle_error(context.scene, f"You don't have any ControlNet models installed. You will need to download them from Hugging Face. [Get help]({config.HELP_WITH_CONTROLNET_URL})")
+            return operators.handle_error(scene, f"You don't have any ControlNet models installed. You will need to download them from Hugging Face. [Get help]({config.HELP_WITH_CONTROLNET_URL})")
         else:
-            context.scene.air_props.controlnet_available_models = "||||".join(models)
+            scene.air_props.controlnet_available_models = "||||".join(models)
             return True
     except:
-        return operators.handle_error(context.scene, f"Couldn't get the list of available ControlNet models from the Automatic1111 server. Make sure ControlNet is installed and activated. [Get help]({config.HELP_WITH_CONTROLNET_URL})")
+        return operators.handle_error(scene, f"Couldn't get the list of available ControlNet models from the Automatic1111 server. Make sure ControlNet is installed and activated. [Get help]({config.HELP_WITH_CONTROLNET_URL})")
 
 
-def load_controlnet_modules(context):
+def store_controlnet_modules(scene, response_obj):
     try:
-        # get the list of available controlnet modules from the Automatic1111 api
-        server_url = get_server_url("/controlnet/module_list")
-        headers = { "Accept": "application/json" }
-        response = requests.get(server_url, headers=headers, timeout=5)
-        response_obj = response.json()
         print("ControlNet modules returned from Automatic1111 API:")
         print(response_obj)
 
         # store the list of modules in the scene properties
         modules = response_obj["module_list"]
-        context.scene.air_props.controlnet_available_modules = "||||".join(modules)
+        scene.air_props.controlnet_available_modules = "||||".join(modules)
         return True
     except:
-        return operators.handle_error(context.scene, f"Couldn't get the list of available ControlNet modules from the Automatic1111 server. Make sure ControlNet is installed and activated. [Get help]({config.HELP_WITH_CONTROLNET_URL})")
+        return operators.handle_error(scene, f"Couldn't get the list of available ControlNet modules from the Automatic1111 server. Make sure ControlNet is installed and activated. [Get help]({config.HELP_WITH_CONTROLNET_URL})")
+
+
+# the lists are loaded on a worker thread (so the ui doesn't freeze while we wait for the
+# server), and stored in the current scene once they're back
+def load_sd_models():
+    return load_list("/sdapi/v1/sd-models", store_sd_models)
+
+
+def load_upscaler_models():
+    return load_list("/sdapi/v1/upscalers", store_upscaler_models)
+
+
+def load_controlnet_models():
+    return load_list("/controlnet/model_list", store_controlnet_models)
+
+
+def load_controlnet_modules():
+    return load_list("/controlnet/module_list", store_controlnet_modules)
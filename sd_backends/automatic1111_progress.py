@@ -0,0 +1,187 @@
+import bpy
+import base64
+import os
+import threading
+import time
+import requests
+from .. import (
+    http_sessions,
+    task_queue,
+    temp_files,
+    utils,
+)
+
+
+# while an Automatic1111 server is generating, check its progress (on a separate thread,
+# with small, fast requests) and show it in the progress bar. Requests to the same server
+# share one watcher, since the server only reports on the image it's currently generating.
+
+PROGRESS_PATH = "/sdapi/v1/progress"
+CHECK_INTERVAL = 0.5
+CHECK_TIMEOUT = 5
+
+# how often to update the preview of the image being generated (each one is a full image
+# to download and load, so this is much less often than the progress bar is updated)
+PREVIEW_INTERVAL = 2
+
+PREVIEW_IMAGE_NAME = "AI Render Preview"
+
+
+class Watcher:
+    def __init__(self, base_url, headers, show_preview):
+        self.base_url = base_url
+        self.headers = headers
+        self.show_preview = show_preview
+        self.requests = 1
+        self.progress = 0
+        self.eta = None
+        self.step = 0
+        self.steps = 0
+        self.preview_updated_at = 0
+        self.preview_file = None
+        self.stop_event = threading.Event()
+
+
+# private
+lock = threading.Lock()
+watchers = {} # base url -> Watcher
+
+
+def check_progress(watcher):
+    try:
+        response = http_sessions.get_session("automatic1111").get(
+            watcher.base_url + PROGRESS_PATH,
+            params={"skip_current_image": "false" if watcher.show_preview else "true"},
+            headers=watcher.headers,
+            timeout=CHECK_TIMEOUT,
+        )
+        if response.status_code != 200:
+            return False
+        status = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return False
+
+    state = status.get("state") or {}
+    with lock:
+        watcher.progress = min(max(status.get("progress") or 0, 0), 1)
+        watcher.eta = status.get("eta_relative")
+        watcher.step = state.get("sampling_step") or 0
+        watcher.steps = state.get("sampling_steps") or 0
+
+    # save the preview to a temp file, so it can be loaded in the main thread
+    current_image = status.get("current_image")
+    if current_image and time.monotonic() - watcher.preview_updated_at >= PREVIEW_INTERVAL:
+        watcher.preview_updated_at = time.monotonic()
+        try:
+            preview_file = utils.create_temp_file("ai-render-preview-")
+            temp_files.write_atomic(preview_file, base64.b64decode(current_image.split(",", 1)[-1]))
+            with lock:
+                watcher.preview_file = preview_file
+        except (OSError, ValueError):
+            pass
+
+    return True
+
+
+def poll(watcher):
+    while not watcher.stop_event.wait(CHECK_INTERVAL):
+        if check_progress(watcher):
+            # coalesced with any update that hasn't run yet, so the ui is redrawn at most
+            # once per check, however many servers are being watched
+            task_queue.add(update_progress_bar, task_queue.PRIORITY_UI, key="automatic1111_progress")
+
+
+def update_progress_bar():
+    scene = bpy.context.scene
+
+    # during an animation, the animation operator shows the progress (including this, for the frames in progress)
+    if scene.air_props.is_rendering_animation_manually:
+        return
+
+    with lock:
+        if not watchers:
+            watcher = None
+        else:
+            watcher = max(watchers.values(), key=lambda watcher: watcher.progress)
+            progress, eta, step, steps = watcher.progress, watcher.eta, watcher.step, watcher.steps
+            preview_file, watcher.preview_file = watcher.preview_file, None
+
+    # once nothing is being generated, hide the progress bar
+    if not watcher:
+        if scene.air_progress != -1:
+            scene.air_progress = -1
+            scene.air_progress_status_message = ""
+        return
+
+    # only set what's changed, since each change redraws the image editors
+    label = f"AI Render (Step {step}/{steps})" if steps else "AI Render"
+    status_message = f"{round(eta)}s left" if eta else ""
+    percent = round(progress * 100)
+
+    if scene.air_progress_label != label:
+        scene.air_progress_label = label
+    if scene.air_progress_status_message != status_message:
+        scene.air_progress_status_message = status_message
+    if scene.air_progress != percent:
+        scene.air_progress = percent
+
+    if preview_file and not bpy.app.background:
+        show_preview(preview_file)
+
+
+def show_preview(preview_file):
+    try:
+        preview_image = bpy.data.images.get(PREVIEW_IMAGE_NAME)
+        if preview_image:
+            # reuse the same image, and remove the last preview's file
+            old_preview_file = preview_image.filepath
+            preview_image.filepath = preview_file
+            preview_image.reload()
+            if os.path.basename(old_preview_file).startswith("ai-render-preview-") and os.path.exists(old_preview_file):
+                os.remove(old_preview_file)
+        else:
+            preview_image = bpy.data.images.load(preview_file, check_existing=False)
+            preview_image.name = PREVIEW_IMAGE_NAME
+
+        utils.view_sd_result_in_air_image_editor(preview_image)
+    except:
+        print("AI Render: couldn't show the preview of the image being generated")
+
+
+# public methods
+def watch(base_url, headers=None, show_preview=False):
+    """Start showing the progress of a request that's being sent to the server. Returns a watcher, which must be passed to unwatch()"""
+    with lock:
+        watcher = watchers.get(base_url)
+        if watcher:
+            watcher.requests += 1
+            watcher.show_preview = watcher.show_preview or show_preview
+            return watcher
+
+        watcher = Watcher(base_url, headers, show_preview)
+        watchers[base_url] = watcher
+
+    threading.Thread(target=poll, args=(watcher,), name="ai-render-automatic1111-progress", daemon=True).start()
+    return watcher
+
+
+def unwatch(watcher):
+    """Stop showing the progress of a request, once the server has responded"""
+    with lock:
+        watcher.requests -= 1
+        if watcher.requests > 0:
+            return
+
+        watcher.stop_event.set()
+        if watchers.get(watcher.base_url) is watcher:
+            del watchers[watcher.base_url]
+        is_last = not watchers
+
+    if is_last:
+        task_queue.add(update_progress_bar, task_queue.PRIORITY_UI, key="automatic1111_progress")
+
+
+def get_progress_of_all():
+    """Get the total progress of the images being generated (e.g. 1.5 when two servers are each halfway through an image)"""
+    with lock:
+        return sum(watcher.progress for watcher in watchers.values())
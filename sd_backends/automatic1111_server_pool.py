@@ -0,0 +1,192 @@
+import threading
+import time
+import requests
+from .. import (
+    cancellation,
+    http_sessions,
+)
+
+
+# a pool of Automatic1111 servers that requests are spread across. Each request goes
+# to the healthy server with the fewest outstanding requests (relative to how many it
+# can run at once), and is re-queued on another server if its server times out.
+
+HEALTH_CHECK_PATH = "/sdapi/v1/sd-models"
+HEALTH_CHECK_TIMEOUT = 5
+HEALTH_RECHECK_INTERVAL = 30
+
+
+class Server:
+    def __init__(self, url, max_requests=1):
+        self.url = url
+        self.max_requests = max_requests
+        self.outstanding = 0
+        self.is_healthy = None # None means it hasn't been checked yet
+        self.checked_at = 0
+
+    def needs_health_check(self):
+        return self.is_healthy is None or (not self.is_healthy and time.monotonic() - self.checked_at > HEALTH_RECHECK_INTERVAL)
+
+    def is_usable(self):
+        return self.is_healthy != False or self.needs_health_check()
+
+    def is_available(self):
+        return self.is_usable() and self.outstanding < self.max_requests
+
+
+# private
+servers = []
+servers_config = None
+condition = threading.Condition()
+
+
+def parse_server_pool(text):
+    """Parse a comma separated list of server urls, each with an optional '*N' concurrency limit"""
+    parsed = []
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+
+        url, _, max_requests = item.partition("*")
+        try:
+            max_requests = max(1, int(max_requests)) if max_requests.strip() else 1
+        except ValueError:
+            max_requests = 1
+
+        parsed.append((url.strip().rstrip("/"), max_requests))
+    return parsed
+
+
+def check_health(server, headers=None):
+    try:
+        response = http_sessions.get_session("automatic1111").get(server.url + HEALTH_CHECK_PATH, headers=headers, timeout=HEALTH_CHECK_TIMEOUT)
+        is_healthy = response.status_code == 200
+    except requests.exceptions.RequestException:
+        is_healthy = False
+
+    with condition:
+        server.is_healthy = is_healthy
+        server.checked_at = time.monotonic()
+        condition.notify_all()
+
+    if not is_healthy:
+        print(f"AI Render: Automatic1111 server {server.url} failed its health check")
+    return is_healthy
+
+
+def acquire(exclude=()):
+    """Reserve the usable server with the fewest outstanding requests, waiting if they're all busy"""
+    exclude = list(exclude)
+
+    while True:
+        with condition:
+            candidates = [server for server in servers if server not in exclude and server.is_usable()]
+            if not candidates:
+                return None
+
+            available = [server for server in candidates if server.outstanding < server.max_requests]
+            if not available:
+                condition.wait(1)
+                continue
+
+            server = min(available, key=lambda server: (server.outstanding / server.max_requests, server.outstanding))
+            server.outstanding += 1
+
+        # check the server before we use it, if it's new or has been failing
+        if server.needs_health_check() and not check_health(server):
+            release(server)
+            exclude.append(server)
+            continue
+
+        return server
+
+
+def release(server, is_healthy=True):
+    with condition:
+        server.outstanding = max(0, server.outstanding - 1)
+        if not is_healthy:
+            server.is_healthy = False
+            server.checked_at = time.monotonic()
+        condition.notify_all()
+
+
+# public methods
+def configure(text):
+    """Update the pool from the preferences text, keeping the state of servers that are still in it"""
+    global servers, servers_config
+
+    with condition:
+        if text == servers_config:
+            return
+
+        existing = {server.url: server for server in servers}
+        new_servers = []
+        for url, max_requests in parse_server_pool(text):
+            server = existing.get(url) or Server(url)
+            server.max_requests = max_requests
+            new_servers.append(server)
+
+        servers = new_servers
+        servers_config = text
+        condition.notify_all()
+
+
+def get_capacity(text):
+    """Get the total number of requests the pool can run at once"""
+    return sum(max_requests for url, max_requests in parse_server_pool(text))
+
+
+def post(path, headers=None, timeout=None, on_send=None, cancel_token=None, **kwargs):
+    """Post to the least busy server in the pool, re-queueing on another server if it times out or can't be reached.
+
+    If given, on_send(server_url) is called with each server the request is sent to. If cancel_token is cancelled
+    while waiting for a server's response, the connection is closed and cancellation.Cancelled is raised"""
+    body = kwargs.get("data")
+    tried = []
+    last_exception = None
+
+    while True:
+        server = acquire(exclude=tried)
+        if server is None:
+            break
+
+        # a streamed body may have been partly sent to the last server, so start it again
+        if hasattr(body, "seek"):
+            body.seek(0)
+
+        if on_send:
+            on_send(server.url)
+
+        try:
+            with http_sessions.abort_on_cancel(cancel_token):
+                response = http_sessions.get_session("automatic1111").post(server.url + path, headers=headers, timeout=timeout, **kwargs)
+            release(server)
+            return response
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            # we closed the connection ourselves, so the server is fine
+            if cancel_token and cancel_token.is_cancelled():
+                release(server)
+                raise cancellation.Cancelled()
+
+            print(f"AI Render: Automatic1111 server {server.url} didn't respond, re-queueing the request")
+            release(server, is_healthy=False)
+            tried.append(server)
+            last_exception = e
+        except:
+            release(server)
+            raise
+
+    if last_exception:
+        raise last_exception
+    raise requests.exceptions.ConnectionError("None of the Automatic1111 servers in the pool are available")
+
+
+def reset():
+    """Forget the servers and their health, so the pool is set up again (from the preferences) on the next request"""
+    global servers, servers_config
+
+    with condition:
+        servers = []
+        servers_config = None
+        condition.notify_all()
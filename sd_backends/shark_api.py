@@ -1,9 +1,11 @@
 import bpy
-import base64
 import requests
 import random
 from .. import (
+    cancellation,
     config,
+    http_sessions,
+    json_stream,
     operators,
     utils,
 )
@@ -11,15 +13,13 @@ from .. import (
 # TODO: Controlnet Supprt
 # TODO: Support Model Choice
 
-def generate(params, img_file, filename_prefix, props):
+def generate(params, img_file, filename_prefix, props, is_text2image=False, cancel_token=None):
     # Configuring custom params for shark
     params["denoising_strength"] = round(1 - params["image_similarity"], 2)
     del params["tiling"]
 
-    # add a base 64 encoded image to the params
-    params["init_images"] = ["data:image/png;base64," +
-                             base64.b64encode(img_file.read()).decode()]
-    img_file.close()
+    # add the image to the params (it's base 64 encoded as the request is sent)
+    params["init_images"] = [json_stream.Base64File(img_file, "data:image/png;base64,")]
 
     # get server url
     try:
@@ -28,107 +28,91 @@ def generate(params, img_file, filename_prefix, props):
         return operators.handle_error(None, f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_SHARK_INSTALLATION_URL})", "local_server_url_missing")
 
     # send the API request
-    response = do_post(server_url, params)
+    response = do_post(server_url, params, cancel_token)
 
     # Error already handled
     if response is False:
         return False
 
     if response.status_code == 200:
-        return handle_success(response, filename_prefix)
+        return handle_success(response, filename_prefix, cancel_token)
     else:
         return handle_error(response)
 
 
-def upscale(img_file, filename_prefix, props):
+def upscale(img_file, filename_prefix, props, cancel_token=None):
 
     data = {
         "prompt": "",
         "negative_prompt": "",
         "seed": random.randint(1000000000, 2147483647),
-        "height": utils.sanitized_upscaled_height(max_upscaled_image_size()),
-        "width": utils.sanitized_upscaled_width(max_upscaled_image_size()),
+        "height": props.upscaled_height,
+        "width": props.upscaled_width,
         "steps": 50,
         "noise_level": 20,
         "cfg_scale": 7
     }
 
-    data["init_images"] = ["data:image/png;base64," +
-                           base64.b64encode(img_file.read()).decode()]
-    img_file.close()
+    data["init_images"] = [json_stream.Base64File(img_file, "data:image/png;base64,")]
 
     try:
         server_url = get_server_url("/sdapi/v1/upscaler")
     except:
         return operators.handle_error(None, f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_SHARK_INSTALLATION_URL})", "local_server_url_missing")
 
-    response = do_post(server_url, data)
+    response = do_post(server_url, data, cancel_token)
 
     if response is False:
         return False
 
     if response.status_code == 200:
-        return handle_success(response, filename_prefix)
+        return handle_success(response, filename_prefix, cancel_token)
     else:
         return handle_error(response)
 
 
-def inpaint(params, img_file, mask_file, filename_prefix, props):
+def inpaint(params, img_file, mask_file, filename_prefix, props, cancel_token=None):
 
-    params["image"] = "data:image/png;base64," + base64.b64encode(img_file.read()).decode()
-    img_file.close()
-
-    params["mask"] = "data:image/png;base64," + base64.b64encode(mask_file.read()).decode()
-    mask_file.close()
+    params["image"] = json_stream.Base64File(img_file, "data:image/png;base64,")
+    params["mask"] = json_stream.Base64File(mask_file, "data:image/png;base64,")
 
     try:
         server_url = get_server_url("/sdapi/v1/inpaint")
     except:
         return operators.handle_error(None, f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_SHARK_INSTALLATION_URL})", "local_server_url_missing")
 
-    response = do_post(server_url, params)
+    response = do_post(server_url, params, cancel_token)
 
     if response is False:
         return False
 
     if response.status_code == 200:
-        return handle_success(response, filename_prefix)
+        return handle_success(response, filename_prefix, cancel_token)
     else:
         return handle_error(response)
 
 
-def outpaint(params, img_file, filename_prefix, props):
+def outpaint(params, img_file, filename_prefix, props, cancel_token=None):
 
-    params["init_images"] = ["data:image/png;base64," + base64.b64encode(img_file.read()).decode()]
-    img_file.close()
+    params["init_images"] = [json_stream.Base64File(img_file, "data:image/png;base64,")]
 
     try:
         server_url = get_server_url("/sdapi/v1/outpaint")
     except:
         return operators.handle_error(None, f"You need to specify a location for the local Stable Diffusion server in the add-on preferences. [Get help]({config.HELP_WITH_SHARK_INSTALLATION_URL})", "local_server_url_missing")
 
-    response = do_post(server_url, params)
+    response = do_post(server_url, params, cancel_token)
 
     if response is False:
         return False
 
     if response.status_code == 200:
-        return handle_success(response, filename_prefix)
+        return handle_success(response, filename_prefix, cancel_token)
     else:
         return handle_error(response)
 
 
-def handle_success(response, filename_prefix):
-
-    # ensure we have the type of response we are expecting
-    try:
-        response_obj = response.json()
-        base64_img = response_obj.get("images", [False])[
-            0] or response_obj.get("image")
-    except:
-        print("SHARK response content: ")
-        print(response.content)
-        return operators.handle_error(None, "Received an unexpected response from the Shark Stable Diffusion server.", "unexpected_response")
+def handle_success(response, filename_prefix, cancel_token=None):
 
     # create a temp file
     try:
@@ -136,19 +120,22 @@ def handle_success(response, filename_prefix):
     except:
         return operators.handle_error(None, "Couldn't create a temp file to save image.", "temp_file")
 
-    # decode base64 image
+    # decode the base64 image into the temp file as the response downloads
     try:
-        img_binary = base64.b64decode(
-            base64_img.replace("data:image/png;base64,", ""))
-    except:
+        has_image = json_stream.save_image_from_response(response, output_file, cancel_token=cancel_token)
+    except cancellation.Cancelled:
+        # the request was cancelled, so there's no error to show
+        return False
+    except requests.exceptions.RequestException:
+        return operators.handle_error(None, "The connection to the Shark Stable Diffusion server was lost while downloading the image.", "unexpected_response")
+    except OSError:
+        return operators.handle_error(None, "Couldn't write to temp file.", "temp_file_write")
+    except ValueError:
         return operators.handle_error(None, "Couldn't decode base64 image from the Shark Stable Diffusion server.", "base64_decode")
 
-    # save the image to the temp file
-    try:
-        with open(output_file, 'wb') as file:
-            file.write(img_binary)
-    except:
-        return operators.handle_error(None, "Couldn't write to temp file.", "temp_file_write")
+    # ensure we got the type of response we are expecting
+    if not has_image:
+        return operators.handle_error(None, "Received an unexpected response from the Shark Stable Diffusion server.", "unexpected_response")
 
     # return the temp file
     return output_file
@@ -173,6 +160,10 @@ def handle_error(response):
         return operators.handle_error(None, f"An error occurred in the SHARK Stable Diffusion server. Check the server logs for more info, or check out the SHARK Troubleshooting guide. [Get help]({config.HELP_WITH_SHARK_TROUBLESHOOTING_URL})", "unknown_error_response")
 
 
+def get_session():
+    return http_sessions.get_session("shark")
+
+
 def create_headers():
     return {
         "User-Agent": f"Blender/{bpy.app.version_string}",
@@ -181,16 +172,29 @@ def create_headers():
     }
 
 
-def do_post(url, data):
-    # send the API request
+def do_post(url, data, cancel_token=None):
+    # send the API request, streaming the body (so images are base 64 encoded while
+    # they're sent) and the response (so handle_success can decode it as it downloads)
+    body = json_stream.JsonBody(data, cancel_token)
+    headers = {**create_headers(), "Content-Type": "application/json"}
     try:
-        return requests.post(url, json=data, headers=create_headers(), timeout=utils.local_sd_timeout())
+        # (SHARK can't be told to stop, but if the request is cancelled while we wait for
+        # the response, the connection is closed so we stop waiting)
+        with http_sessions.abort_on_cancel(cancel_token):
+            return get_session().post(url, data=body, headers=headers, timeout=utils.local_sd_timeout(), stream=True)
+    except cancellation.Cancelled:
+        # the request was cancelled, so there's no error to show
+        return False
     except requests.exceptions.ConnectionError:
+        if cancel_token and cancel_token.is_cancelled():
+            return False
         return operators.handle_error(None, f"The local Stable Diffusion server couldn't be found. It's either not running, or it's running at a different location than what you specified in the add-on preferences. [Get help]({config.HELP_WITH_SHARK_INSTALLATION_URL})", "local_server_not_found")
     except requests.exceptions.MissingSchema:
         return operators.handle_error(None, f"The url for your local Stable Diffusion server is invalid. Please set it correctly in the add-on preferences. [Get help]({config.HELP_WITH_SHARK_INSTALLATION_URL})", "local_server_url_invalid")
     except requests.exceptions.ReadTimeout:
         return operators.handle_error(None, "The local Stable Diffusion server timed out. Set a longer timeout in AI Render preferences, or use a smaller image size.", "timeout")
+    finally:
+        body.close()
 
 
 def get_server_url(path):
@@ -216,10 +220,18 @@ def max_upscaled_image_size():
 def supports_upscaling():
     return True
 
+
+def supports_batches():
+    return False
+
 def supports_tiling():
     return False
 
 
+def supports_prompt_weights():
+    return False
+
+
 def get_image_format():
     return 'PNG'
 
@@ -3,14 +3,16 @@ import base64
 import requests
 from .. import (
     config,
+    http_sessions,
     operators,
+    temp_files,
     utils,
 )
 
 
 # CORE FUNCTIONS:
 
-def generate(params, img_file, filename_prefix, props):
+def generate(params, img_file, filename_prefix, props, is_text2image=False, cancel_token=None):
 
     # validate the params, specifically for the Stability API
     if not validate_params(params, props):
@@ -43,10 +45,22 @@ def generate(params, img_file, filename_prefix, props):
         'init_image': img_file,
     }
 
+    # don't send the request if it's already been cancelled
+    if cancel_token and cancel_token.is_cancelled():
+        img_file.close()
+        return False
+
     # send the API request
+    # (if the request is cancelled while we wait for the response, the connection is closed)
     try:
-        response = requests.post(api_url, headers=headers, files=files, data=mapped_params, timeout=request_timeout())
+        with http_sessions.abort_on_cancel(cancel_token):
+            response = get_session().post(api_url, headers=headers, files=files, data=mapped_params, timeout=request_timeout())
         img_file.close()
+    except requests.exceptions.ConnectionError:
+        img_file.close()
+        if cancel_token and cancel_token.is_cancelled():
+            return False
+        return operators.handle_error(None, "Couldn't connect to the Stability API. Check your internet connection, and try again in a moment.", "server_not_found")
     except requests.exceptions.ReadTimeout:
         img_file.close()
         return operators.handle_error(None, f"The server timed out. Try again in a moment, or get help. [Get help with timeouts]({config.HELP_WITH_TIMEOUTS_URL})", "timeout")
@@ -54,14 +68,19 @@ def generate(params, img_file, filename_prefix, props):
     # print log info for debugging
     # debug_log(response)
 
+    # the Stability API can't stop a request once it's been sent (closing the connection
+    # just stops us waiting for it), so drop the result
+    if cancel_token and cancel_token.is_cancelled():
+        return False
+
     # handle the response
     if response.status_code == 200:
-        return handle_success(response, filename_prefix)
+        return handle_success(response, filename_prefix, params.get("batch_size", 1))
     else:
         return handle_error(response)
 
 
-def upscale(img_file, filename_prefix, props):
+def upscale(img_file, filename_prefix, props, cancel_token=None):
 
     # create the headers
     headers = create_headers()
@@ -76,13 +95,25 @@ def upscale(img_file, filename_prefix, props):
 
     # prepare the params
     data = {
-        'width': utils.sanitized_upscaled_width(max_upscaled_image_size())
+        'width': props.upscaled_width
     }
 
+    # don't send the request if it's already been cancelled
+    if cancel_token and cancel_token.is_cancelled():
+        img_file.close()
+        return False
+
     # send the API request
+    # (if the request is cancelled while we wait for the response, the connection is closed)
     try:
-        response = requests.post(api_url, headers=headers, files=files, data=data, timeout=request_timeout())
+        with http_sessions.abort_on_cancel(cancel_token):
+            response = get_session().post(api_url, headers=headers, files=files, data=data, timeout=request_timeout())
+        img_file.close()
+    except requests.exceptions.ConnectionError:
         img_file.close()
+        if cancel_token and cancel_token.is_cancelled():
+            return False
+        return operators.handle_error(None, "Couldn't connect to the Stability API. Check your internet connection, and try again in a moment.", "server_not_found")
     except requests.exceptions.ReadTimeout:
         img_file.close()
         return operators.handle_error(None, f"The server timed out during upscaling. Try again in a moment, or turn off upscaling.", "timeout")
@@ -90,6 +121,11 @@ def upscale(img_file, filename_prefix, props):
     # print log info for debugging
     # debug_log(response)
 
+    # the Stability API can't stop a request once it's been sent (closing the connection
+    # just stops us waiting for it), so drop the result
+    if cancel_token and cancel_token.is_cancelled():
+        return False
+
     # handle the response
     if response.status_code == 200:
         return handle_success(response, filename_prefix)
@@ -97,16 +133,18 @@ def upscale(img_file, filename_prefix, props):
         return handle_error(response)
 
 
-def handle_success(response, filename_prefix):
+def handle_success(response, filename_prefix, batch_size=1):
     try:
         data = response.json()
-        output_file = utils.create_temp_file(filename_prefix + "-")
+        output_files = []
 
-        for i, image in enumerate(data["artifacts"]):
-            with open(output_file, 'wb') as file:
-                file.write(base64.b64decode(image["base64"]))
+        # save each image to its own file (there's more than one for a batch)
+        for i, image in enumerate(data["artifacts"][:batch_size]):
+            output_file = utils.create_temp_file(filename_prefix + (f"-{i + 1}-" if batch_size > 1 else "-"))
+            temp_files.write_atomic(output_file, base64.b64decode(image["base64"]))
+            output_files.append(output_file)
 
-        return output_file
+        return output_files if batch_size > 1 else output_files[0]
     except:
         return operators.handle_error(None, f"Couldn't create a temp file to save image", "temp_file")
 
@@ -137,6 +175,10 @@ def handle_error(response):
 
 # PRIVATE SUPPORT FUNCTIONS:
 
+def get_session():
+    return http_sessions.get_session("dreamstudio")
+
+
 def create_headers():
     return {
         "User-Agent": f"Blender/{bpy.app.version_string}",
@@ -157,12 +199,20 @@ def map_params(params):
     # convert the params to the Stability API format
     mapped_params["image_strength"] = round(params["image_similarity"], 2)
     mapped_params["sampler"] = params["sampler"].upper()
-    mapped_params["text_prompts[0][text]"] = params["prompt"]
-    mapped_params["text_prompts[0][weight]"] = 1.0
 
-    if params["negative_prompt"]:
-        mapped_params["text_prompts[1][text]"] = params["negative_prompt"]
-        mapped_params["text_prompts[1][weight]"] = -1.0
+    # send each prompt separately, with its weight (there are several while blending
+    # between animated prompts), and the negative prompts with negative weights
+    text_prompts = params.get("prompt_weights") or [(params["prompt"], 1.0)]
+    negative_text_prompts = params.get("negative_prompt_weights") or [(params["negative_prompt"], 1.0)]
+    text_prompts = text_prompts + [(text, -weight) for text, weight in negative_text_prompts if text]
+
+    for i, (text, weight) in enumerate(text_prompts):
+        mapped_params[f"text_prompts[{i}][text]"] = text
+        mapped_params[f"text_prompts[{i}][weight]"] = weight
+
+    # generate a batch of images in one request
+    if params.get("batch_size", 1) > 1:
+        mapped_params["samples"] = params["batch_size"]
 
     return mapped_params
 
@@ -276,9 +326,17 @@ def supports_choosing_model():
 def supports_upscaling():
     return True
 
+
+def supports_batches():
+    return True
+
 def supports_tiling():
     return False
 
+
+def supports_prompt_weights():
+    return True
+
 def supports_reloading_upscaler_models():
     return False
 
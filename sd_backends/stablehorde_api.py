@@ -1,75 +1,71 @@
 import bpy
 import base64
+import functools
 import time
 import requests
 
 from .. import (
     config,
+    http_sessions,
     operators,
+    temp_files,
     utils,
 )
+from . import stablehorde_jobs
 
 API_REQUEST_URL = config.STABLE_HORDE_API_URL_BASE + "/generate/async"
-API_CHECK_URL = config.STABLE_HORDE_API_URL_BASE + "/generate/check"
 API_GET_URL = config.STABLE_HORDE_API_URL_BASE + "/generate/status"
 
+SUBMIT_RETRY_DELAY = 2
+
 # CORE FUNCTIONS:
 
-def generate(params, img_file, filename_prefix, props):
+def generate(params, img_file, filename_prefix, props, is_text2image=False, cancel_token=None):
 
     # map the generic params to the specific ones for the Stable Horde API
     stablehorde_params = map_params(params)
 
     # add a base 64 encoded image to the params
-    stablehorde_params["source_image"] = base64.b64encode(img_file.read()).decode()
+    if not is_text2image:
+        stablehorde_params["source_image"] = base64.b64encode(img_file.read()).decode()
 
-    # close the image file
-    img_file.close()
+        # close the image file
+        img_file.close()
 
     # create the headers
     headers = create_headers()
 
-    # send the API request
-    start_time = time.monotonic()
-    try:
-        print(f"Sending request to Stable Horde API: {API_REQUEST_URL}")
-        response = requests.post(API_REQUEST_URL, json=stablehorde_params, headers=headers, timeout=20)
-        id = response.json()["id"]
-        img_file.close()
-    except requests.exceptions.ReadTimeout:
-        img_file.close()
-        return operators.handle_error(None, f"There was an error sending this request to Stable Horde. Please try again in a moment.", "timeout")
-    except Exception as e:
-        img_file.close()
-        return operators.handle_error(None, f"Error with Stable Horde. Full error message: {e}", "unknown_error")
-
-    # Check the status of the request (For at most request_timeout seconds)
-    for i in range(request_timeout()):
-        try:
-            time.sleep(1)
-            URL=API_CHECK_URL + "/" + id
-            print(f"Checking status of request at Stable Horde API: {URL}")
-            response = requests.get(URL, headers=headers, timeout=20)
-            print(f"Waiting for {str(time.monotonic() - start_time)}s. Response: {response.json()}")
-            if response.json()["done"] == True:
-                print("The horde took " + str(time.monotonic() - start_time) + "s to imagine this frame.")
-                break
-        except requests.exceptions.ReadTimeout:
-            # Ignore timeouts
-            print("WARN: Timeout while checking status")
-        except Exception as e: # Catch all other errors
-            return operators.handle_error(None, f"Error while checking status: {e}", "unknown_error")
-    if (i == request_timeout() - 1):
+    # submit the job
+    id = submit(stablehorde_params, headers, cancel_token)
+    if not id:
+        return False
+
+    # wait for the job to be done (all our jobs are checked on together, so lots of them
+    # can wait in the queue at once, e.g. for an animation). If the request is cancelled
+    # while it's waiting, the job is deleted from the horde.
+    job = stablehorde_jobs.track(id, headers, request_timeout())
+    cancel_callback = cancel_token.on_cancel(functools.partial(stablehorde_jobs.cancel, job)) if cancel_token else None
+    stablehorde_jobs.wait(job)
+    if cancel_callback:
+        cancel_token.remove_callback(cancel_callback)
+
+    if job.state == "cancelled" or (cancel_token and cancel_token.is_cancelled()):
+        return False
+    elif job.state == "timeout":
         return operators.handle_error(None, f"Timeout generating image. Try again in a moment, or get help. [Get help with timeouts]({config.HELP_WITH_TIMEOUTS_URL})", "timeout")
+    elif job.state != "done":
+        return operators.handle_error(None, f"Error with Stable Horde: {job.error}", "unknown_error")
+
+    print(f"The horde took {round(job.get_elapsed_time(), 1)}s ({job.checks} status checks) to imagine this frame.")
 
     # Get the image
     try:
         URL=API_GET_URL + "/" + id
         print(f"Retrieving image from Stable Horde API: {URL}")
-        response = requests.get(URL, headers=headers, timeout=20)
+        response = get_session().get(URL, headers=headers, timeout=20)
         # handle the response
         if response.status_code == 200:
-            return handle_success(response, filename_prefix)
+            return handle_success(response, filename_prefix, params.get("batch_size", 1))
         else:
             return handle_error(response)
 
@@ -79,43 +75,85 @@ def generate(params, img_file, filename_prefix, props):
         return operators.handle_error(None, f"Error with Stable Horde. Full error message: {e}", "unknown_error")
 
 
-def handle_success(response, filename_prefix):
+def submit(stablehorde_params, headers, cancel_token=None):
+    """Submit a job to Stable Horde, and return its id"""
+    start_time = time.monotonic()
+    retry_delay = SUBMIT_RETRY_DELAY
+
+    while True:
+        # don't submit a job if the request has already been cancelled
+        if cancel_token and cancel_token.is_cancelled():
+            return False
+
+        try:
+            print(f"Sending request to Stable Horde API: {API_REQUEST_URL}")
+            response = get_session().post(API_REQUEST_URL, json=stablehorde_params, headers=headers, timeout=20)
+        except requests.exceptions.ReadTimeout:
+            return operators.handle_error(None, f"There was an error sending this request to Stable Horde. Please try again in a moment.", "timeout")
+        except Exception as e:
+            return operators.handle_error(None, f"Error with Stable Horde. Full error message: {e}", "unknown_error")
+
+        # if we already have too many jobs in the queue, wait for some of them to finish
+        if response.status_code == 429 and time.monotonic() - start_time + retry_delay < request_timeout():
+            print(f"Stable Horde is limiting how many requests we can send. Trying again in {retry_delay}s")
+            if cancel_token:
+                cancel_token.wait(retry_delay)
+            else:
+                time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, stablehorde_jobs.MAX_CHECK_INTERVAL)
+            continue
+
+        try:
+            return response.json()["id"]
+        except Exception:
+            return operators.handle_error(None, f"Error with Stable Horde. Full server response: {response.content}", "unknown_error")
+
+
+def handle_success(response, filename_prefix, batch_size=1):
 
     # ensure we have the type of response we are expecting
     try:
         response_obj = response.json()
-        img_url = response_obj["generations"][0]["img"]
-        print(f"Worker: {response_obj['generations'][0]['worker_name']}, " +
+        generations = response_obj["generations"][:batch_size]
+        img_urls = [generation["img"] for generation in generations]
+        print(f"Workers: {', '.join(generation['worker_name'] for generation in generations)}, " +
               f"kudos: {response_obj['kudos']}")
     except:
         print("Stable Horde response content: ")
         print(response.content)
         return operators.handle_error(None, "Received an unexpected response from the Stable Horde server.", "unexpected_response")
 
-    # create a temp file
-    try:
-        output_file = utils.create_temp_file(filename_prefix + "-", suffix=f".{get_image_format().lower()}")
-    except:
-        return operators.handle_error(None, "Couldn't create a temp file to save image.", "temp_file")
+    if not img_urls:
+        return operators.handle_error(None, "Received an unexpected response from the Stable Horde server.", "unexpected_response")
 
-    # Retrieve img from img_url and write it to the temp file
-    img_binary = None
-    try:
-        print(f"Retrieving image file from R2: {img_url}")
-        response = requests.get(img_url, timeout=20)
-        img_binary = response.content
-    except requests.exceptions.ReadTimeout:
-        return operators.handle_error(None, f"Timeout retrieving file. Try again in a moment, or get help. [Get help with timeouts]({config.HELP_WITH_TIMEOUTS_URL})", "timeout")
+    output_files = []
+    for i, img_url in enumerate(img_urls):
 
-    # save the image to the temp file
-    try:
-        with open(output_file, 'wb') as file:
-            file.write(img_binary)
-    except:
-        return operators.handle_error(None, "Couldn't write to temp file.", "temp_file_write")
+        # create a temp file
+        try:
+            output_file = utils.create_temp_file(filename_prefix + (f"-{i + 1}-" if batch_size > 1 else "-"), suffix=f".{get_image_format().lower()}")
+        except:
+            return operators.handle_error(None, "Couldn't create a temp file to save image.", "temp_file")
+
+        # Retrieve img from img_url and write it to the temp file
+        img_binary = None
+        try:
+            print(f"Retrieving image file from R2: {img_url}")
+            response = get_session().get(img_url, timeout=20)
+            img_binary = response.content
+        except requests.exceptions.ReadTimeout:
+            return operators.handle_error(None, f"Timeout retrieving file. Try again in a moment, or get help. [Get help with timeouts]({config.HELP_WITH_TIMEOUTS_URL})", "timeout")
 
-    # return the temp file
-    return output_file
+        # save the image to the temp file
+        try:
+            temp_files.write_atomic(output_file, img_binary)
+        except:
+            return operators.handle_error(None, "Couldn't write to temp file.", "temp_file_write")
+
+        output_files.append(output_file)
+
+    # return the temp file (or all of them, for a batch)
+    return output_files if batch_size > 1 else output_files[0]
 
 
 def handle_error(response):
@@ -124,6 +162,10 @@ def handle_error(response):
 
 # PRIVATE SUPPORT FUNCTIONS:
 
+def get_session():
+    return http_sessions.get_session("stablehorde")
+
+
 def create_headers():
     # if no api-key specified, use the default non-authenticated api-key
     apikey = utils.get_stable_horde_api_key() if not utils.get_stable_horde_api_key().strip() == "" else "0000000000"
@@ -149,6 +191,7 @@ def map_params(params):
             "seed": str(params["seed"]),
             "steps": params["steps"],
             "sampler_name": params["sampler"],
+            "n": params.get("batch_size", 1),
         }
     }
 
@@ -211,10 +254,18 @@ def supports_choosing_model():
 def supports_upscaling():
     return False
 
+
+def supports_batches():
+    return True
+
 def supports_tiling():
     return False
 
 
+def supports_prompt_weights():
+    return False
+
+
 def supports_reloading_upscaler_models():
     return False
 
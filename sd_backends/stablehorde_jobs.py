@@ -0,0 +1,227 @@
+import threading
+import time
+import traceback
+import requests
+from .. import (
+    config,
+    http_sessions,
+)
+
+
+# tracks all of our in-progress Stable Horde jobs. Instead of every request checking
+# on its own job each second, one poller thread checks on all of them, backing off
+# based on where each job is in the queue (from the wait_time and queue_position that
+# Horde returns). This lets lots of jobs (e.g. a whole animation) wait in the queue at
+# once, and each waiting request is woken up as soon as its job is done.
+
+API_CHECK_URL = config.STABLE_HORDE_API_URL_BASE + "/generate/check"
+API_STATUS_URL = config.STABLE_HORDE_API_URL_BASE + "/generate/status"
+
+MIN_CHECK_INTERVAL = 1
+MAX_CHECK_INTERVAL = 20
+CHECK_TIMEOUT = 20
+
+# how many jobs to keep in the queue at once when rendering an animation (each waiting
+# job holds a worker thread, so this shouldn't be more than worker_pool.max_workers)
+MAX_JOBS_IN_FLIGHT = 8
+
+# how long past a job's deadline to keep waiting for the poller, before giving up on it
+WAIT_MARGIN = CHECK_TIMEOUT + MAX_CHECK_INTERVAL
+
+
+class Job:
+    def __init__(self, id, headers, timeout):
+        self.id = id
+        self.headers = headers
+        self.submitted_at = time.monotonic()
+        self.deadline = self.submitted_at + timeout
+        self.next_check_at = self.submitted_at + MIN_CHECK_INTERVAL
+        self.check_interval = MIN_CHECK_INTERVAL
+        self.checks = 0
+        self.status = {}
+        self.state = "waiting" # waiting, done, faulted, impossible, timeout, cancelled or error
+        self.error = None
+        self.done_event = threading.Event()
+
+    def get_elapsed_time(self):
+        return time.monotonic() - self.submitted_at
+
+
+# private
+jobs = []
+condition = threading.Condition()
+poller = None
+
+
+def get_check_interval(job, status):
+    wait_time = status.get("wait_time") or 0
+
+    if status.get("processing") or status.get("finished"):
+        # a worker has picked it up, so it should be done soon
+        interval = MIN_CHECK_INTERVAL
+    elif wait_time > 0:
+        # check again about halfway through the estimated wait, since the estimate
+        # gets more accurate as the job moves up the queue
+        interval = wait_time / 2
+    elif status.get("queue_position"):
+        # no estimate, but the further back in the queue, the less often it needs checking
+        interval = min(job.check_interval * 2, status["queue_position"])
+    else:
+        # no estimate yet, so back off exponentially
+        interval = job.check_interval * 2
+
+    return min(max(interval, MIN_CHECK_INTERVAL), MAX_CHECK_INTERVAL)
+
+
+def finish(job, state, error=None):
+    with condition:
+        job.state = state
+        job.error = error
+        if job in jobs:
+            jobs.remove(job)
+        condition.notify_all()
+    job.done_event.set()
+
+
+def schedule(job, interval):
+    with condition:
+        job.check_interval = interval
+        job.next_check_at = time.monotonic() + interval
+
+
+def check_job(job):
+    job.checks += 1
+    try:
+        response = http_sessions.get_session("stablehorde").get(f"{API_CHECK_URL}/{job.id}", headers=job.headers, timeout=CHECK_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        print(f"WARN: Couldn't check the status of Stable Horde job {job.id} ({e})")
+        schedule(job, min(job.check_interval * 2, MAX_CHECK_INTERVAL))
+        return
+
+    if response.status_code == 404:
+        return finish(job, "error", "Stable Horde doesn't know about this request anymore")
+    elif response.status_code != 200:
+        # e.g. we're being rate limited, so slow down
+        print(f"WARN: Stable Horde returned {response.status_code} while checking job {job.id}")
+        schedule(job, min(job.check_interval * 2, MAX_CHECK_INTERVAL))
+        return
+
+    try:
+        status = response.json()
+    except ValueError:
+        status = None
+
+    if not isinstance(status, dict):
+        print(f"WARN: Stable Horde returned an unexpected status for job {job.id}")
+        schedule(job, min(job.check_interval * 2, MAX_CHECK_INTERVAL))
+        return
+
+    job.status = status
+    print(f"Stable Horde job {job.id}: waited {round(job.get_elapsed_time())}s, queue position {status.get('queue_position')}, estimated wait {status.get('wait_time')}s")
+
+    if status.get("faulted"):
+        finish(job, "faulted", "The request faulted on Stable Horde")
+    elif status.get("is_possible") == False:
+        finish(job, "impossible", "No Stable Horde workers can run this request right now")
+    elif status.get("done"):
+        finish(job, "done")
+    else:
+        schedule(job, get_check_interval(job, status))
+
+
+def poll():
+    global poller
+
+    try:
+        poll_jobs()
+    finally:
+        # if the poller stopped for any reason, let the next tracked job start a new one
+        with condition:
+            if poller is threading.current_thread():
+                poller = None
+
+
+def poll_jobs():
+    global poller
+
+    while True:
+        with condition:
+            if not jobs:
+                poller = None
+                return
+
+            now = time.monotonic()
+
+            # give up on jobs that have taken too long
+            for job in [job for job in jobs if job.deadline <= now]:
+                jobs.remove(job)
+                job.state = "timeout"
+                job.done_event.set()
+
+            if not jobs:
+                continue
+
+            # wait until the next job is due to be checked (or a new job is added)
+            job = min(jobs, key=lambda job: job.next_check_at)
+            delay = min(job.next_check_at, job.deadline) - now
+            if delay > 0:
+                condition.wait(delay)
+                continue
+
+            # don't check this job again until it's been rescheduled
+            job.next_check_at = float("inf")
+
+        # an unexpected error shouldn't stop the poller, since every job depends on it
+        try:
+            check_job(job)
+        except Exception:
+            print(f"AI Render Error: Unexpected error while checking Stable Horde job {job.id}")
+            traceback.print_exc()
+            schedule(job, min(job.check_interval * 2, MAX_CHECK_INTERVAL))
+
+
+# public methods
+def track(id, headers, timeout):
+    """Start tracking a job that's been submitted to Stable Horde"""
+    global poller
+
+    job = Job(id, headers, timeout)
+    with condition:
+        jobs.append(job)
+        if poller is None:
+            poller = threading.Thread(target=poll, name="ai-render-stablehorde-poller", daemon=True)
+            poller.start()
+        condition.notify_all()
+
+    return job
+
+
+def wait(job):
+    """Block until the job is done (or has failed or timed out)"""
+    # (the poller times jobs out, but don't rely on it, in case it has stopped)
+    if not job.done_event.wait(timeout=max(job.deadline - time.monotonic(), 0) + WAIT_MARGIN):
+        finish(job, "timeout")
+    return job
+
+
+def cancel(job):
+    """Stop waiting for a job, and delete it from Stable Horde, so no worker spends time generating it"""
+    if job.done_event.is_set():
+        return
+
+    # wake up whoever is waiting first, since deleting the job can take a moment
+    finish(job, "cancelled")
+
+    try:
+        response = http_sessions.get_session("stablehorde").delete(f"{API_STATUS_URL}/{job.id}", headers=job.headers, timeout=CHECK_TIMEOUT)
+        if response.status_code == 200:
+            print(f"Stable Horde job {job.id} was cancelled")
+        else:
+            print(f"WARN: Stable Horde returned {response.status_code} while cancelling job {job.id}")
+    except requests.exceptions.RequestException as e:
+        print(f"WARN: Couldn't cancel Stable Horde job {job.id} ({e})")
+
+
+def get_jobs_in_progress():
+    with condition:
+        return len(jobs)
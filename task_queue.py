@@ -1,22 +1,141 @@
 import bpy
-import queue
+import heapq
+import itertools
+import threading
+import time
+import traceback
 from bpy.app.handlers import persistent
 
 
+# priorities (lower runs first). UI feedback (like error popups) runs before the
+# results coming back from worker threads, which run before new work, and background
+# work (like analytics) only runs once everything else is done.
+PRIORITY_UI = 0
+PRIORITY_RESULT = 1
+PRIORITY_DEFAULT = 2
+PRIORITY_BACKGROUND = 3
+
+# how long each timer tick can spend running tasks before giving Blender a chance to
+# redraw (at least one task always runs per tick, however long it takes)
+TIME_BUDGET = 0.05
+
+# how often to check for new tasks when the queue is empty, and how soon to come
+# back when there are still tasks left after using up a tick's time budget
+IDLE_INTERVAL = 0.1
+BUSY_INTERVAL = 0.01
+
+
+class Task:
+    """A handle for a queued function, which can be used to cancel it before it runs"""
+
+    def __init__(self, function, priority, key=None):
+        self.function = function
+        self.priority = priority
+        self.key = key
+        self.is_cancelled = False
+        self.is_done = False
+
+    def cancel(self):
+        """Cancel the task, if it hasn't run yet. Returns True if it was cancelled"""
+        with lock:
+            if self.is_done:
+                return False
+            self.is_cancelled = True
+            if self.key is not None and pending_by_key.get(self.key) is self:
+                del pending_by_key[self.key]
+            return True
+
+    def is_pending(self):
+        return not self.is_done and not self.is_cancelled
+
+
 # private
-execution_queue = queue.Queue()
+lock = threading.Lock()
+execution_queue = [] # heap of (priority, order, task)
+pending_by_key = {}
+order = itertools.count()
+
+
+def get_next_task():
+    with lock:
+        while execution_queue:
+            priority, task_order, task = heapq.heappop(execution_queue)
+            if task.is_cancelled:
+                continue
+
+            task.is_done = True
+            if task.key is not None and pending_by_key.get(task.key) is task:
+                del pending_by_key[task.key]
+            return task
+    return None
+
 
 def execute_queued_functions():
-    while not execution_queue.empty():
-        function = execution_queue.get()
-        function()
-    return 0.2
+    start_time = time.monotonic()
+
+    while True:
+        task = get_next_task()
+        if task is None:
+            return IDLE_INTERVAL
+
+        # an error in one task shouldn't stop the queue (returning without a next
+        # interval would unregister the timer)
+        try:
+            task.function()
+        except Exception:
+            print("AI Render Error: Unexpected error in a queued task")
+            traceback.print_exc()
+
+        # come back after Blender has had a chance to redraw, if we've used up this tick
+        if time.monotonic() - start_time >= TIME_BUDGET:
+            return BUSY_INTERVAL if get_queue_depth() else IDLE_INTERVAL
+
+
+def reprioritize(task, priority):
+    # move a waiting task to its new place in the queue (call with the lock held)
+    execution_queue[:] = [entry for entry in execution_queue if entry[2] is not task]
+    heapq.heapify(execution_queue)
+    task.priority = priority
+    heapq.heappush(execution_queue, (priority, next(order), task))
+
+
+# public methods
+def add(function, priority=PRIORITY_DEFAULT, key=None):
+    """Add a function to the task queue, to be executed in the main thread. Returns a Task, which can be cancelled.
+
+    If a key is given and a task with the same key is still waiting to run, the two are
+    coalesced: the waiting task will run the new function, at the new priority, and its
+    handle is returned"""
+    with lock:
+        if key is not None:
+            pending_task = pending_by_key.get(key)
+            if pending_task is not None and pending_task.is_pending():
+                pending_task.function = function
+                if pending_task.priority != priority:
+                    reprioritize(pending_task, priority)
+                return pending_task
+
+        task = Task(function, priority, key)
+        heapq.heappush(execution_queue, (priority, next(order), task))
+        if key is not None:
+            pending_by_key[key] = task
+        return task
+
+
+def get_queue_depth():
+    """Get the number of tasks waiting to run"""
+    with lock:
+        return sum(1 for priority, task_order, task in execution_queue if not task.is_cancelled)
 
 
-# public method
-def add(function):
-    """Add a function to the task queue, to be executed in the main thread"""
-    execution_queue.put(function)
+def get_queue_depths():
+    """Get the number of tasks waiting to run, for each priority"""
+    depths = {}
+    with lock:
+        for priority, task_order, task in execution_queue:
+            if not task.is_cancelled:
+                depths[priority] = depths.get(priority, 0) + 1
+    return depths
 
 
 def register():
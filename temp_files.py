@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from . import config
+
+
+# all of AI Render's temp files (renders, generated images, upscales, ControlNet inputs,
+# previews) go in a folder for this session, inside config.tmp_path_subfolder. Once the
+# folder gets bigger than the max size, the least recently used files are removed, except
+# for files that are still referenced (e.g. the last generated image) and brand new files
+# (which may still be waiting to be loaded). The folder is removed when the add-on is
+# unregistered, and folders left behind by a crash are removed the next time.
+
+SESSION_PREFIX = "session-"
+
+# files newer than this are never removed, since they may still be in use
+MIN_AGE_TO_REMOVE = 60
+
+# folders from other sessions older than this are assumed to have been left by a crash
+STALE_SESSION_AGE = 24 * 60 * 60
+
+
+# private
+lock = threading.Lock()
+session_dir = None
+files = {} # path -> size (None until it's been written), in order of last use
+references = {} # name -> set of paths
+max_size = None # set in the main thread from the preferences, since bpy isn't thread safe
+
+
+def get_root_dir():
+    return os.path.join(tempfile.gettempdir(), config.tmp_path_subfolder)
+
+
+def ensure_session_dir():
+    global session_dir
+
+    if session_dir is None or not os.path.isdir(session_dir):
+        root_dir = get_root_dir()
+        os.makedirs(root_dir, exist_ok=True)
+        remove_stale_sessions(root_dir)
+        session_dir = tempfile.mkdtemp(prefix=SESSION_PREFIX, dir=root_dir)
+    return session_dir
+
+
+def remove_stale_sessions(root_dir):
+    now = time.time()
+    try:
+        for entry in os.scandir(root_dir):
+            if entry.name.startswith(SESSION_PREFIX) and entry.is_dir() and now - entry.stat().st_mtime > STALE_SESSION_AGE:
+                shutil.rmtree(entry.path, ignore_errors=True)
+    except OSError:
+        pass
+
+
+def is_referenced(path):
+    return any(path in paths for paths in references.values())
+
+
+def remove_file(path):
+    files.pop(path, None)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def evict(max_size):
+    """Remove the least recently used files until the session folder is under max_size (call with the lock held)"""
+    total_size = 0
+    for path, size in list(files.items()):
+        if not size:
+            try:
+                size = files[path] = os.path.getsize(path)
+            except OSError:
+                # it's been removed (or renamed) by something else
+                files.pop(path, None)
+                continue
+        total_size += size
+
+    if total_size <= max_size:
+        return
+
+    now = time.time()
+    for path, size in list(files.items()):
+        if total_size <= max_size:
+            break
+        if is_referenced(path):
+            continue
+        try:
+            if now - os.path.getmtime(path) < MIN_AGE_TO_REMOVE:
+                continue
+        except OSError:
+            pass
+
+        remove_file(path)
+        total_size -= size or 0
+
+
+# public methods
+def set_max_size(size):
+    """Set how big the session folder can get before the least recently used files are removed"""
+    global max_size
+    with lock:
+        max_size = size
+
+
+def create(prefix, suffix=".png"):
+    """Create a new, empty temp file in this session's folder, and return its path"""
+    with lock:
+        file, path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=ensure_session_dir())
+        os.close(file)
+        files[path] = None
+
+        if max_size is not None:
+            evict(max_size)
+
+    return path
+
+
+def write_atomic(path, data):
+    """Write a file all at once, so it's never left half written (e.g. if a download fails part way)"""
+    partial_path = path + ".partial"
+    try:
+        with open(partial_path, 'wb') as file:
+            file.write(data)
+        os.replace(partial_path, path)
+    except:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+
+def touch(path):
+    """Mark a temp file as just used, so it's the last to be removed"""
+    with lock:
+        if path in files:
+            files[path] = files.pop(path)
+
+
+def set_reference(name, paths):
+    """Keep the given temp files (a path or a list of them) until the reference with this name is changed"""
+    if isinstance(paths, str):
+        paths = [paths]
+
+    with lock:
+        references[name] = set(path for path in paths if path)
+
+    for path in paths:
+        touch(path)
+
+
+def get_session_size():
+    with lock:
+        return sum(size for size in files.values() if size)
+
+
+def cleanup(keep_referenced=True):
+    """Remove this session's temp files (except the referenced ones, if keep_referenced is True)"""
+    global session_dir
+
+    with lock:
+        for path in list(files):
+            if not keep_referenced or not is_referenced(path):
+                remove_file(path)
+
+        if session_dir and not files:
+            shutil.rmtree(session_dir, ignore_errors=True)
+            session_dir = None
+
+
+def register():
+    pass
+
+
+def unregister():
+    # the referenced files (e.g. the last generated image) are kept, since the blend file
+    # may still point to them. They're removed with the folder once it goes stale.
+    cleanup()
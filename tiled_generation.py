@@ -0,0 +1,176 @@
+import math
+import os
+import numpy as np
+from . import (
+    encoded_image,
+    operators,
+    pixel_utils,
+    utils,
+)
+
+
+# an image that's too big for the backend (see max_image_size()) can be generated in
+# tiles: it's split into overlapping tiles that each fit within the backend's limit, the
+# tiles are all sent at once (so they're generated in parallel, as far as the backend
+# allows), and the generated tiles are blended back together, fading from one tile to
+# the next across the overlap so there are no visible seams.
+#
+# Reading and writing the pixels uses Blender's images, so splitting and blending happen
+# in the main thread (but they're vectorized, so they're quick).
+
+# tile sizes are a multiple of this (like the image dimensions)
+TILE_SIZE_STEP = utils.valid_dimension_step_size
+
+
+class TiledRequest:
+    """Collects the results of the tile requests (which can come back in any order), and calls on_done(tile_files) once
+    they're all back. As soon as one tile fails, the others are cancelled (there's no image without it), and only that
+    tile's error is shown"""
+
+    def __init__(self, tile_count, on_done, cancel_token):
+        self.tile_files = [None] * tile_count
+        self.remaining = tile_count
+        self.on_done = on_done
+        self.cancel_token = cancel_token
+        self.failed = False
+
+    def handle_result(self, index, result):
+        # each result is (tile_file, errors), from operators.request_generated_tile
+        tile_file, errors = result or (False, [])
+        self.tile_files[index] = tile_file
+
+        if not tile_file and not self.failed:
+            self.failed = True
+            # (if the tiles were already cancelled, there's no error to show)
+            if self.cancel_token.cancel():
+                if errors:
+                    operators.handle_error(*errors[0])
+                else:
+                    operators.handle_error(None, "Couldn't generate one of the tiles", "tiled_generation")
+
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.on_done(self.tile_files)
+
+
+def get_tile_size(width, height, max_pixels):
+    # the biggest tiles that fit the backend, as square as the image allows
+    side = min(int(math.sqrt(max_pixels)) // TILE_SIZE_STEP * TILE_SIZE_STEP, utils.max_dimension_size)
+    tile_width = min(width, side)
+    tile_height = min(height, utils.max_dimension_size, max_pixels // tile_width // TILE_SIZE_STEP * TILE_SIZE_STEP)
+    return tile_width, tile_height
+
+
+def get_tile_positions(length, tile_length, overlap):
+    # spread the tiles evenly, so they overlap by at least the given amount
+    if tile_length >= length:
+        return [0]
+    overlap = min(overlap, tile_length // 2)
+    count = math.ceil((length - overlap) / (tile_length - overlap))
+    return [round(i * (length - tile_length) / (count - 1)) for i in range(count)]
+
+
+def get_fade(position, tile_length, positions):
+    # how far this tile overlaps the tiles before and after it
+    index = positions.index(position)
+    fade_start = positions[index - 1] + tile_length - position if index > 0 else 0
+    fade_end = position + tile_length - positions[index + 1] if index < len(positions) - 1 else 0
+    return fade_start, fade_end
+
+
+def get_ramp(length, fade_start, fade_end):
+    # 1 in the middle of the tile, easing down towards 0 across the overlaps
+    positions = np.arange(length, dtype=np.float32) + 0.5
+    ramp = np.ones(length, dtype=np.float32)
+    if fade_start:
+        ramp = np.minimum(ramp, positions / fade_start)
+    if fade_end:
+        ramp = np.minimum(ramp, (length - positions) / fade_end)
+    return ramp * ramp * (3 - 2 * ramp)
+
+
+def get_tile_weights(tile):
+    """Get the feathered blending weights for a tile, as a (height, width, 1) array"""
+    row_ramp = get_ramp(tile["height"], *tile["fade_y"])
+    column_ramp = get_ramp(tile["width"], *tile["fade_x"])
+    return np.outer(row_ramp, column_ramp)[:, :, np.newaxis]
+
+
+# public methods
+def get_tiles(width, height, max_pixels, overlap):
+    """Split an image into overlapping tiles that fit within max_pixels. Each tile is a dict with its position and size
+    (in Blender's pixel coordinates, from the bottom left), and how far it fades into its neighbors"""
+    tile_width, tile_height = get_tile_size(width, height, max_pixels)
+    x_positions = get_tile_positions(width, tile_width, overlap)
+    y_positions = get_tile_positions(height, tile_height, overlap)
+
+    return [{
+        "x": x,
+        "y": y,
+        "width": tile_width,
+        "height": tile_height,
+        "fade_x": get_fade(x, tile_width, x_positions),
+        "fade_y": get_fade(y, tile_height, y_positions),
+    } for y in y_positions for x in x_positions]
+
+
+def split_image(scene, image, width, height, tiles, filename_prefix):
+    """Split an image (an EncodedImage, or the path of an image file) into the tiles, resizing it to width x height
+    first if it isn't already. Returns a list of EncodedImages (one per tile), or False if there was an error"""
+    temp_file = None
+    try:
+        # Blender can only load images from files
+        if isinstance(image, encoded_image.EncodedImage):
+            temp_file = utils.create_temp_file(filename_prefix + "-", suffix=f".{image.file_format.lower()}")
+            image.save(temp_file)
+            image = temp_file
+
+        pixels = pixel_utils.resize(pixel_utils.read_image_file(image), width, height)
+        return [
+            encoded_image.EncodedImage(
+                pixel_utils.encode_png(pixel_utils.to_uint8(pixels[tile["y"]:tile["y"] + tile["height"], tile["x"]:tile["x"] + tile["width"]])),
+                'PNG',
+                f"{filename_prefix}-tile-{i + 1}",
+            )
+            for i, tile in enumerate(tiles)
+        ]
+    except Exception as e:
+        print(e)
+        return operators.handle_error(scene, "Couldn't split the image into tiles", "tiled_generation")
+    finally:
+        if temp_file:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+
+
+def blend_tiles(scene, tiles, tile_files, file_format, filename_prefix):
+    """Blend the generated tiles back into one image, and save it (in the given format) to a temp file. Returns the
+    file's path, or False if there was an error"""
+    width = max(tile["x"] + tile["width"] for tile in tiles)
+    height = max(tile["y"] + tile["height"] for tile in tiles)
+
+    try:
+        blended = np.zeros((height, width, 4), dtype=np.float32)
+        total_weights = np.zeros((height, width, 1), dtype=np.float32)
+
+        for tile, tile_file in zip(tiles, tile_files):
+            # (the backend might not give back exactly the size we asked for)
+            tile_pixels = pixel_utils.resize(pixel_utils.read_image_file(tile_file), tile["width"], tile["height"])
+            weights = get_tile_weights(tile)
+
+            area = np.s_[tile["y"]:tile["y"] + tile["height"], tile["x"]:tile["x"] + tile["width"]]
+            blended[area] += tile_pixels * weights
+            total_weights[area] += weights
+
+        blended /= np.maximum(total_weights, 1e-6)
+
+        data = pixel_utils.encode_image(pixel_utils.to_uint8(blended), file_format)
+        output_file = utils.create_temp_file(filename_prefix + "-", suffix=f".{file_format.lower()}")
+        with open(output_file, 'wb') as file:
+            file.write(data)
+        return output_file
+    except Exception as e:
+        print(e)
+        return operators.handle_error(scene, "Couldn't blend the generated tiles together", "tiled_generation")
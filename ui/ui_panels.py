@@ -2,8 +2,12 @@ import bpy
 import math
 from .. import (
     addon_updater_ops,
+    animation_journal,
+    cancellation,
     config,
+    local_upscaler,
     operators,
+    result_cache,
     utils,
 )
 
@@ -80,7 +84,10 @@ class AIR_PT_setup(bpy.types.Panel):
 
     @classmethod
     def are_dimensions_small_enough(cls, context):
-        return not utils.are_dimensions_too_large(context.scene) and context.scene.air_props.error_key != 'dimensions_too_large'
+        return (
+            (not utils.are_dimensions_too_large(context.scene) or context.scene.air_props.use_tiled_generation)
+            and context.scene.air_props.error_key != 'dimensions_too_large'
+        )
 
     @classmethod
     def are_dimensions_large_enough(cls, context):
@@ -121,6 +128,9 @@ class AIR_PT_setup(bpy.types.Panel):
                 utils.label_multiline(layout, text="Adjust Image Size: \nStable Diffusion only works on certain image dimensions.", icon="INFO", width=width_guess)
             elif not AIR_PT_setup.are_dimensions_small_enough(context):
                 utils.label_multiline(layout, text=f"Adjust Image Size: \nImage dimensions are too large. Please decrease width and/or height. Total pixel area must be at most {round(utils.get_active_backend().max_image_size() / (1024*1024), 1)} megapixels.", icon="INFO", width=width_guess)
+
+                row = layout.row()
+                row.prop(props, "use_tiled_generation", text="Or Generate in Tiles")
             else:
                 utils.label_multiline(layout, text=f"Adjust Image Size: \nImage dimensions are too small. Please increase width and/or height. Total pixel area must be at least {round(utils.get_active_backend().min_image_size() / (1024*1024), 1)} megapixels.", icon="INFO", width=width_guess)
 
@@ -137,7 +147,7 @@ class AIR_PT_setup(bpy.types.Panel):
             col = row.column()
             col.operator(operators.AIR_OT_show_other_dimension_options.bl_idname, text="Other")
 
-            if utils.get_active_backend().supports_upscaling() and props.do_upscale_automatically:
+            if props.do_upscale_automatically:
                 layout.separator()
                 box = layout.box()
                 utils.label_multiline(box, text=f"Final image will be upscaled {round(props.upscale_factor)}x larger than these initial dimensions.", width=width_guess-20)
@@ -264,6 +274,14 @@ class AIR_PT_advanced_options(bpy.types.Panel):
         sub = row.column()
         sub.prop(props, 'steps', text="", slider=False)
 
+        # Variations
+        if utils.get_active_backend().supports_batches():
+            row = layout.row()
+            sub = row.column()
+            sub.label(text="Variations")
+            sub = row.column()
+            sub.prop(props, 'batch_size', text="", slider=False)
+
         # Prompt Strength
         row = layout.row()
         sub = row.column()
@@ -286,16 +304,48 @@ class AIR_PT_advanced_options(bpy.types.Panel):
         sub = row.column()
         sub.prop(props, 'sampler', text="")
 
+        # Tiled Generation
+        row = layout.row()
+        row.prop(props, 'use_tiled_generation')
+
+        if props.use_tiled_generation:
+            row = layout.row()
+            sub = row.column()
+            sub.label(text="Tile Overlap")
+            sub = row.column()
+            sub.prop(props, 'tiled_generation_overlap', text="", slider=False)
+
+        # Live Preview
+        if utils.sd_backend(context) == "automatic1111":
+            row = layout.row()
+            row.prop(props, 'automatic1111_live_preview')
 
         row = layout.row()
         row.operator(operators.AIR_OT_automatic1111_load_sd_models.bl_idname, text="Load SD Models", icon="FILE_REFRESH")
 
+        # Result Cache
+        if utils.is_result_cache_enabled(context):
+            box = layout.box()
+            row = box.row()
+            row.label(text="Result Cache:")
+            row.operator(operators.AIR_OT_clear_result_cache.bl_idname, text="", icon="TRASH")
+
+            row = box.row()
+            row.label(text=result_cache.get_stats_summary(utils.result_cache_path(context)))
+            if props.use_random_seed:
+                row = box.row()
+                row.label(text="Set a fixed seed to use cached images", icon="INFO")
+
 class AIR_LT_ControlNetList(bpy.types.UIList):
     def draw_item(self, context, layout, data, item, icon, active_data, active_propname):
         layout.separator()
         layout.prop(item, "model", text="")
         layout.prop(item, "preprocessor", text="")
-        layout.template_ID(item, "image", open="image.open")
+        layout.prop(item, "input_source", text="")
+        if item.input_source == 'IMAGE':
+            layout.template_ID(item, "image", open="image.open")
+        elif item.input_source == 'AOV':
+            layout.prop(item, "aov_name", text="")
 
 
 class AIR_PT_controlnet(bpy.types.Panel):
@@ -383,6 +433,23 @@ class AIR_PT_operation(bpy.types.Panel):
         row.enabled = props.last_generated_image_filename != ""
         row.operator(operators.AIR_OT_generate_new_image_from_last_sd_image.bl_idname)
 
+        # Cancel whatever is being generated
+        if cancellation.get_active_count() > 0:
+            row = layout.row()
+            row.operator(operators.AIR_OT_cancel_generation.bl_idname, icon='CANCEL')
+
+        # Variations from the last batch
+        variation_files = utils.get_variation_files(props)
+        if variation_files:
+            layout.separator()
+
+            row = layout.row()
+            row.label(text="Choose a Variation:")
+
+            row = layout.row(align=True)
+            for i in range(len(variation_files)):
+                row.operator(operators.AIR_OT_choose_variation.bl_idname, text=str(i + 1), depress=i == props.selected_variation).index = i
+
         layout.separator()
 
         row = layout.row()
@@ -418,6 +485,10 @@ class AIR_PT_upscale(bpy.types.Panel):
     def does_backend_support_upscaling(cls, context):
         return utils.get_active_backend().supports_upscaling()
 
+    @classmethod
+    def should_upscale_locally(cls, context):
+        return utils.should_upscale_locally(context.scene.air_props)
+
     @classmethod
     def is_upscaler_model_list_loaded(cls, context):
         return utils.get_active_backend().is_upscaler_model_list_loaded(context)
@@ -437,14 +508,16 @@ class AIR_PT_upscale(bpy.types.Panel):
 
         width_guess = 220
 
-        # if backend does not support upscaling, show message
+        # if backend does not support upscaling, show message (images are upscaled locally instead)
         if not AIR_PT_upscale.does_backend_support_upscaling(context):
             box = layout.box()
-            utils.label_multiline(box, text=f"Upscaling is not supported by {utils.sd_backend_formatted_name()}. If you'd like to upscale your image, switch to DreamStudio or Automatic1111 in AI Render's preferences.", icon="ERROR", width=width_guess)
-            return
+            utils.label_multiline(box, text=f"Upscaling is not supported by {utils.sd_backend_formatted_name()}, so images will be upscaled on this computer (on the CPU).", icon="INFO", width=width_guess)
+        else:
+            row = layout.row()
+            row.prop(props, "use_local_upscaler")
 
         # if the upscaler model list hasn't been loaded, show message and button
-        if not AIR_PT_upscale.is_upscaler_model_list_loaded(context):
+        if not AIR_PT_upscale.should_upscale_locally(context) and not AIR_PT_upscale.is_upscaler_model_list_loaded(context):
             utils.label_multiline(layout, text="To get started upscaling, load the available upscaler models", icon="ERROR", width=width_guess)
             layout.operator(operators.AIR_OT_automatic1111_load_upscaler_models.bl_idname, text="Load Upscaler Models", icon="FILE_REFRESH")
             return
@@ -459,11 +532,12 @@ class AIR_PT_upscale(bpy.types.Panel):
         sub = row.column()
         sub.prop(props, "upscale_factor", text="", slider=False)
 
-        row = layout.row()
-        sub = row.column()
-        sub.label(text="Upscaler Model")
-        sub = row.column()
-        sub.prop(props, "upscaler_model", text="")
+        if not AIR_PT_upscale.should_upscale_locally(context):
+            row = layout.row()
+            sub = row.column()
+            sub.label(text="Upscaler Model")
+            sub = row.column()
+            sub.prop(props, "upscaler_model", text="")
 
         box = layout.box()
         row = box.row()
@@ -473,8 +547,16 @@ class AIR_PT_upscale(bpy.types.Panel):
         if not AIR_PT_upscale.are_upscaled_dimensions_small_enough(context):
             utils.label_multiline(layout, text="Upscaled dimensions are too large. Please decrease the scale factor.", icon="ERROR", width=width_guess)
 
+        # if we're upscaling locally, show how quick it is (once it's been measured)
+        if AIR_PT_upscale.should_upscale_locally(context):
+            row = layout.row()
+            row.operator(operators.AIR_OT_benchmark_local_upscaler.bl_idname, icon="TIME")
+            if local_upscaler.last_throughput:
+                row = layout.row()
+                row.label(text=f"Local upscaler: {local_upscaler.last_throughput:.1f} megapixels per second")
+
         # if the backend supports reloading the upscaler model list, show button
-        if AIR_PT_upscale.does_backend_support_reloading_upscaler_model_list(context):
+        elif AIR_PT_upscale.does_backend_support_reloading_upscaler_model_list(context):
             row = layout.row()
             row.operator(operators.AIR_OT_automatic1111_load_upscaler_models.bl_idname, text="Reload Upscaler Models", icon="FILE_REFRESH")
 
@@ -515,10 +597,33 @@ class AIR_PT_inpaint(bpy.types.Panel):
         sub.prop(props, 'inpaint_padding', text="", slider=False)
 
         row = layout.row()
-        row.prop(props, "inpaint_mask_path", text="Mask")
+        sub = row.column()
+        sub.label(text="Mask:")
+        sub = row.column()
+        sub.prop(props, "inpaint_mask_source", text="")
+
+        if props.inpaint_mask_source == 'FILE':
+            row = layout.row()
+            row.prop(props, "inpaint_mask_path", text="Mask")
+        else:
+            if props.inpaint_mask_source == 'OBJECT_INDEX':
+                row = layout.row()
+                sub = row.column()
+                sub.label(text="Object Index:")
+                sub = row.column()
+                sub.prop(props, "inpaint_mask_object_index", text="")
+
+            row = layout.row()
+            sub = row.column()
+            sub.label(text="Feather:")
+            sub = row.column()
+            sub.prop(props, "inpaint_mask_feather", text="", slider=False)
+
+            row = layout.row()
+            row.prop(props, "inpaint_mask_invert")
 
         row = layout.row()
-        row.enabled = props.last_generated_image_filename != "" and props.inpaint_mask_path != ""
+        row.enabled = props.last_generated_image_filename != "" and (props.inpaint_mask_path != "" or props.inpaint_mask_source != 'FILE')
         row.operator(operators.AIR_OT_inpaint_from_last_sd_image.bl_idname)
 
 
@@ -610,10 +715,56 @@ class AIR_PT_animation(bpy.types.Panel):
         row.operator(operators.AIR_OT_render_animation.bl_idname, icon="RENDER_ANIMATION", text=render_animation_text)
         row.enabled = is_animation_enabled_button_enabled
 
+        # Resume an animation render that stopped part way
+        if is_animation_enabled_button_enabled and not props.is_rendering_animation_manually:
+            remaining_frames = animation_journal.get_remaining_frames(operators.get_animation_output_dir(scene), check_files=False)
+            if remaining_frames:
+                row = layout.row()
+                frame_or_frames = "Frame" if len(remaining_frames) == 1 else "Frames"
+                row.operator(operators.AIR_OT_render_animation.bl_idname, icon="RECOVER_LAST", text=f"Resume Animation ({len(remaining_frames)} {frame_or_frames} Left)").resume = True
+
         # Path
         row = layout.row()
         row.prop(props, "animation_output_path", text="Path")
 
+        # Pipelining
+        row = layout.row()
+        sub = row.column()
+        sub.label(text="Frames in Flight")
+        sub = row.column()
+        sub.prop(props, "animation_pipeline_depth", text="", slider=False)
+
+        # Retrying failed frames
+        row = layout.row()
+        sub = row.column()
+        sub.label(text="Retries per Frame")
+        sub = row.column()
+        sub.prop(props, "animation_frame_retries", text="", slider=False)
+
+        # Incremental re-renders
+        row = layout.row()
+        row.prop(props, "animation_skip_unchanged_frames")
+
+        # Sharing frames with other instances
+        row = layout.row()
+        row.prop(props, "animation_use_sharding")
+
+        if props.animation_use_sharding:
+            box = layout.box()
+
+            row = box.row(align=True)
+            row.prop(props, "animation_shard_index")
+            row.prop(props, "animation_shard_count")
+
+            row = box.row()
+            row.prop(props, "animation_shard_frames")
+
+            row = box.row()
+            row.prop(props, "animation_claim_timeout")
+
+            row = box.row()
+            row.operator(operators.AIR_OT_clear_frame_claims.bl_idname, icon="TRASH")
+
         # Animated Prompts
         layout.separator()
 
@@ -624,6 +775,12 @@ class AIR_PT_animation(bpy.types.Panel):
             row = layout.row()
             row.operator(operators.AIR_OT_edit_animated_prompts.bl_idname)
 
+            row = layout.row()
+            sub = row.column()
+            sub.label(text="Blend Frames")
+            sub = row.column()
+            sub.prop(props, "animated_prompts_blend_frames", text="", slider=False)
+
         # Tips
         if round(props.image_similarity, 2) < 0.7 and not props.close_animation_tips:
             layout.separator()
@@ -23,7 +23,12 @@ import os
 import shutil
 import math
 import tempfile
-from . import config
+import threading
+import types
+from . import (
+    config,
+    temp_files,
+)
 from .sd_backends import (
     automatic1111_api,
     stability_api,
@@ -33,20 +38,62 @@ from .sd_backends import (
 
 min_dimension_size = 128
 max_dimension_size = 2048
+max_tiled_dimension_size = 8192
+max_local_upscaled_image_size = 4096 * 4096
 valid_dimension_step_size = 64
 
 example_dimensions = [512, 640, 768, 896, 960, 1024, 1280, 1344, 1600, 1920, 2048]
 file_formats = {"JPEG": "jpg", "BMP": "bmp", "IRIS": "rgb", "PNG": "png", "JPEG2000": "jp2", "TARGA": "tga", "TARGA_RAW": "tga", "CINEON": "cin", "DPX": "dpx", "OPEN_EXR_MULTILAYER": "exr", "OPEN_EXR": "exr", "HDR": "hdr", "TIFF": "tif", "WEBP": "webp"}
 
 
+# private
+preferences_snapshot = None
+
+
 def get_addon_preferences(context=None):
+    # bpy isn't thread safe, so other threads (e.g. the worker threads sending requests)
+    # get a copy of the preferences that was made in the main thread
+    if not context and threading.current_thread() is not threading.main_thread():
+        return preferences_snapshot
+
     if not context:
         context = bpy.context
     return context.preferences.addons[__package__].preferences
 
 
+def update_preferences_snapshot(context=None):
+    """Copy the add-on preferences for the other threads to read (this has to be called in the main thread)"""
+    global preferences_snapshot
+
+    preferences = get_addon_preferences(context)
+    preferences_snapshot = get_snapshot(preferences)
+    temp_files.set_max_size(preferences.temp_files_max_size * 1024 * 1024)
+
+
 def create_temp_file(prefix, suffix=".png"):
-    return tempfile.NamedTemporaryFile(prefix=prefix, suffix=suffix).name
+    # (the max size is set by update_preferences_snapshot, so this is safe in any thread)
+    return temp_files.create(prefix, suffix)
+
+
+def get_snapshot(props):
+    values = {}
+    for prop in props.bl_rna.properties:
+        if prop.identifier == 'rna_type' or prop.type in {'POINTER', 'COLLECTION'}:
+            continue
+        values[prop.identifier] = getattr(props, prop.identifier)
+    return types.SimpleNamespace(**values)
+
+
+def get_props_snapshot(props):
+    """Copy the simple property values (and the upscaled size) into a plain object, which is safe to read outside the
+    main thread. This also refreshes the copy of the preferences, so the request sees the current ones"""
+    update_preferences_snapshot()
+
+    snapshot = get_snapshot(props)
+    max_upscaled_image_size = get_active_backend().max_upscaled_image_size()
+    snapshot.upscaled_width = sanitized_upscaled_width(max_upscaled_image_size, props.id_data)
+    snapshot.upscaled_height = sanitized_upscaled_height(max_upscaled_image_size, props.id_data)
+    return snapshot
 
 
 def should_autosave_after_image(props):
@@ -206,6 +253,42 @@ def local_sd_timeout(context=None):
     return get_addon_preferences(context).local_sd_timeout
 
 
+def is_local_sd_server_pool_enabled(context=None):
+    preferences = get_addon_preferences(context)
+    return preferences.use_local_sd_server_pool and preferences.local_sd_server_pool.strip() != ""
+
+
+def local_sd_server_pool(context=None):
+    return get_addon_preferences(context).local_sd_server_pool
+
+
+def get_variation_files(props):
+    return props.variation_files.split("||||") if props.variation_files else []
+
+
+def is_result_cache_enabled(context=None):
+    return get_addon_preferences(context).use_result_cache
+
+
+def result_cache_path(context=None):
+    path = get_addon_preferences(context).result_cache_path.strip()
+    if not path:
+        return os.path.join(tempfile.gettempdir(), config.result_cache_subfolder)
+    return os.path.normpath(bpy.path.abspath(path))
+
+
+def result_cache_max_size(context=None):
+    return get_addon_preferences(context).result_cache_max_size * 1024 * 1024
+
+
+def temp_files_max_size(context=None):
+    return get_addon_preferences(context).temp_files_max_size * 1024 * 1024
+
+
+def output_image_history(context=None):
+    return get_addon_preferences(context).output_image_history
+
+
 def get_output_width(scene):
     return round(scene.render.resolution_x * scene.render.resolution_percentage / 100)
 
@@ -256,16 +339,21 @@ def sanitized_upscaled_height(max_upscaled_image_size, scene=None):
         return upscaled_height
 
 
+def get_max_dimension_size(scene):
+    # when generating in tiles, only each tile has to be within the backend's limits
+    return max_tiled_dimension_size if scene.air_props.use_tiled_generation else max_dimension_size
+
+
 def are_dimensions_valid(scene):
     return (
         get_output_width(scene) in range(
             min_dimension_size,
-            max_dimension_size + valid_dimension_step_size, # range is exclusive of the last value
+            get_max_dimension_size(scene) + valid_dimension_step_size, # range is exclusive of the last value
             valid_dimension_step_size
         ) and
         get_output_height(scene) in range(
             min_dimension_size,
-            max_dimension_size + valid_dimension_step_size, # range is exclusive of the last value
+            get_max_dimension_size(scene) + valid_dimension_step_size, # range is exclusive of the last value
             valid_dimension_step_size
         )
     )
@@ -275,12 +363,31 @@ def are_dimensions_too_large(scene):
     return get_output_width(scene) * get_output_height(scene) > get_active_backend().max_image_size()
 
 
+def should_generate_in_tiles(scene):
+    return scene.air_props.use_tiled_generation and (
+        are_dimensions_too_large(scene)
+        or get_output_width(scene) > max_dimension_size
+        or get_output_height(scene) > max_dimension_size
+    )
+
+
 def are_dimensions_too_small(scene):
     return get_output_width(scene) * get_output_height(scene) < get_active_backend().min_image_size()
 
 
+def should_upscale_locally(props=None):
+    # upscale on this computer if we've chosen to, or if the backend can't upscale at all
+    if not props:
+        props = bpy.context.scene.air_props
+    return props.use_local_upscaler or not get_active_backend().supports_upscaling()
+
+
+def get_max_upscaled_image_size(scene):
+    return max_local_upscaled_image_size if should_upscale_locally(scene.air_props) else get_active_backend().max_upscaled_image_size()
+
+
 def are_upscaled_dimensions_too_large(scene):
-    return get_upscaled_width(scene) * get_upscaled_height(scene) > get_active_backend().max_upscaled_image_size()
+    return get_upscaled_width(scene) * get_upscaled_height(scene) > get_max_upscaled_image_size(scene)
 
 
 def generate_example_dimensions_tuple_list():
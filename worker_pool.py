@@ -0,0 +1,65 @@
+import concurrent.futures
+import functools
+import threading
+import traceback
+from . import (
+    operators,
+    task_queue,
+)
+
+
+# private
+max_workers = 8
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ai-render")
+        return executor
+
+
+def handle_done(callback, future):
+    # this runs on the worker thread, so hand the result over to the main thread
+    if future.cancelled():
+        return
+
+    try:
+        result = future.result()
+    except Exception as e:
+        # the callback only sees that there's no result, so tell the user what went wrong here
+        # (handle_error hands the message over to the main thread)
+        print("AI Render Error: Unexpected error on a worker thread")
+        traceback.print_exc()
+        operators.handle_error(None, f"Something went wrong while talking to the Stable Diffusion server: {e}", "unexpected_error")
+        result = False
+
+    task_queue.add(functools.partial(callback, result), task_queue.PRIORITY_RESULT)
+
+
+# public methods
+def submit(function, callback=None):
+    """Run a function on a worker thread. If a callback is given, it will be called with the function's result, in the main thread"""
+    future = get_executor().submit(function)
+    if callback:
+        future.add_done_callback(functools.partial(handle_done, callback))
+    return future
+
+
+def is_main_thread():
+    return threading.current_thread() is threading.main_thread()
+
+
+def register():
+    pass
+
+
+def unregister():
+    global executor
+    with executor_lock:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = None